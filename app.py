@@ -13,7 +13,30 @@ from src.core.client import connect_to_server
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='WebSocket Chat Client with Image Support')
     parser.add_argument('--sound', '-s', type=str, help='Path to custom notification sound file (.wav)')
+    parser.add_argument('--render-mode', choices=['full', 'half'], help='Image rendering: one or two pixels per terminal cell')
+    parser.add_argument('--colors', choices=['truecolor', '256', '16'], help='Color palette used to render images')
+    parser.add_argument('--batch-ms', type=float, help='Coalesce messages sent within this window into one frame')
+    parser.add_argument('--compression', choices=['on', 'off'], help='Negotiate permessage-deflate with the server')
+    parser.add_argument('--compression-threshold', type=int, help='Only compress messages of at least this many bytes')
+    parser.add_argument('--protocol', choices=['msgpack', 'json'], help='Wire protocol to ask the server for (falls back to JSON)')
+    parser.add_argument('--media-codec', choices=['none', 'zstd'], help='Compress image uploads (zstd needs the zstandard package)')
     args = parser.parse_args()
+
+    if args.batch_ms is not None:
+        config.BATCH_WINDOW_MS = args.batch_ms
+    if args.compression:
+        config.COMPRESSION = args.compression == 'on'
+    if args.compression_threshold is not None:
+        config.COMPRESSION_THRESHOLD = args.compression_threshold
+    if args.protocol:
+        config.WIRE_PROTOCOLS = list(dict.fromkeys([args.protocol, 'json']))
+    if args.media_codec:
+        config.MEDIA_CHUNK_CODEC = args.media_codec
+
+    if args.render_mode:
+        config.IMAGE_RENDER_MODE = args.render_mode
+    if args.colors:
+        config.IMAGE_COLOR_MODE = args.colors
     
     # Set notification sound from command line argument or use default
     if args.sound:
@@ -28,7 +51,7 @@ if __name__ == "__main__":
         if os.path.exists(default_sound) and os.path.getsize(default_sound) > 100:
             config.NOTIFICATION_SOUND = default_sound
             print(f"Using default notification sound: {default_sound}")
-    
+
     try:
         asyncio.run(connect_to_server())
     except KeyboardInterrupt:
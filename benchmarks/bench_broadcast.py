@@ -0,0 +1,103 @@
+"""Broadcast throughput: per-recipient ``json.dumps`` vs encode-once fan-out.
+
+Starts a local websocket server, connects N clients to it and measures how
+many events per second the server can deliver to all of them, first with the
+original loop (one ``json.dumps`` and one awaited ``send`` per recipient) and
+then through ``src.server.broadcast`` (one encode, one queue put per
+recipient, writers drain concurrently).
+
+Usage:
+    python -m benchmarks.bench_broadcast [--events 200] [--clients 10 100 1000]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from src.core import serialization
+from src.server import broadcast as fanout
+
+HOST = "localhost"
+PORT = 8790
+
+
+def make_event(i):
+    return {
+        "type": "atack_notification",
+        "message": f"user{i % 50} attacked user{(i + 1) % 50} with meteor.",
+    }
+
+
+async def send_before(connections, events):
+    """The original server path: serialize and await once per recipient."""
+    for i in range(events):
+        for ws in connections:
+            await ws.send(json.dumps(make_event(i)))
+
+
+async def send_after(connections, events):
+    """Encode once and queue the same bytes for every recipient.
+
+    Waits for room in full queues: the overflow policy would drop frames once
+    there are more events than ``config.SEND_QUEUE_SIZE``.
+    """
+    for i in range(events):
+        await fanout.broadcast_wait(connections, make_event(i))
+
+
+async def drain(ws, expected):
+    received = 0
+    while received < expected:
+        await ws.recv()
+        received += 1
+
+
+async def run(client_count, events, sender):
+    server_side = []
+    connected = asyncio.Event()
+
+    async def handler(websocket):
+        server_side.append(websocket)
+        if len(server_side) == client_count:
+            connected.set()
+        await websocket.wait_closed()
+
+    async with websockets.serve(handler, HOST, PORT, max_queue=None):
+        clients = [await websockets.connect(f"ws://{HOST}:{PORT}", max_queue=None) for _ in range(client_count)]
+        await connected.wait()
+        for ws in server_side:
+            fanout.open_outbox(ws)
+
+        receivers = [asyncio.create_task(drain(ws, events)) for ws in clients]
+        start = time.perf_counter()
+        await sender(server_side, events)
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        for ws in server_side:
+            fanout.close_outbox(ws)
+        for ws in clients:
+            await ws.close()
+    return elapsed
+
+
+async def main(events, client_counts):
+    print(f"JSON backend: {serialization.BACKEND}")
+    print(f"{'clients':>8} {'before ev/s':>12} {'after ev/s':>12} {'before msg/s':>14} {'after msg/s':>14}")
+    for count in client_counts:
+        before = await run(count, events, send_before)
+        after = await run(count, events, send_after)
+        print(
+            f"{count:>8} {events / before:>12.0f} {events / after:>12.0f} "
+            f"{events * count / before:>14.0f} {events * count / after:>14.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadcast serialization benchmark")
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+    asyncio.run(main(args.events, args.clients))
@@ -0,0 +1,168 @@
+"""Compression policy: CPU cost vs bytes saved on representative traffic.
+
+Runs synthetic chat traffic through the same permessage-deflate extension
+the client and server negotiate (``src.core.compression``), with context
+takeover as in a real connection, for a few window size / memory level
+settings. Every message is also decompressed, so the CPU column is what
+both ends pay together. Image chunks are also compressed with zstd when the
+``zstandard`` package is installed.
+
+Traffic classes:
+
+* chat: single chat lines, mostly a few dozen bytes.
+* history: ``history`` pages of 50 messages (also /search results).
+* users: ``user_list`` replies.
+* jpeg / raw: 64 KiB chunks of a photo-like image, as an upload after
+  downscaling (JPEG) and as an uncompressed original (``/image --original``
+  of a BMP).
+
+The "policy" rows replay a mix of all classes with the configured threshold
+and binary setting, vs compressing everything.
+
+Usage:
+    python -m benchmarks.bench_compression [--messages 2000] [--threshold 512] [--repeat 3]
+"""
+import argparse
+import io
+import json
+import random
+import time
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+
+from src.core import compression
+from src.core import config
+
+WORDS = (
+    "hello world image meteor attack lobby room server client terminal render "
+    "color pixel sound whisper chat message history search index cluster worker "
+    "ok lol yes no thanks see you later brb anyone here? nice gg"
+).split()
+USERS = [f"user{i}" for i in range(50)]
+
+# (window bits, memory level)
+DEFLATE_SETTINGS = [(9, 1), (12, 5), (15, 8)]
+
+
+def chat_line(rng):
+    return {"type": "message", "user": rng.choice(USERS), "text": " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))}
+
+
+def traffic(count, rng):
+    """{class: list of (opcode, payload bytes)}"""
+    messages = [json.dumps(chat_line(rng)).encode() for _ in range(count)]
+    pages = []
+    for _ in range(max(count // 50, 1)):
+        page = [dict(chat_line(rng), seq=i, ts=1.7e9 + i) for i in range(50)]
+        pages.append(json.dumps({"type": "history", "room": "lobby", "messages": page, "more": True}).encode())
+    users = [
+        json.dumps({"type": "user_list", "users": [
+            {"name": name, "life": rng.randint(0, 100), "room": "lobby"} for name in USERS
+        ], "count": len(USERS)}).encode()
+        for _ in range(max(count // 100, 1))
+    ]
+    jpeg, raw = image_bytes(rng)
+    return {
+        "chat": [(Opcode.TEXT, m) for m in messages],
+        "history": [(Opcode.TEXT, p) for p in pages],
+        "users": [(Opcode.TEXT, u) for u in users],
+        "jpeg": [(Opcode.BINARY, c) for c in chunks(jpeg)],
+        "raw": [(Opcode.BINARY, c) for c in chunks(raw)],
+    }
+
+
+def image_bytes(rng):
+    """A photo-like test image, as JPEG and as uncompressed BMP."""
+    from PIL import Image, ImageFilter
+
+    noise = Image.frombytes("RGB", (640, 480), bytes(rng.getrandbits(8) for _ in range(640 * 480 * 3)))
+    image = Image.radial_gradient("L").resize((640, 480)).convert("RGB")
+    image = Image.blend(image, noise.filter(ImageFilter.GaussianBlur(3)), 0.5)
+    encoded = []
+    for fmt, options in (("JPEG", {"quality": config.IMAGE_UPLOAD_QUALITY}), ("BMP", {})):
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, **options)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def chunks(data):
+    return [data[i:i + config.IMAGE_CHUNK_SIZE] for i in range(0, len(data), config.IMAGE_CHUNK_SIZE)]
+
+
+def best_of(repeat, fn, *args, **kwargs):
+    """(bytes out, lowest CPU seconds) of ``repeat`` runs."""
+    runs = [fn(*args, **kwargs) for _ in range(repeat)]
+    return runs[0][0], min(cpu for _, cpu in runs)
+
+
+def run_deflate(frames, window_bits, mem_level, threshold=0, binary=True):
+    """(bytes out, CPU seconds) to compress and decompress ``frames`` on one connection."""
+    encoder = compression.SelectiveDeflate(
+        False, False, window_bits, window_bits, {"memLevel": mem_level, "level": config.COMPRESSION_LEVEL},
+        threshold=threshold, binary=binary,
+    )
+    decoder = PerMessageDeflate(False, False, window_bits, window_bits)
+    size = 0
+    start = time.process_time()
+    for opcode, payload in frames:
+        frame = encoder.encode(Frame(opcode, payload))
+        size += len(frame.data)
+        decoder.decode(frame)
+    return size, time.process_time() - start
+
+
+def run_zstd(frames):
+    size = 0
+    start = time.process_time()
+    for _, payload in frames:
+        compressed = compression.compress_chunk(payload, "zstd")
+        size += len(compressed)
+        compression.decompress_chunk(compressed, "zstd", config.IMAGE_CHUNK_SIZE)
+    return size, time.process_time() - start
+
+
+def row(name, setting, frames, size, cpu):
+    raw = sum(len(payload) for _, payload in frames)
+    saved = raw - size
+    per_kb = cpu * 1e6 / max(saved / 1024, 1e-9) if saved > 0 else float("inf")
+    print(f"{name:<9} {setting:<16} {len(frames):>7} {raw:>11} {size:>11} {saved / raw:>7.1%} "
+          f"{cpu * 1e6 / len(frames):>10.1f} {per_kb:>12.1f}")
+
+
+def main(count, threshold, repeat):
+    rng = random.Random(1)
+    classes = traffic(count, rng)
+    print(f"{'traffic':<9} {'setting':<16} {'msgs':>7} {'bytes':>11} {'on wire':>11} {'saved':>7} "
+          f"{'us/msg':>10} {'us/KiB saved':>12}")
+    for name, frames in classes.items():
+        for window_bits, mem_level in DEFLATE_SETTINGS:
+            size, cpu = best_of(repeat, run_deflate, frames, window_bits, mem_level)
+            row(name, f"deflate w{window_bits} m{mem_level}", frames, size, cpu)
+        if frames[0][0] is Opcode.BINARY and compression.zstandard is not None:
+            size, cpu = best_of(repeat, run_zstd, frames)
+            row(name, f"zstd {config.MEDIA_ZSTD_LEVEL}", frames, size, cpu)
+        print()
+
+    # Interleave the classes the way a busy room would see them
+    mix = [frame for frames in classes.values() for frame in frames]
+    rng.shuffle(mix)
+    window_bits, mem_level = config.COMPRESSION_WINDOW_BITS, config.COMPRESSION_MEM_LEVEL
+    for setting, kwargs in (
+        ("everything", dict(threshold=0, binary=True)),
+        (f"text >= {threshold}", dict(threshold=threshold, binary=False)),
+    ):
+        size, cpu = best_of(repeat, run_deflate, mix, window_bits, mem_level, **kwargs)
+        row("policy", setting, mix, size, cpu)
+    if compression.zstandard is None:
+        print("\nzstandard is not installed: zstd rows skipped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compression CPU vs bytes saved benchmark")
+    parser.add_argument("--messages", type=int, default=2000, help="Chat lines (other classes scale with it)")
+    parser.add_argument("--threshold", type=int, default=config.COMPRESSION_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.messages, args.threshold, args.repeat)
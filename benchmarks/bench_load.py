@@ -0,0 +1,531 @@
+"""Load test: thousands of simulated clients against a local server.
+
+Starts ``server.py`` in a subprocess (with a temporary history database and
+media store, and the rate limits off unless ``--set`` says otherwise),
+connects ``--clients`` asyncio clients to it and has each of them act
+``--rate`` times per second, picking from a weighted ``--mix`` of:
+
+* message: a chat line to the whole lobby;
+* whisper: a private message to a random user;
+* atack: an atack on a random user;
+* users: a ``users`` query (the reply lists every user);
+* image: a chunked image upload of ``--image-kb`` random bytes.
+
+Measured during ``--duration`` seconds, after the clients are connected and
+``--warmup`` seconds have passed:
+
+* end-to-end delivery latency of messages and images, as seen by
+  ``--observers`` clients that decode everything they receive (the others
+  just drain their socket, which keeps the load generator cheap);
+* round trip of whispers, atacks and users queries, to their reply;
+* throughput: events sent, frames and bytes delivered;
+* CPU and resident memory of the server processes (from /proc, Linux only)
+  and CPU of the load generator itself, to tell when it is the bottleneck.
+
+Sender and receivers live in this process, so latencies use one clock.
+
+The result is printed as JSON (or written to ``--output``) with the
+parameters and git revision, so runs can be kept and compared:
+``--compare baseline.json`` prints the change of every headline number.
+
+Usage:
+    python -m benchmarks.bench_load [--clients 500] [--rate 0.5] [--duration 20]
+        [--mix message=70,whisper=10,atack=5,users=5,image=10] [--observers 20]
+        [--workers 1] [--protocol msgpack] [--set BATCH_WINDOW_MS=5 ...] [--output run.json] [--compare base.json]
+"""
+import argparse
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict, deque
+
+import websockets
+
+from src.core import batching
+from src.core import compression
+from src.core import config
+from src.core import protocol
+from src.core import serialization
+from src.core.transfer import pack_chunk
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ACTIONS = ("message", "whisper", "atack", "users", "image")
+DEFAULT_MIX = "message=70,whisper=10,atack=5,users=5,image=10"
+
+# Request -> reply types that end its round trip
+REPLIES = {
+    "whisper": ("whisper_sent", "whisper_error"),
+    "atack": ("atack_error",),  # or the battle event with the hit, see _received
+    "users": ("user_list",),
+}
+REPLY_KIND = {reply: kind for kind, replies in REPLIES.items() for reply in replies}
+
+# Runs the server with config overrides applied before it builds its stores
+SERVER_CODE = """
+import asyncio, functools, json, sys
+from src.core import config
+for key, value in json.loads(sys.argv[1]).items():
+    setattr(config, key, value)
+import server
+workers = int(sys.argv[2])
+try:
+    if workers > 1:
+        server.run_cluster(functools.partial(server.run_worker, workers=workers), workers)
+    else:
+        asyncio.run(server.main())
+except KeyboardInterrupt:
+    pass
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers, overrides, tmp):
+    settings = {
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": port,
+        "HISTORY_DB": os.path.join(tmp, "history.db"),
+        "MEDIA_STORE_DIR": os.path.join(tmp, "media"),
+        "CLUSTER_SOCKET": os.path.join(tmp, "cluster.sock"),
+        "RATE_LIMITS": {},
+        "METRICS_PORT": 0,
+        "LOG_LEVEL": "warning",
+        "BATCH_STATS_INTERVAL": 0,
+        **overrides,
+    }
+    log = open(os.path.join(tmp, "server.log"), "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_CODE, json.dumps(settings), str(workers)],
+        cwd=ROOT, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}, see {log.name}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+# Server resources, from /proc
+
+def process_tree(pid):
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/task/{child}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def tree_usage(pid):
+    """(CPU seconds, resident bytes) of a process and its children, or None."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = rss = 0
+    try:
+        for p in process_tree(pid):
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+    except (OSError, ValueError, IndexError):
+        return None
+    return cpu, rss
+
+
+# Load generator
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(int(q * len(samples)), len(samples) - 1)] * 1000, 3)
+
+    return {"count": len(samples), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": at(1.0)}
+
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.window_start = None
+        self.latencies = defaultdict(list)  # kind -> seconds
+        self.sent = defaultdict(int)        # action -> count, during the window
+        self.frames = 0
+        self.bytes = 0
+        self.observed_messages = 0
+        self.errors = defaultdict(int)
+
+    def latency(self, kind, sent_at, now):
+        """Record a latency, if the event was sent during the window.
+
+        Returns:
+            bool: True if it was recorded.
+        """
+        if self.recording and sent_at >= self.window_start:
+            self.latencies[kind].append(now - sent_at)
+            return True
+        return False
+
+
+class SimClient:
+    def __init__(self, index, observer, stats, rng):
+        self.name = f"load{index}"
+        self.observer = observer
+        self.stats = stats
+        self.rng = rng
+        self.websocket = None
+        self.packed = False
+        self.pending = defaultdict(deque)  # request kind -> send times, replies come in order
+        self.images = {}                   # transfer id -> sent_at, seen by this observer
+
+    async def connect(self, uri):
+        self.websocket = await websockets.connect(
+            uri, max_size=None, open_timeout=30,
+            compression=None, extensions=compression.client_extensions(), subprotocols=protocol.available()
+        )
+        self.packed = protocol.is_packed(self.websocket.subprotocol)
+        # Any event with a user name registers it; this one has a small reply
+        await self.websocket.send(self.encode({"type": "command", "name": "rooms", "user": self.name}))
+
+    def encode(self, event):
+        return protocol.pack(event) if self.packed else json.dumps(event)
+
+    async def read(self):
+        stats = self.stats
+        try:
+            async for frame in self.websocket:
+                stats.frames += 1
+                stats.bytes += len(frame)
+                binary = isinstance(frame, bytes)
+                # Binary frames are image chunks, unless they are packed events
+                if not (self.observer or self._waiting()) or (binary and not (self.packed and protocol.packed_type(frame))):
+                    continue
+                data = protocol.unpack(frame) if binary else serialization.decode(frame)
+                for event in batching.unpack(data):
+                    self._received(event, time.perf_counter())
+        except websockets.ConnectionClosed:
+            pass
+
+    def _waiting(self):
+        return any(self.pending.values())
+
+    def _received(self, event, now):
+        kind = event.get("type")
+        if kind in REPLY_KIND:
+            pending = self.pending[REPLY_KIND[kind]]
+            if pending:
+                self.stats.latency(f"{REPLY_KIND[kind]}_rtt", pending.popleft(), now)
+            return
+        if kind == "battle":
+            # Atacks are resolved in ticks: the round trip ends with the tick of the hit
+            pending = self.pending["atack"]
+            for hit in event.get("hits", ()):
+                if hit.get("from") == self.name and pending:
+                    self.stats.latency("atack_rtt", pending.popleft(), now)
+            return
+        if not self.observer:
+            return
+        if kind == "message" and "sent_at" in event:
+            if self.stats.latency("message", event["sent_at"], now):
+                self.stats.observed_messages += 1
+        elif kind == "image_start" and "sent_at" in event:
+            self.images[event.get("id")] = event["sent_at"]
+        elif kind == "image_end":
+            sent_at = self.images.pop(event.get("id"), None)
+            if sent_at is not None:
+                self.stats.latency("image", sent_at, now)
+
+    async def act(self, action, names, image_bytes):
+        now = time.perf_counter()
+        target = self.rng.choice(names)
+        if action == "message":
+            await self.websocket.send(self.encode({
+                "type": "message", "user": self.name, "text": f"load test {self.rng.random()}", "sent_at": now
+            }))
+        elif action == "whisper":
+            self.pending["whisper"].append(now)
+            await self.websocket.send(self.encode({
+                "type": "whisper", "from": self.name, "to": target, "message": "psst"
+            }))
+        elif action == "atack":
+            self.pending["atack"].append(now)
+            await self.websocket.send(self.encode({
+                "type": "atack", "from": self.name, "to": target, "atack": "punch"
+            }))
+        elif action == "users":
+            self.pending["users"].append(now)
+            await self.websocket.send(self.encode({"type": "command", "name": "users", "user": self.name}))
+        elif action == "image":
+            await self.send_image(image_bytes)
+        if self.stats.recording:
+            self.stats.sent[action] += 1
+
+    async def send_image(self, size):
+        data = os.urandom(size)
+        transfer_id = uuid.uuid4()
+        await self.websocket.send(self.encode({
+            "type": "image_start", "id": transfer_id.hex, "user": self.name,
+            "filename": "load.png", "size": size, "sent_at": time.perf_counter()
+        }))
+        seq = 0
+        for offset in range(0, size, config.IMAGE_CHUNK_SIZE):
+            await self.websocket.send(pack_chunk(transfer_id.bytes, seq, data[offset:offset + config.IMAGE_CHUNK_SIZE]))
+            seq += 1
+        await self.websocket.send(self.encode({
+            "type": "image_end", "id": transfer_id.hex, "chunks": seq, "sha256": hashlib.sha256(data).hexdigest()
+        }))
+
+    async def run(self, rate, actions, weights, names, image_bytes):
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            action = self.rng.choices(actions, weights)[0]
+            try:
+                await self.act(action, names, image_bytes)
+            except websockets.ConnectionClosed:
+                self.stats.errors["closed"] += 1
+                return
+
+
+async def connect_all(clients, uri, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with semaphore:
+            await client.connect(uri)
+
+    results = await asyncio.gather(*(connect(client) for client in clients), return_exceptions=True)
+    return [client for client, result in zip(clients, results) if not isinstance(result, BaseException)]
+
+
+async def drive(args, uri, server_pid):
+    rng = random.Random(args.seed)
+    stats = Stats()
+    mix = parse_mix(args.mix)
+    actions, weights = list(mix), list(mix.values())
+    clients = [SimClient(i, i < args.observers, stats, random.Random(rng.random())) for i in range(args.clients)]
+
+    start = time.perf_counter()
+    connected = await connect_all(clients, uri, args.concurrency)
+    connect_seconds = time.perf_counter() - start
+    if len(connected) < len(clients):
+        stats.errors["connect"] = len(clients) - len(connected)
+    names = [client.name for client in connected]
+    readers = [asyncio.create_task(client.read()) for client in connected]
+
+    senders = [
+        asyncio.create_task(client.run(args.rate, actions, weights, names, args.image_kb * 1024))
+        for client in connected
+    ]
+    await asyncio.sleep(args.warmup)
+
+    # Measurement window
+    server_before = tree_usage(server_pid)
+    own_before = resource.getrusage(resource.RUSAGE_SELF)
+    frames_before, bytes_before = stats.frames, stats.bytes
+    stats.window_start = time.perf_counter()
+    stats.recording = True
+    peak_rss = 0
+    while time.perf_counter() - stats.window_start < args.duration:
+        await asyncio.sleep(min(1, args.duration))
+        usage = tree_usage(server_pid)
+        if usage is not None:
+            peak_rss = max(peak_rss, usage[1])
+    elapsed = time.perf_counter() - stats.window_start
+    for sender in senders:
+        sender.cancel()
+    frames, received_bytes = stats.frames - frames_before, stats.bytes - bytes_before
+    server_after = tree_usage(server_pid)
+    own_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # Let what was sent in the window arrive before closing
+    await asyncio.sleep(args.drain)
+    stats.recording = False
+    await asyncio.gather(*senders, return_exceptions=True)
+    await asyncio.gather(*(client.websocket.close() for client in connected), return_exceptions=True)
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    sent_total = sum(stats.sent.values())
+    own_cpu = (own_after.ru_utime + own_after.ru_stime) - (own_before.ru_utime + own_before.ru_stime)
+    result = {
+        "clients": len(connected),
+        "connect_seconds": round(connect_seconds, 3),
+        "duration": round(elapsed, 3),
+        "throughput": {
+            "sent_per_s": round(sent_total / elapsed, 1),
+            "sent_by_action": dict(stats.sent),
+            "frames_delivered_per_s": round(frames / elapsed, 1),
+            "bytes_delivered_per_s": round(received_bytes / elapsed, 1),
+        },
+        "latency_ms": {kind: percentiles(samples) for kind, samples in sorted(stats.latencies.items())},
+        "loadgen_cpu_percent": round(own_cpu / elapsed * 100, 1),
+        "errors": dict(stats.errors),
+    }
+    if stats.sent["message"] and args.observers:
+        # Every observer should get every message (the sender's room is the lobby)
+        result["observer_delivery_ratio"] = round(
+            stats.observed_messages / (stats.sent["message"] * min(args.observers, len(connected))), 4
+        )
+    if result["loadgen_cpu_percent"] > 90:
+        print("Warning: the load generator was CPU bound, latencies include its own delays", file=sys.stderr)
+    if server_before and server_after:
+        result["server"] = {
+            "cpu_seconds": round(server_after[0] - server_before[0], 3),
+            "cpu_percent": round((server_after[0] - server_before[0]) / elapsed * 100, 1),
+            "rss_mb_peak": round(max(peak_rss, server_after[1]) / 2 ** 20, 1),
+            "rss_mb_end": round(server_after[1] / 2 ** 20, 1),
+        }
+    return result
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        action, _, weight = item.partition("=")
+        action = action.strip()
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"Unknown action {action!r}, expected one of {', '.join(ACTIONS)}")
+        mix[action] = float(weight or 1)
+    return {action: weight for action, weight in mix.items() if weight > 0}
+
+
+def parse_setting(text):
+    """``KEY=VALUE`` with a Python literal value, for a server config override."""
+    key, _, value = text.partition("=")
+    if not hasattr(config, key):
+        raise argparse.ArgumentTypeError(f"Unknown config setting {key!r}")
+    try:
+        return key, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return key, value
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def headline(result):
+    """The numbers worth comparing between runs: name -> (value, True if higher is better)."""
+    numbers = {
+        "sent/s": (result["throughput"]["sent_per_s"], True),
+        "frames delivered/s": (result["throughput"]["frames_delivered_per_s"], True),
+    }
+    for kind, latency in result["latency_ms"].items():
+        for q in ("p50", "p99"):
+            if q in latency:
+                numbers[f"{kind} {q} ms"] = (latency[q], False)
+    if "server" in result:
+        numbers["server CPU %"] = (result["server"]["cpu_percent"], False)
+        numbers["server RSS MB"] = (result["server"]["rss_mb_peak"], False)
+    return numbers
+
+
+def compare(baseline, result):
+    before, after = headline(baseline["result"]), headline(result["result"])
+    print(f"\n{'metric':<24} {'baseline':>12} {'this run':>12} {'change':>9}", file=sys.stderr)
+    for name, (value, higher_is_better) in after.items():
+        if name not in before:
+            continue
+        old = before[name][0]
+        change = (value - old) / old * 100 if old else 0.0
+        better = (change > 0) == higher_is_better or change == 0
+        print(f"{name:<24} {old:>12g} {value:>12g} {change:>+8.1f}% {'' if better else '(worse)'}", file=sys.stderr)
+
+
+def main(args):
+    overrides = dict(args.set)
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        process = start_server(port, args.workers, overrides, tmp)
+        try:
+            result = asyncio.run(drive(args, f"ws://127.0.0.1:{port}", process.pid))
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "benchmark": "bench_load",
+        "version": 1,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git": git_revision(),
+        "python": sys.version.split()[0],
+        "params": {
+            "clients": args.clients, "rate": args.rate, "duration": args.duration, "warmup": args.warmup,
+            "mix": parse_mix(args.mix), "observers": args.observers, "image_kb": args.image_kb,
+            "workers": args.workers, "seed": args.seed, "server_config": overrides,
+            "compression": config.COMPRESSION,
+            "protocol": protocol.available()[0],
+        },
+        "result": result,
+    }
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(encoded)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server load test")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=0.5, help="Actions per second of each client")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds measured")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=2, help="Seconds to wait for late deliveries")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weighted actions (default {DEFAULT_MIX})")
+    parser.add_argument("--observers", type=int, default=20, help="Clients that decode and time deliveries")
+    parser.add_argument("--image-kb", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--concurrency", type=int, default=100, help="Connections opened at a time")
+    parser.add_argument("--compression", choices=["on", "off"], help="Negotiate permessage-deflate")
+    parser.add_argument("--protocol", choices=["json", "msgpack"], help="Wire protocol of the clients")
+    parser.add_argument("--set", type=parse_setting, action="append", default=[], metavar="KEY=VALUE",
+                        help="Server config override, e.g. BATCH_WINDOW_MS=5 or SEND_QUEUE_SIZE=1024")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON result here instead of stdout")
+    parser.add_argument("--compare", help="Earlier JSON result to compare against")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+    if args.compression:
+        config.COMPRESSION = args.compression == "on"
+        args.set.append(("COMPRESSION", config.COMPRESSION))
+    if args.protocol:
+        config.WIRE_PROTOCOLS = [args.protocol]
+    main(args)
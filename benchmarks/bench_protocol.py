@@ -0,0 +1,69 @@
+"""Wire protocols: bytes per event and encode/decode cost, JSON vs msgpack.
+
+Encodes representative server and client events with the JSON backend of
+``src.core.serialization`` and with ``chat.msgpack`` (``src.core.protocol``),
+and decodes them back, as the receiving side would.
+
+Usage:
+    python -m benchmarks.bench_protocol [--repeat 20000]
+"""
+import argparse
+import time
+
+from src.core import protocol
+from src.core import serialization
+
+USERS = [{"name": f"user{i}", "life": 100 - i, "room": "lobby"} for i in range(50)]
+
+EVENTS = {
+    "atack": {"type": "atack", "from": "alice", "to": "bob", "atack": "punch"},
+    "atack_received": {"type": "atack_received", "from": "alice", "atack": "punch"},
+    "life_update": {"type": "life_update", "life": 70},
+    "atack_notification": {"type": "atack_notification", "message": "alice attacked bob with punch."},
+    "battle": {"type": "battle", "room": "lobby", "tick": 1042, "hits": [
+        {"from": "alice", "to": "bob", "atack": "punch", "damage": 8, "life": 62},
+        {"from": "carol", "to": "alice", "atack": "fireball", "damage": 25, "life": 75},
+    ], "defeated": [], "respawned": []},
+    "message": {"type": "message", "user": "alice", "text": "anyone up for a game?"},
+    "whisper": {"type": "whisper", "from": "alice", "to": "bob", "message": "psst"},
+    "user_list": {"type": "user_list", "users": USERS, "count": len(USERS)},
+    "history": {"type": "history", "room": "lobby", "more": True, "replay": False, "messages": [
+        {"seq": i, "ts": 1.7e9 + i, "user": f"user{i % 50}", "text": "hello world " * (i % 4 + 1)} for i in range(50)
+    ]},
+}
+
+
+def per_event(repeat, fn, arg):
+    """Microseconds per call, best of 3."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6 / repeat
+
+
+def main(repeat):
+    if protocol.msgpack is None:
+        print("msgpack is not installed")
+        return
+    print(f"JSON backend: {serialization.BACKEND}")
+    print(f"{'event':<19} {'json B':>7} {'msgpack B':>10} {'saved':>6} "
+          f"{'json enc/dec us':>16} {'msgpack enc/dec us':>19}")
+    for name, event in EVENTS.items():
+        text, packed = serialization.encode(event), protocol.pack(event)
+        assert protocol.unpack(packed) == event
+        times = [
+            per_event(repeat, serialization.encode, event), per_event(repeat, serialization.decode, text),
+            per_event(repeat, protocol.pack, event), per_event(repeat, protocol.unpack, packed),
+        ]
+        print(f"{name:<19} {len(text):>7} {len(packed):>10} {1 - len(packed) / len(text):>6.0%} "
+              f"{times[0]:>7.2f} /{times[1]:>7.2f} {times[2]:>9.2f} /{times[3]:>7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wire protocol size and CPU benchmark")
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,127 @@
+"""Terminal image rendering: per-cell ``print`` loop vs vectorized renderer.
+
+Renders the same image at a fixed terminal size with the original
+implementation of ``display_image_in_terminal`` and with the current one,
+writing into an in-memory buffer, and reports time per frame and output size.
+
+Usage:
+    python -m benchmarks.bench_render [--image path] [--columns 200] [--lines 60] [--repeat 5]
+"""
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import numpy
+from PIL import Image
+
+from src.utils import image_utils, render_cache
+
+
+def legacy_load(image_path, columns, lines):
+    """Image loading as it was before vectorization, kept for comparison."""
+    image = Image.open(image_path, "r")
+    image.thumbnail((columns, lines - 1), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    width, height = image.size
+    pixel_values = list(image.getdata())
+    return numpy.array(pixel_values).reshape((height, width, 3))
+
+
+def legacy_render(image, columns, lines):
+    """The per-cell print loop as it was before vectorization."""
+    target_lines = lines - 1
+    target_columns = columns
+    img_height, img_width, channels = image.shape
+    k = 0
+    for i in range(img_height):
+        if i >= target_lines:
+            break
+        for j in range(img_width):
+            if j >= target_columns:
+                break
+            r = image[i][j][k]
+            g = image[i][j][k+1]
+            b = image[i][j][k+2]
+            background_color_code = f"\033[48;2;{r};{g};{b}m"
+            reset_code = "\033[0m"
+            colored_char = f"{background_color_code} {reset_code}"
+            print(colored_char, end="")
+        print()
+
+
+def current_render(pixels, mode="full", colors="truecolor"):
+    sys.stdout.write(image_utils.render_ansi(pixels, mode, colors))
+
+
+def current_total(data):
+    # Start cold: the render cache would otherwise serve every repeat
+    render_cache.CACHE.clear()
+    image_utils.display_image_in_terminal(io.BytesIO(data), "full", "truecolor")
+
+
+def make_test_image():
+    """A photo-like JPEG: smooth gradients with some noise."""
+    y, x = numpy.mgrid[0:600, 0:2000]
+    pixels = numpy.stack([x * 255 // 2000, y * 255 // 600, (x + y) * 255 // 2600], axis=2)
+    pixels = pixels + numpy.random.default_rng(0).integers(-12, 12, pixels.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8)).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def time_frames(render, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        sink = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            render()
+        best = min(best, time.perf_counter() - start)
+    return best, len(sink.getvalue().encode("utf-8"))
+
+
+def main(image, columns, lines, repeat):
+    data = open(image, "rb").read() if image else make_test_image()
+    image_utils.get_terminal_size = lambda: (columns, lines)
+    pixels = image_utils.load_image(io.BytesIO(data), columns, lines - 1)
+    legacy_pixels = legacy_load(io.BytesIO(data), columns, lines)
+
+    rows = [
+        ("load", lambda: legacy_load(io.BytesIO(data), columns, lines),
+         lambda: image_utils.load_image(io.BytesIO(data), columns, lines - 1)),
+        ("render", lambda: legacy_render(legacy_pixels, columns, lines),
+         lambda: current_render(pixels)),
+        ("total", lambda: legacy_render(legacy_load(io.BytesIO(data), columns, lines), columns, lines),
+         lambda: current_total(data)),
+    ]
+
+    print(f"terminal {columns}x{lines}, image cells {pixels.shape[1]}x{pixels.shape[0]}, best of {repeat}")
+    print(f"{'stage':>8} {'legacy ms':>10} {'current ms':>11} {'speedup':>8} {'legacy B':>10} {'current B':>10}")
+    for name, legacy_fn, current_fn in rows:
+        legacy, legacy_bytes = time_frames(legacy_fn, repeat)
+        current, current_bytes = time_frames(current_fn, repeat)
+        print(f"{name:>8} {legacy * 1000:>10.1f} {current * 1000:>11.1f} {legacy / current:>7.1f}x "
+              f"{legacy_bytes:>10} {current_bytes:>10}")
+
+    print()
+    print(f"{'mode':>6} {'colors':>10} {'pixels':>10} {'ms':>8} {'bytes':>10}")
+    for mode in image_utils.RENDER_MODES:
+        rows_per_line = 2 if mode == "half" else 1
+        mode_pixels = image_utils.load_image(io.BytesIO(data), columns, (lines - 1) * rows_per_line)
+        for colors in image_utils.COLOR_MODES:
+            elapsed, size = time_frames(lambda: current_render(mode_pixels, mode, colors), repeat)
+            print(f"{mode:>6} {colors:>10} {mode_pixels.shape[1]}x{mode_pixels.shape[0]:<5} "
+                  f"{elapsed * 1000:>8.1f} {size:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Terminal image rendering benchmark")
+    parser.add_argument("--image", type=str, help="Image to render (defaults to a generated one)")
+    parser.add_argument("--columns", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.image, args.columns, args.lines, args.repeat)
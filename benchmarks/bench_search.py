@@ -0,0 +1,112 @@
+"""History search: FTS5 inverted index vs a ``LIKE`` scan of the log.
+
+Fills a temporary history database with synthetic chat messages through the
+same batched writes the server uses (so the index is maintained by the
+insert trigger), then times ``HistoryStore.search`` against the scan a
+naive implementation would run.
+
+Usage:
+    python -m benchmarks.bench_search [--messages 1000000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from src.server.history import HistoryStore
+
+WORDS = (
+    "hello world image meteor attack lobby room server client terminal render "
+    "color pixel sound whisper chat message history search index cluster worker "
+    "python socket queue batch cache media upload download frame"
+).split()
+USERS = [f"user{i}" for i in range(200)]
+ROOMS = ["lobby", "dev", "games", "random", "music"]
+
+QUERIES = [
+    ("single term", dict(terms=["meteor"])),
+    ("two terms", dict(terms=["meteor", "whisper"])),
+    ("rare pair", dict(terms=["pixel", "download", "cluster"])),
+    ("rare term", dict(terms=["needle"])),
+    ("prefix", dict(terms=["termin*"])),
+    ("term + user", dict(terms=["image"], user="user42")),
+    ("term + room + time", dict(terms=["cache"], room="dev", since=0.5)),
+]
+
+
+def fill(store, count, batch_size=10000):
+    rng = random.Random(1)
+    start = time.time() - count
+    for offset in range(0, count, batch_size):
+        batch = []
+        for i in range(offset, min(offset + batch_size, count)):
+            words = rng.choices(WORDS, k=rng.randint(3, 12))
+            if i % 10007 == 0:
+                words.append("needle")
+            batch.append((rng.choice(ROOMS), start + i, rng.choice(USERS), " ".join(words)))
+        store._write(batch)
+    return start
+
+
+def scan(store, terms, user=None, room=None, since=0, limit=50):
+    """What a search without the index has to do: test every row."""
+    sql = "SELECT seq, ts, user, room, text FROM messages WHERE ts >= ?"
+    args = [since]
+    for term in terms:
+        sql += " AND text LIKE ?"
+        args.append(f"%{term.rstrip('*')}%")
+    if user:
+        sql += " AND user = ?"
+        args.append(user)
+    if room:
+        sql += " AND room = ?"
+        args.append(room)
+    sql += " ORDER BY seq DESC LIMIT ?"
+    args.append(limit)
+    return store._connect().execute(sql, args).fetchall()
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+async def main(messages, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = HistoryStore(os.path.join(tmp, "history.db"))
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        first_ts = await loop.run_in_executor(store.executor, fill, store, messages)
+        print(f"Inserted and indexed {messages} messages in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'query':<20} {'results':>8} {'index ms':>10} {'scan ms':>10}")
+        for name, query in QUERIES:
+            query = dict(query)
+            if "since" in query:
+                query["since"] = first_ts + messages * query["since"]
+
+            results = await store.search(**query)
+            best = float("inf")
+            for _ in range(repeat):
+                t = time.perf_counter()
+                await store.search(**query)
+                best = min(best, time.perf_counter() - t)
+            scan_ms = await loop.run_in_executor(
+                store.executor, timed, lambda: scan(store, **query), repeat
+            )
+            print(f"{name:<20} {len(results):>8} {best * 1000:>10.2f} {scan_ms:>10.2f}")
+        await store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="History search benchmark")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.repeat))
@@ -0,0 +1,88 @@
+"""Client startup: time from launching ``app.py`` to the first prompt.
+
+Everything the client does before asking for the server URI is importing
+modules, so this times a fresh interpreter importing ``app`` (minus the bare
+interpreter start-up), reports the slowest imports from ``python -X
+importtime`` and checks that the heavy image and audio libraries are not
+loaded yet.
+
+Exits with status 1 when a heavy module is imported at startup or the
+median exceeds ``--budget-ms``, so it can be used as a regression check.
+
+Usage:
+    python -m benchmarks.bench_startup [--runs 10] [--top 15] [--budget-ms 300]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed once an image or a sound is used
+HEAVY_MODULES = ("numpy", "PIL", "pygame", "cv2")
+
+
+def run_python(code, *flags):
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+
+
+def wall_time(code, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_python(code)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def slowest_imports(top):
+    """(cumulative us, self us, module) of the slowest imports, from -X importtime."""
+    stderr = run_python("import app", "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # column header
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main(runs, top, budget_ms):
+    baseline = wall_time("pass", runs)
+    total = wall_time("import app", runs)
+    startup = total - baseline
+    loaded = run_python(
+        f"import sys, app; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    ).stdout.split()
+
+    print(f"Interpreter start:   {baseline:8.1f} ms")
+    print(f"Time to prompt:      {startup:8.1f} ms  (median of {runs}, interpreter excluded)")
+    print(f"Heavy modules loaded: {', '.join(loaded) or 'none'}")
+    print(f"\n{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_time, name in slowest_imports(top):
+        print(f"{cumulative / 1000:>14.1f} {self_time / 1000:>9.1f}  {name.strip()}")
+
+    failed = bool(loaded)
+    if budget_ms is not None and startup > budget_ms:
+        print(f"\nFAIL: time to prompt {startup:.1f} ms is over the {budget_ms} ms budget")
+        failed = True
+    if loaded:
+        print(f"\nFAIL: {', '.join(loaded)} imported at startup")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client startup benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+    sys.exit(main(args.runs, args.top, args.budget_ms))
@@ -1,183 +1,696 @@
+import argparse
 import asyncio
+import functools
+import logging
+import sqlite3
+import time
+import uuid
 import websockets
-import json
+from src.core import batching
+from src.core import compression
 from src.core import config
+from src.core import protocol
+from src.core import serialization
+from src.core.dispatch import Dispatcher
+from src.core.transfer import pack_chunk, unpack_chunk, CHUNK_ID_SIZE, TransferError
+from src.server.registry import Registry, DEFAULT_ROOM
+from src.server.broadcast import (
+    open_outbox, close_outbox, send, send_wait, hold_outbox, release_outbox, METER, OUTBOXES
+)
+from src.server.media_store import MediaStore, is_digest
+from src.server.cluster import Cluster, make_backend, run_cluster
+from src.server.history import HistoryStore
+from src.server import metrics
+from src.server import ratelimit
+from src.server.ratelimit import RateLimiter, THROTTLED
+from src.server.logs import LEVELS, setup_logging
+from src.server.sessions import SessionManager
+from src.server.battle import BattleEngine
+
+REGISTRY = Registry()
+CLUSTER = Cluster(REGISTRY)
+MEDIA_STORE = MediaStore()
+HISTORY = HistoryStore()
+SESSIONS = SessionManager(REGISTRY, CLUSTER)
+BATTLE = BattleEngine(REGISTRY, CLUSTER)
+SESSIONS.on_adopt(BATTLE.adopt)
+STARTED = time.time()
+
+log = logging.getLogger("chat.server")
+
+
+def queue_depths():
+    """Frames waiting in each connection's send queue, by user (or address before registering)."""
+    depths = {}
+    for websocket, outbox in OUTBOXES.items():
+        if outbox.detached or outbox.closed:
+            continue
+        session = REGISTRY.get(websocket)
+        depths[(session['name'] if session else str(websocket.remote_address),)] = outbox.queue.qsize()
+    return depths
+
+
+metrics.Gauge("chat_connections", "Open websocket connections", read=lambda: {(): len(OUTBOXES) - len(SESSIONS.expiry)})
+metrics.Gauge("chat_users", "Users registered on this worker", read=lambda: {(): REGISTRY.count})
+metrics.Gauge("chat_detached_sessions", "Sessions waiting for their client to reconnect", read=lambda: {(): len(SESSIONS.expiry)})
+metrics.Gauge("chat_send_queue_depth", "Frames waiting in a connection's send queue", ("user",), read=queue_depths)
+metrics.Gauge("chat_throttled", "Events throttled by the rate limits", ("kind", "action"), read=lambda: dict(THROTTLED))
+
+
+def end_session(websocket):
+    """Drop a user for good: its connection closed and it didn't come back."""
+    close_outbox(websocket)
+    disconnected_user = REGISTRY.disconnect(websocket)
+    if disconnected_user:
+        CLUSTER.announce_leave(disconnected_user['name'])
+        BATTLE.forget(disconnected_user['name'])
+        log.info("User '%s' disconnected. Total users: %d", disconnected_user['name'], REGISTRY.total)
+
+
+SESSIONS.on_expire = end_session
+
+
+async def stream_media(websocket, digest, user, filename):
+    """Send a stored image to one client as a regular chunked transfer."""
+    transfer_id = uuid.uuid4()
+    try:
+        with MEDIA_STORE.open(digest) as f:
+            await send_wait(websocket, {
+                "type": "image_start",
+                "id": transfer_id.hex,
+                "user": user,
+                "filename": filename,
+                "size": MEDIA_STORE.size_of(digest)
+            })
+            seq = 0
+            for chunk in iter(lambda: f.read(config.IMAGE_CHUNK_SIZE), b""):
+                await send_wait(websocket, pack_chunk(transfer_id.bytes, seq, chunk), binary=True)
+                seq += 1
+        await send_wait(websocket, {
+            "type": "image_end",
+            "id": transfer_id.hex,
+            "chunks": seq,
+            "sha256": digest
+        })
+    except (OSError, KeyError) as e:
+        log.error("[MEDIA] Failed to stream %s: %s", digest, e)
+
+
+async def stream_history(websocket, room, limit, since=0, until=None, replay=False):
+    """Send the recent messages of a room to one client, one page per event.
+
+    A replay goes ahead of the live events held back by ``replay_history``
+    and releases them once queued.
+    """
+    try:
+        pages = HISTORY.pages(room, limit, since, until)
+        page = await anext(pages, None)
+        if page is None and not replay:
+            await send_wait(websocket, {"type": "history", "room": room, "messages": [], "more": False})
+        while page is not None:
+            following = await anext(pages, None)
+            await send_wait(websocket, {
+                "type": "history",
+                "room": room,
+                "messages": page,
+                "more": following is not None,
+                "replay": replay
+            }, early=replay)
+            page = following
+    finally:
+        if replay:
+            await release_outbox(websocket)
+
+
+def replay_history(websocket, room):
+    """Catch a client up on a room it just entered."""
+    if config.HISTORY_REPLAY_COUNT > 0:
+        # Bound the replay now: anything sent from here on reaches the client
+        # live, after the replay
+        now = time.time()
+        hold_outbox(websocket)
+        asyncio.create_task(stream_history(
+            websocket, room, config.HISTORY_REPLAY_COUNT,
+            since=now - config.HISTORY_REPLAY_MAX_AGE, until=now, replay=True
+        ))
+
+
+async def search_history(websocket, request):
+    """Answer a /search request from the history index."""
+    terms = request.get('terms') or []
+    try:
+        within = float(request.get('within') or 0)
+        older_than = float(request.get('older_than') or 0)
+    except (TypeError, ValueError):
+        within = older_than = 0
+    now = time.time()
+    start = time.perf_counter()
+    try:
+        results = await HISTORY.search(
+            [str(term) for term in terms if isinstance(term, str)],
+            user=request.get('from'),
+            room=request.get('room'),
+            since=now - within if within > 0 else 0,
+            until=now - older_than if older_than > 0 else None
+        )
+    except sqlite3.Error as e:
+        log.error("[SEARCH] Query failed: %s", e)
+        results = []
+    await send_wait(websocket, {
+        "type": "search_results",
+        "query": " ".join(str(term) for term in terms),
+        "results": results,
+        "took_ms": (time.perf_counter() - start) * 1000
+    })
+
+
+async def incoming(websocket):
+    """Frames received on a connection, with batch frames split into their events.
+
+    The handler processes each event before asking for the next one, so the
+    time until it does is its handling time.
+    """
+    packed = protocol.is_packed(websocket.subprotocol)
+    async for message in websocket:
+        metrics.BYTES_RECEIVED.inc(amount=len(message))
+        binary = isinstance(message, bytes)
+        for event in [message] if binary else batching.split(message):
+            if binary:
+                # A packed event, or else an image chunk
+                event_type = (packed and protocol.packed_type(event)) or "image_chunk"
+            else:
+                event_type = metrics.event_type(event)
+            metrics.EVENTS_RECEIVED.inc(event_type)
+            start = time.perf_counter()
+            yield event
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, event_type)
+
+
+def server_stats():
+    """The ``server_stats`` reply to the stats command."""
+    depths = queue_depths()
+    return {
+        "type": "server_stats",
+        "worker": CLUSTER.worker_id,
+        "uptime": time.time() - STARTED,
+        **metrics.snapshot(),
+        "throttled": ratelimit.report(),
+        "deepest_queues": sorted(((name, depth) for (name,), depth in depths.items()), key=lambda item: -item[1])[:5],
+    }
+
+
+async def report_rates():
+    """Log how many events each frame carries, to tune the batch window, and what was throttled."""
+    throttled = 0
+    while True:
+        await asyncio.sleep(config.BATCH_STATS_INTERVAL)
+        if METER.events:
+            log.info("[BATCH] Sent %s", METER.report())
+        if THROTTLED.total() != throttled:
+            throttled = THROTTLED.total()
+            log.info("[RATE] Throttled %s", ratelimit.report())
+
+
+async def over_limit(websocket, limiter, kind, amount=1):
+    """Apply the rate limit of ``kind`` to an event from ``websocket``.
+
+    Returns:
+        bool: True if the event must be dropped.
+    """
+    wait = limiter.take(kind, amount)
+    if not wait:
+        return False
+    action = ratelimit.action_for(kind)
+    THROTTLED[kind, action] += 1
+    if action == ratelimit.DELAY:
+        # Not reading meanwhile pushes back on the client
+        while 0 < wait <= config.RATE_LIMIT_MAX_DELAY:
+            await asyncio.sleep(wait)
+            wait = limiter.take(kind, amount)
+        if not wait:
+            return False
+        THROTTLED[kind, ratelimit.DROP] += 1
+    elif action == ratelimit.DISCONNECT:
+        log.warning("[RATE] Disconnecting %s: too many %s events", websocket.remote_address, kind)
+        # A flooding client doesn't get to resume its session
+        SESSIONS.end(websocket)
+        asyncio.create_task(websocket.close(1008, "rate limit exceeded"))
+        return True
+    if limiter.notify():
+        send(websocket, {"type": "notification", "action": f"Slow down: too many {kind} events, some were dropped"})
+    return True
+
+
+class Peer:
+    """A client connection and the state its events are handled with."""
+
+    __slots__ = ("websocket", "packed", "user_name", "transfers", "codecs", "limiter")
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.packed = protocol.is_packed(websocket.subprotocol)
+        self.user_name = None
+        self.transfers = {}  # image transfers started by this connection: id -> MediaWriter
+        self.codecs = {}     # transfers uploaded with compressed chunks: id -> codec
+        self.limiter = RateLimiter()
+
+    @property
+    def room(self):
+        return REGISTRY.room_of(self.websocket)
+
+    def is_chunk(self, frame):
+        """Binary frames are image chunks, except packed events on chat.msgpack connections."""
+        return not self.packed or frame[:CHUNK_ID_SIZE] in self.transfers
+
+
+async def reject(error, peer, message, data):
+    send(peer.websocket, {"type": "notification", "action": f"Invalid event: {error}"})
+
+
+# Handlers take (peer, raw message, decoded event); the raw message is what gets relayed
+EVENTS = Dispatcher("events", observe=metrics.DISPATCH_SECONDS.observe, on_invalid=reject)
+COMMANDS = Dispatcher("commands", observe=metrics.DISPATCH_SECONDS.observe, on_invalid=reject)
+
+
+@EVENTS.fallback
+async def relay(peer, message, data):
+    """Broadcast to everyone in the sender's room."""
+    CLUSTER.broadcast(message, room=peer.room)
+
+
+@EVENTS.on("message")
+async def on_message(peer, message, data):
+    # Chat message: log it, then broadcast it
+    if peer.user_name is not None:
+        HISTORY.append(peer.room, peer.user_name, str(data.get('text', '')))
+    CLUSTER.broadcast(message, room=peer.room)
+
+
+@EVENTS.on("command", schema={"name": str})
+async def on_command(peer, message, data):
+    await COMMANDS.dispatch(data['name'], peer, message, data)
+
+
+@COMMANDS.fallback
+async def relay_command(peer, message, data):
+    CLUSTER.broadcast(message, room=peer.room)
+
+
+@COMMANDS.on("quit")
+async def on_quit(peer, message, data):
+    # Let the room see the goodbye too
+    SESSIONS.end(peer.websocket)
+    CLUSTER.broadcast(message, room=peer.room)
+
+
+@COMMANDS.on("users")
+async def on_users(peer, message, data):
+    online_users = REGISTRY.user_list()
+    send(peer.websocket, {
+        "type": "user_list",
+        "users": online_users,
+        "count": len(online_users)
+    })
+
+
+@COMMANDS.on("stats")
+async def on_stats(peer, message, data):
+    send(peer.websocket, server_stats())
+
+
+@COMMANDS.on("join", "leave")
+async def on_join(peer, message, data):
+    websocket = peer.websocket
+    room = data.get('room') if data['name'] == 'join' else DEFAULT_ROOM
+    if not isinstance(room, str) or not room or len(room) > 32:
+        send(websocket, {"type": "notification", "action": "Invalid room name"})
+        return
+    previous = REGISTRY.move(websocket, room)
+    if previous is None:
+        return
+    if previous != room:
+        CLUSTER.announce_room(peer.user_name, room)
+        CLUSTER.broadcast({
+            "type": "notification",
+            "user": peer.user_name,
+            "action": "left the room"
+        }, exclude=(websocket,), room=previous)
+        CLUSTER.broadcast({
+            "type": "notification",
+            "user": peer.user_name,
+            "action": "joined the room"
+        }, exclude=(websocket,), room=room)
+    send(websocket, {
+        "type": "room_joined",
+        "room": room,
+        "count": REGISTRY.room_counts().get(room, 0)
+    })
+    if previous != room:
+        replay_history(websocket, room)
+
+
+@COMMANDS.on("history")
+async def on_history(peer, message, data):
+    if REGISTRY.get(peer.websocket) is None:
+        return
+    try:
+        limit = int(data.get('limit') or config.HISTORY_PAGE_SIZE)
+        within = float(data.get('within') or 0)
+    except (TypeError, ValueError):
+        send(peer.websocket, {"type": "notification", "action": "Invalid history request"})
+        return
+    limit = max(1, min(limit, config.HISTORY_MAX_MESSAGES))
+    since = time.time() - within if within > 0 else 0
+    if within > 0 and not data.get('limit'):
+        limit = config.HISTORY_MAX_MESSAGES
+    asyncio.create_task(stream_history(peer.websocket, peer.room, limit, since))
+
+
+@COMMANDS.on("rooms")
+async def on_rooms(peer, message, data):
+    send(peer.websocket, {
+        "type": "room_list",
+        "rooms": [{"name": name, "count": count} for name, count in REGISTRY.room_counts().items()],
+        "current": peer.room
+    })
+
+
+@COMMANDS.on("search")
+async def on_search(peer, message, data):
+    asyncio.create_task(search_history(peer.websocket, data))
+
+
+@EVENTS.on("whisper", schema={"to": str, "message": str})
+async def on_whisper(peer, message, data):
+    if peer.user_name is None:
+        return
+    to_user = data['to']
+    text = data['message']
+
+    # Send to target user, on whichever worker it is connected
+    if CLUSTER.deliver(to_user, {
+        "type": "whisper_received",
+        "from": peer.user_name,
+        "message": text
+    }):
+        # Send confirmation to sender
+        send(peer.websocket, {
+            "type": "whisper_sent",
+            "to": to_user,
+            "message": text
+        })
+    else:
+        # User not found
+        log.info("[WHISPER] User '%s' not found", to_user)
+        send(peer.websocket, {
+            "type": "whisper_error",
+            "message": f"User '{to_user}' not found or offline."
+        })
+
+
+@EVENTS.on("atack", schema={"to": str, "atack": str})
+async def on_atack(peer, message, data):
+    if peer.user_name is None:
+        return
+    # The result reaches the attacker with the next battle event
+    error = BATTLE.attack(peer.user_name, data['to'], data['atack'])
+    if error is not None:
+        send(peer.websocket, {"type": "atack_error", "message": error})
+
+
+@EVENTS.on("image_start", schema={"id": str, "size": int})
+async def on_image_start(peer, message, data):
+    try:
+        transfer_id = uuid.UUID(hex=data['id']).bytes
+    except ValueError:
+        return
+    if data['size'] > config.IMAGE_MAX_SIZE:
+        send(peer.websocket, {
+            "type": "notification",
+            "action": f"Image rejected: larger than {config.IMAGE_MAX_SIZE} bytes"
+        })
+        return
+    codec = data.get('codec')
+    if codec and codec not in compression.media_codecs():
+        send(peer.websocket, {"type": "notification", "action": f"Image rejected: unsupported codec {codec}"})
+        return
+    peer.transfers[transfer_id] = MEDIA_STORE.begin()
+    if codec:
+        peer.codecs[transfer_id] = codec
+        data = {key: value for key, value in data.items() if key != 'codec'}
+    await CLUSTER.broadcast_wait(data if codec else message, exclude=(peer.websocket,), room=peer.room)
+
+
+@EVENTS.on("image_end", schema={"id": str})
+async def on_image_end(peer, message, data):
+    try:
+        transfer_id = uuid.UUID(hex=data['id']).bytes
+    except ValueError:
+        return
+    writer = peer.transfers.pop(transfer_id, None)
+    peer.codecs.pop(transfer_id, None)
+    if writer is not None:
+        await CLUSTER.broadcast_wait(message, exclude=(peer.websocket,), room=peer.room)
+        writer.commit(data.get('sha256'))
+
+
+@EVENTS.on("media_offer", schema={"sha256": str})
+async def on_media_offer(peer, message, data):
+    # Client asks whether the server already has an image before uploading it
+    digest = data['sha256']
+    if is_digest(digest) and MEDIA_STORE.has(digest):
+        send(peer.websocket, {"type": "media_have", "sha256": digest})
+        CLUSTER.broadcast({
+            "type": "image_ref",
+            "user": data.get('user'),
+            "filename": data.get('filename'),
+            "size": MEDIA_STORE.size_of(digest),
+            "sha256": digest
+        }, exclude=(peer.websocket,), room=peer.room)
+    else:
+        send(peer.websocket, {"type": "media_need", "sha256": digest})
+
+
+@EVENTS.on("media_fetch", schema={"sha256": str})
+async def on_media_fetch(peer, message, data):
+    # Client could not resolve an image_ref locally
+    digest = data['sha256']
+    if is_digest(digest) and MEDIA_STORE.has(digest):
+        asyncio.create_task(stream_media(peer.websocket, digest, data.get('poster'), data.get('filename')))
+    else:
+        send(peer.websocket, {
+            "type": "notification",
+            "action": "Image is no longer available on the server"
+        })
+
+
+async def resume(peer, data):
+    """Reconnecting client picking up its session where it left off."""
+    session = await SESSIONS.resume(data.get('token'), peer.websocket, data.get('last_seq'))
+    if session is None:
+        send(peer.websocket, {"type": "resume_failed"})
+    else:
+        peer.user_name = session['name']
+        log.info("User '%s' resumed its session.", peer.user_name)
+
+
+def register(peer, data):
+    """Store the username on the first event that carries one.
+
+    Returns:
+        bool: False if the name is taken and the event must be dropped.
+    """
+    websocket = peer.websocket
+    requested_name = data.get('user') or data.get('from')
+    if REGISTRY.get(websocket) is not None or not requested_name:
+        return True
+    session = REGISTRY.register(websocket, requested_name)
+    if session is None:
+        send(websocket, {
+            "type": "notification",
+            "action": f"Name '{requested_name}' is already taken. Reconnect with another name"
+        })
+        return False
+    peer.user_name = requested_name
+    CLUSTER.announce_join(session)
+    SESSIONS.create(websocket)
+    replay_history(websocket, session['room'])
+    log.info("User '%s' registered. Total users: %d", peer.user_name, REGISTRY.total)
+    return True
+
+
+async def relay_chunk(peer, message):
+    """Relay an image chunk right away if this connection owns the transfer."""
+    try:
+        transfer_id, seq, payload = unpack_chunk(message)
+    except TransferError:
+        return
+    writer = peer.transfers.get(transfer_id)
+    if writer is None:
+        return
+    if transfer_id in peer.codecs:
+        # Uploaded compressed: store and relay it decoded, receivers may lack the codec
+        try:
+            payload = compression.decompress_chunk(payload, peer.codecs[transfer_id], config.IMAGE_CHUNK_SIZE)
+        except ValueError:
+            return
+        message = pack_chunk(transfer_id, seq, payload)
+    if await over_limit(peer.websocket, peer.limiter, "image", len(payload)):
+        # A transfer missing a chunk can't complete: abort it for everyone
+        peer.transfers.pop(transfer_id).discard()
+        peer.codecs.pop(transfer_id, None)
+        await CLUSTER.broadcast_wait({"type": "image_abort", "id": transfer_id.hex()}, exclude=(peer.websocket,),
+                                     room=peer.room)
+        return
+    if writer.received + len(payload) <= config.IMAGE_MAX_SIZE:
+        await CLUSTER.broadcast_wait(message, exclude=(peer.websocket,), binary=True, room=peer.room)
+        # Keep a copy so later posts of the same image are deduplicated
+        writer.write(payload)
 
-USERS = {}
 
 async def handler(websocket):
-    user_name = None
-    USERS[websocket] = None
+    peer = Peer(websocket)
+    limiter = peer.limiter
+    REGISTRY.connect(websocket)
+    open_outbox(websocket)
 
     try:
-        async for message in websocket:
-            print(f"Received: {message}")
-            
+        async for message in incoming(websocket):
+            packed = isinstance(message, bytes)
+            if packed and peer.is_chunk(message):
+                await relay_chunk(peer, message)
+                continue
+
+            log.debug("Received: %s", message)
+            if await over_limit(websocket, limiter, "total"):
+                continue
+
             try:
-                data = json.loads(message)
-                
-                # Store username on first message
-                if USERS[websocket] is None and data.get('user'):
-                    user_name = data.get('user')
-                    user_life = 100
-                    USERS[websocket] = {'name': user_name, 'life': user_life}
-                    print(f"User '{user_name}' registered. Total users: {len([u for u in USERS.values() if u])}")
-                
-                # Handle users command
-                if data.get('type') == 'command' and data.get('name') == 'users':
-                    online_users = [name for name in USERS.values() if name]
-                    response = json.dumps({
-                        "type": "user_list",
-                        "users": online_users,
-                        "count": len(online_users)
-                    })
-                    await websocket.send(response)
-                    continue
-                
-                # Handle whisper command
-                elif data.get('type') == 'whisper':
-                    from_user = data.get('from')
-                    to_user = data.get('to')
-                    message = data.get('message')
-                    
-                    
-                    # Find target user's websocket
-                    target_ws = None
-                    for ws, user in USERS.items():
-                        if user["name"] == to_user:
-                            target_ws = ws
-                            break
-                    await websocket.send({"type": "debug", "message": f"Target WS: {target_ws}, To User: {to_user}, From User: {from_user}"})
-                    if target_ws:
-                        # Send to target user
-                        whisper_msg = json.dumps({
-                            "type": "whisper_received",
-                            "from": from_user,
-                            "message": message
-                        })
-                        await target_ws.send(whisper_msg)
-                        
-                        # Send confirmation to sender
-                        confirmation = json.dumps({
-                            "type": "whisper_sent",
-                            "to": to_user,
-                            "message": message
-                        })
-                        
-                        await websocket.send(confirmation)
-                    else:
-                        # User not found
-                        print(f"[WHISPER] User '{to_user}' not found")
-                        error_msg = json.dumps({
-                            "type": "whisper_error",
-                            "message": f"User '{to_user}' not found or offline."
-                        })
-                        await websocket.send(error_msg)
-                    continue
-                
-                elif data.get('type') == 'atack':
-                    from_user = data.get('from')
-                    to_user = data.get('to')
-                    atack = data.get('atack')
-                    
-                    # Find target user's websocket
-                    target_ws = None
-                    for ws, user in USERS.items():
-                        if user["name"] == to_user:
-                            target_ws = ws
-                            break
-                    
-                    if target_ws:
-                        # Send atack to target user
-                        atack_msg = json.dumps({
-                            "type": "atack_received",
-                            "from": from_user,
-                            "atack": atack
-                        })
-                        await target_ws.send(atack_msg)
-
-                        # Send confirmation to sender
-                        confirmation = json.dumps({
-                            "type": "atack_sent",
-                            "to": to_user,
-                            "atack": atack
-                        })
-
-                        await websocket.send(confirmation)
-
-                        if USERS[target_ws]['life'] > 0:
-                            USERS[target_ws]['life'] -= config.ATACKS.get(atack, 0)
-                            if USERS[target_ws]['life'] < 0:
-                                USERS[target_ws]['life'] = 0
-
-                            # Broadcast death notification to all users except the defeated user
-                            if USERS[target_ws]['life'] == 0:
-                                death_broadcast = json.dumps({
-                                    "type": "notification",
-                                    "action": "has been defeated",
-                                    "user": to_user
-                                })
-                                for ws in USERS.keys():
-                                    if ws != target_ws:
-                                        await ws.send(death_broadcast)
-
-                                death_message = json.dumps({
-                                    "type": "notification",
-                                    "action": f"You have been defeated by {from_user}. Better luck next time!"
-                                })
-                                await target_ws.send(death_message)
-
-                        life_update = json.dumps({
-                            "type": "life_update",
-                            "life": USERS[target_ws]['life']
-                        })
-                        await target_ws.send(life_update)
-
-                        # Notify other users
-                        for ws, username in USERS.items():
-                            if ws != websocket and ws != target_ws:
-                                spectator_msg = json.dumps({
-                                    "type": "atack_notification",
-                                    "message": f"{from_user} attacked {to_user} with {atack}."
-                                })
-                                await ws.send(spectator_msg)
-                    else:
-                        # User not found
-                        print(f"[ATACK] User '{to_user}' not found")
-                        error_msg = json.dumps({
-                            "type": "atack_error",
-                            "message": f"User '{to_user}' not found or offline."
-                        })
-                        await websocket.send(error_msg)
-                    continue
-
-            except json.JSONDecodeError:
-                pass  # Not JSON, treat as regular message
-            
-            # Broadcast to all users
-            recipients = [ws for ws in USERS.keys()] 
-
-            if recipients:
-                send_tasks = [ws.send(message) for ws in recipients]
-                await asyncio.gather(*send_tasks, return_exceptions=True)
-                
+                data = protocol.unpack(message) if packed else serialization.decode(message)
+            except protocol.DecodeError:
+                continue
+            except serialization.DecodeError:
+                # Not JSON, treat as regular message
+                if not await over_limit(websocket, limiter, "message"):
+                    CLUSTER.broadcast(message, room=peer.room)
+                continue
+            if not isinstance(data, dict):
+                continue
+            if packed:
+                # Relays are encoded again for each protocol
+                message = data
+
+            event_type = data.get('type')
+            if not isinstance(event_type, str):
+                event_type = None
+            kind = ratelimit.EVENT_KINDS.get(event_type)
+            if kind is not None and await over_limit(websocket, limiter, kind):
+                continue
+
+            if event_type == 'resume':
+                if REGISTRY.get(websocket) is None:
+                    await resume(peer, data)
+                continue
+            if not register(peer, data):
+                continue
+
+            await EVENTS.dispatch(event_type, peer, message, data)
+
     except websockets.exceptions.ConnectionClosedOK:
-        print(f"Connection closed normally.")
+        log.debug("Connection closed normally.")
+    except websockets.exceptions.ConnectionClosed as e:
+        # A dropped network connection, not a server fault
+        log.info("Connection lost: %s", e)
     except Exception as e:
-        print(f"Handler error: {e}")
-        
+        log.error("Handler error: %s", e)
+
     finally:
-        if websocket in USERS:
-            disconnected_user = USERS[websocket]
-            del USERS[websocket]
-            print(f"User '{disconnected_user}' disconnected. Total users: {len([u for u in USERS.values() if u])}")
+        # Let receivers drop the buffers of transfers that will never finish
+        for transfer_id, writer in peer.transfers.items():
+            writer.discard()
+            await CLUSTER.broadcast_wait({"type": "image_abort", "id": transfer_id.hex()}, exclude=(websocket,),
+                                         room=peer.room)
+        if websocket.close_code == 1000 and websocket.protocol.close_rcvd_then_sent:
+            # The client closed cleanly (e.g. EOF without /quit): it won't resume
+            SESSIONS.end(websocket)
+        if SESSIONS.detach(websocket):
+            log.info("User '%s' lost its connection, keeping the session for %ss.",
+                     peer.user_name, config.SESSION_RESUME_TIMEOUT)
+        elif websocket in REGISTRY:
+            end_session(websocket)
+        else:
+            close_outbox(websocket)
+
 
-async def main():
-    async with websockets.serve(handler, "localhost", 8765):
-        await asyncio.Future()
+async def main(worker_id=0, workers=1):
+    setup_logging()
+    CLUSTER.worker_id = worker_id
+    CLUSTER.backend = make_backend(workers)
+    await CLUSTER.start()
+    HISTORY.start()
+    if config.BATCH_STATS_INTERVAL > 0:
+        asyncio.create_task(report_rates())
+    asyncio.create_task(metrics.watch_loop_lag())
+    asyncio.create_task(BATTLE.run())
+    endpoint = await metrics.serve(config.METRICS_PORT + worker_id) if config.METRICS_PORT else None
+
+    # Workers share the port; the kernel spreads connections between them
+    try:
+        async with websockets.serve(handler, config.SERVER_HOST, config.SERVER_PORT, reuse_port=workers > 1,
+                                    compression=None, extensions=compression.server_extensions(),
+                                    subprotocols=protocol.available(), select_subprotocol=protocol.select):
+            await asyncio.Future()
+    finally:
+        if endpoint is not None:
+            endpoint.close()
+        # Write the messages still waiting for the next batch
+        await HISTORY.close()
+
+def run_worker(worker_id, workers):
+    try:
+        asyncio.run(main(worker_id, workers))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='WebSocket Chat Server')
+    parser.add_argument('--host', type=str, default=config.SERVER_HOST, help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=config.SERVER_PORT, help='Port to listen on')
+    parser.add_argument('--workers', '-w', type=int, default=config.SERVER_WORKERS, help='Number of worker processes')
+    parser.add_argument('--batch-ms', type=float, default=config.BATCH_WINDOW_MS,
+                        help='Coalesce outgoing events queued within this window into one frame (0: off)')
+    parser.add_argument('--compression', choices=['on', 'off'], default='on' if config.COMPRESSION else 'off',
+                        help='Negotiate permessage-deflate with clients')
+    parser.add_argument('--compression-threshold', type=int, default=config.COMPRESSION_THRESHOLD,
+                        help='Only compress text messages of at least this many bytes')
+    parser.add_argument('--window-bits', type=int, choices=range(9, 16), default=config.COMPRESSION_WINDOW_BITS,
+                        metavar='9-15', help='Deflate window size (memory per connection vs ratio)')
+    parser.add_argument('--mem-level', type=int, choices=range(1, 10), default=config.COMPRESSION_MEM_LEVEL,
+                        metavar='1-9', help='zlib memory level of the compressor')
+    parser.add_argument('--protocols', type=lambda value: value.split(','), default=config.WIRE_PROTOCOLS,
+                        metavar='json,msgpack', help='Wire protocols accepted')
+    parser.add_argument('--log-level', choices=LEVELS, default=config.LOG_LEVEL,
+                        help='Server log level ("debug" logs every received event)')
+    parser.add_argument('--metrics-port', type=int, default=config.METRICS_PORT,
+                        help='Port of the Prometheus metrics endpoint (0: off)')
+    args = parser.parse_args()
+    config.SERVER_HOST = args.host
+    config.SERVER_PORT = args.port
+    config.BATCH_WINDOW_MS = args.batch_ms
+    config.COMPRESSION = args.compression == 'on'
+    config.WIRE_PROTOCOLS = args.protocols
+    config.LOG_LEVEL = args.log_level
+    config.METRICS_PORT = args.metrics_port
+    config.COMPRESSION_THRESHOLD = args.compression_threshold
+    config.COMPRESSION_WINDOW_BITS = args.window_bits
+    config.COMPRESSION_MEM_LEVEL = args.mem_level
+
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            setup_logging()
+            log.info("Starting %d workers on %s:%d", args.workers, args.host, args.port)
+            run_cluster(functools.partial(run_worker, workers=args.workers), args.workers)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("Server stopped.")
\ No newline at end of file
+        log.info("Server stopped.")
@@ -0,0 +1,87 @@
+"""Nagle-style coalescing of small events into "batch" frames.
+
+With ``config.BATCH_WINDOW_MS`` above zero, events queued within that
+window go out as one text frame::
+
+    {"type": "batch", "events": [{...}, {...}]}
+
+Receivers unpack the events and handle them in order. Events are already
+encoded JSON objects, so packing a batch is a byte join, never a
+re-encode. Binary frames and non-JSON text are never batched and flush
+whatever was pending before them, so ordering is preserved.
+"""
+import json
+import time
+
+from src.core import config
+
+BATCH_TYPE = "batch"
+_BATCH_START = b'{"type":"batch","events":['
+_BATCH_END = b']}'
+
+
+def batchable(payload, text=True):
+    """True if an encoded payload can go inside a batch frame."""
+    return text and payload[:1] in (b"{", "{")
+
+
+def pack(payloads):
+    """Join encoded JSON objects (bytes) into one batch frame."""
+    return _BATCH_START + b",".join(payloads) + _BATCH_END
+
+
+def unpack(data):
+    """The events carried by a decoded frame: its own list for a batch, else itself."""
+    if isinstance(data, dict) and data.get("type") == BATCH_TYPE:
+        events = data.get("events")
+        return events if isinstance(events, list) else []
+    return [data]
+
+
+def split(payload, text=True):
+    """Encoded events (str) of a received text frame, unpacking batches.
+
+    Returns ``[payload]`` unchanged for anything that isn't a batch.
+    """
+    if not text or BATCH_TYPE not in payload[:32]:
+        return [payload]
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return [payload]
+    if not isinstance(data, dict) or data.get("type") != BATCH_TYPE:
+        return [payload]
+    return [json.dumps(event) for event in unpack(data)]
+
+
+class RateMeter:
+    """Frames and events sent, to tune the batch window."""
+
+    def __init__(self):
+        self.frames = 0
+        self.events = 0
+        self.last_frames = 0
+        self.last_events = 0
+        self.last_time = time.monotonic()
+
+    def add(self, frames, events):
+        self.frames += frames
+        self.events += events
+
+    def rates(self):
+        """(frames/s, events/s) since the previous call."""
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        rates = ((self.frames - self.last_frames) / elapsed, (self.events - self.last_events) / elapsed)
+        self.last_frames, self.last_events, self.last_time = self.frames, self.events, now
+        return rates
+
+    def report(self):
+        frames, events = self.rates()
+        per_frame = events / frames if frames else 0
+        return f"{events:.0f} events/s in {frames:.0f} frames/s ({per_frame:.1f} events per frame)"
+
+
+def window():
+    """The batch window in seconds, 0 when batching is off."""
+    return max(config.BATCH_WINDOW_MS, 0) / 1000
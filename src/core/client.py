@@ -1,15 +1,17 @@
 import asyncio
-import websockets
-import json
+from websockets.exceptions import ConnectionClosed
 from prompt_toolkit import PromptSession
 from prompt_toolkit.patch_stdout import patch_stdout
 from dotenv import set_key
 
+from src.core import config
+from src.core.connection import Connection
+from src.utils.sound import preload_notification_sound
 from src.handlers.message_handler import receive_messages
 from src.handlers.command_handler import process_command
 
 
-async def send_messages(websocket, user_name, session):
+async def send_messages(connection, user_name, session):
     while True:
         try:
             user_input = await session.prompt_async("> ")
@@ -19,7 +21,7 @@ async def send_messages(websocket, user_name, session):
                 continue
                 
             if user_input.startswith('/'):
-                should_exit = await process_command(websocket, user_name, user_input)
+                should_exit = await process_command(connection, user_name, user_input)
                 if should_exit:
                     break
             else:
@@ -28,11 +30,13 @@ async def send_messages(websocket, user_name, session):
                     "user": user_name,
                     "text": user_input
                 }
-                await websocket.send(json.dumps(message_data))
+                await connection.send(message_data)
+        except ConnectionClosed:
+            print("\n[OFFLINE] Not connected, message not sent. Reconnecting...")
         except (EOFError, KeyboardInterrupt):
             break
             
-    await websocket.close()
+    await connection.close()
 
 
 async def connect_to_server():
@@ -43,25 +47,45 @@ async def connect_to_server():
         set_key(".env", "WEBSOCKET_URI", WEBSOCKET_URI)
 
         print(f"Connecting to server at {WEBSOCKET_URI}...")
-        async with websockets.connect(WEBSOCKET_URI) as websocket:
-            user_name = await session.prompt_async("Enter your name: ")
-            print(f"\nWelcome, {user_name}! Type a message or use commands. Type /help for assistance.\n")
+        connection = Connection(WEBSOCKET_URI)
+        await connection.connect()
+        user_name = await session.prompt_async("Enter your name: ")
+        # Open the audio device and decode the chime while the user starts typing
+        preload_notification_sound(config.NOTIFICATION_SOUND)
+        print(f"\nWelcome, {user_name}! Type a message or use commands. Type /help for assistance.\n")
 
-            # Use patch_stdout to prevent output from interfering with input
-            with patch_stdout():
-                send_task = asyncio.create_task(send_messages(websocket, user_name, session))
-                receive_task = asyncio.create_task(receive_messages(websocket, user_name))
-                
+        # Use patch_stdout to prevent output from interfering with input
+        with patch_stdout():
+            send_task = asyncio.create_task(send_messages(connection, user_name, session))
+            while True:
+                receive_task = asyncio.create_task(receive_messages(connection.websocket, user_name, connection))
                 await asyncio.wait(
                     [send_task, receive_task],
                     return_when=asyncio.FIRST_COMPLETED,
                 )
-                
-                if not send_task.done():
-                    send_task.cancel()
-                if not receive_task.done():
-                    receive_task.cancel()
-            
+                if send_task.done() or connection.closing:
+                    break
+
+                # Connection lost: keep the prompt and reconnect in the background
+                print("\n[DISCONNECTED] Lost connection to the server, reconnecting...")
+                reconnect_task = asyncio.create_task(connection.reconnect())
+                await asyncio.wait(
+                    [send_task, reconnect_task],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not reconnect_task.done():
+                    reconnect_task.cancel()
+                    break
+                if not reconnect_task.result():
+                    print("\n[ERROR] Could not reconnect to the server.")
+                    break
+
+            if not send_task.done():
+                send_task.cancel()
+            if not receive_task.done():
+                receive_task.cancel()
+            await connection.close()
+
     except ConnectionRefusedError:
         print(f"\n[ERROR] Connection refused. Make sure the server is running at {WEBSOCKET_URI}.")
     except Exception as e:
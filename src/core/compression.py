@@ -0,0 +1,144 @@
+"""What gets compressed on the wire, and how.
+
+Both sides negotiate permessage-deflate (RFC 7692) with the window size and
+memory level from the config, but only messages that are worth it are
+actually compressed:
+
+* Text frames shorter than ``config.COMPRESSION_THRESHOLD`` bytes go out as
+  is. A chat line saves a few bytes at best and costs a compressor call.
+  RFC 7692 lets each message choose, so the receiver simply sees a frame
+  without the RSV1 bit.
+* Binary frames (image chunks) are left alone unless
+  ``config.COMPRESSION_BINARY`` is set: uploads are JPEG or PNG and barely
+  shrink, while deflate on 64 KiB chunks is the most expensive thing the
+  connection would do.
+
+Image uploads can use zstd instead (``config.MEDIA_CHUNK_CODEC = "zstd"``),
+which pays off for uncompressed originals sent with ``/image --original``.
+It needs the ``zstandard`` package on both ends. The server lists the codecs
+it accepts in the ``session`` event, the sender announces the codec in
+``image_start``, and the server decompresses the chunks before storing and
+relaying them, so receivers never need zstd themselves.
+"""
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory, PerMessageDeflate, ServerPerMessageDeflateFactory
+)
+from websockets.frames import Opcode
+
+from src.core import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class SelectiveDeflate(PerMessageDeflate):
+    """permessage-deflate that only compresses messages over the threshold."""
+
+    def __init__(self, *args, threshold=0, binary=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.binary = binary
+
+    def encode(self, frame):
+        # Messages are sent in one frame, so deciding per frame is per message
+        if frame.opcode is Opcode.TEXT and len(frame.data) < self.threshold:
+            return frame
+        if frame.opcode is Opcode.BINARY and not self.binary:
+            return frame
+        return super().encode(frame)
+
+
+def _selective(extension):
+    """The same negotiated parameters, with the compression policy from the config."""
+    return SelectiveDeflate(
+        extension.remote_no_context_takeover,
+        extension.local_no_context_takeover,
+        extension.remote_max_window_bits,
+        extension.local_max_window_bits,
+        extension.compress_settings,
+        threshold=config.COMPRESSION_THRESHOLD,
+        binary=config.COMPRESSION_BINARY,
+    )
+
+
+class ServerDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super().process_request_params(params, accepted_extensions)
+        return response, _selective(extension)
+
+
+class ClientDeflateFactory(ClientPerMessageDeflateFactory):
+    def process_response_params(self, params, accepted_extensions):
+        return _selective(super().process_response_params(params, accepted_extensions))
+
+
+def _compress_settings():
+    return {"memLevel": config.COMPRESSION_MEM_LEVEL, "level": config.COMPRESSION_LEVEL}
+
+
+def server_extensions():
+    """``extensions`` for ``websockets.serve``: [] when compression is off."""
+    if not config.COMPRESSION:
+        return []
+    return [ServerDeflateFactory(
+        server_max_window_bits=config.COMPRESSION_WINDOW_BITS,
+        client_max_window_bits=config.COMPRESSION_WINDOW_BITS,
+        compress_settings=_compress_settings(),
+    )]
+
+
+def client_extensions():
+    """``extensions`` for ``websockets.connect``: [] when compression is off."""
+    if not config.COMPRESSION:
+        return []
+    return [ClientDeflateFactory(
+        client_max_window_bits=config.COMPRESSION_WINDOW_BITS,
+        compress_settings=_compress_settings(),
+    )]
+
+
+# Image chunk codecs
+
+def media_codecs():
+    """Chunk codecs this side can decode, as advertised in the ``session`` event."""
+    return ["zstd"] if zstandard is not None else []
+
+
+def upload_codec(accepted):
+    """The codec to upload images with, given the codecs the server accepts.
+
+    Returns:
+        str: The configured codec, or None if either side can't use it.
+    """
+    codec = config.MEDIA_CHUNK_CODEC
+    if codec == "zstd" and zstandard is not None and codec in (accepted or ()):
+        return codec
+    return None
+
+
+def compress_chunk(payload, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=config.MEDIA_ZSTD_LEVEL).compress(payload)
+    return payload
+
+
+def decompress_chunk(payload, codec, max_size):
+    """Decode a chunk payload, refusing anything that expands past ``max_size``.
+
+    Raises:
+        ValueError: The codec is unknown or the payload is invalid or too large.
+    """
+    if not codec:
+        return payload
+    if codec != "zstd" or zstandard is None:
+        raise ValueError(f"Unsupported chunk codec {codec!r}")
+    payload = bytes(payload)
+    try:
+        # The size declared in the frame header wins over max_output_size
+        declared = zstandard.frame_content_size(payload)
+        if declared > max_size:
+            raise ValueError(f"zstd chunk expands to {declared} bytes")
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=max_size)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Invalid zstd chunk: {e}") from e
@@ -1,13 +1,19 @@
 COMMANDS = {
     "quit": "Exits the interactive terminal. Example: /quit",
     "help": "Displays this list of commands. Example: /help",
-    "image": "Sends and displays an image on all terminals. Usage: /image <path/to/file.png>",
+    "image": "Sends and displays an image on all terminals. Usage: /image [--original] [--mode full|half] [--colors truecolor|256|16] <path/to/file.png> (without a path, sets the defaults)",
     "sound": "Changes the notification sound. Usage: /sound <path/to/sound.wav> | /sound mute | /sound unmute",
     "users": "Lists all online users. Example: /users",
     "clear": "Clears messages for the current user. Example: /clear",
     "watch": "Opens a video URL in the default web browser. Usage: /watch <video_url>",
     "whisper": "Sends a private message to a specific user. Usage: /whisper <username> <message>",
     "atack": "Sends an atack command to a specific user. Usage: /atack <username> <atack>",
+    "join": "Joins a chat room; messages and images only reach its members. Usage: /join <room>",
+    "leave": "Leaves the current room and goes back to the lobby. Example: /leave",
+    "rooms": "Lists the rooms and how many users are in each. Example: /rooms",
+    "history": "Shows earlier messages of the current room: the last n, or those from the last 30m/2h/1d. Usage: /history [n|since]",
+    "search": "Searches the chat history, optionally by sender, room and age. Usage: /search <terms> [from:user] [in:room] [since:2h] [until:30m]",
+    "stats": "Shows events vs frames per second sent and received (rates since the last /stats) and the server's metrics. Example: /stats",
 }
 
 ATACKS = {
@@ -33,6 +39,157 @@ ATACKS = {
     "gravity_crush": 28
 }
 
+# Battles: atacks are resolved every BATTLE_TICK_MS and each room gets one
+# "battle" event per tick with all its hits, defeats and respawns. After an
+# atack, the attacker waits damage / BATTLE_DAMAGE_PER_SECOND seconds before
+# the next one; defeated users come back with full life after
+# BATTLE_RESPAWN_SECONDS.
+BATTLE_TICK_MS = 100
+BATTLE_DAMAGE_PER_SECOND = 20
+BATTLE_RESPAWN_SECONDS = 10
+
 NOTIFICATION_SOUND = None
 PREVIOUS_NOTIFICATION_SOUND = None
 IS_MUTED = False
+
+# At most one notification chime per SOUND_COALESCE_MS during a burst of
+# messages; terminal focus is checked at most every FOCUS_CACHE_SECONDS
+SOUND_COALESCE_MS = 500
+FOCUS_CACHE_SECONDS = 2
+
+# Server outbound queues: size per connection and what to do when one is full
+# ("drop_oldest", "drop_newest" or "disconnect").
+SEND_QUEUE_SIZE = 256
+SEND_QUEUE_OVERFLOW = "drop_oldest"
+
+# Chunked image transfer
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_MAX_SIZE = 20 * 1024 * 1024
+IMAGE_SPOOL_SIZE = 1024 * 1024  # received bytes kept in memory before spilling to disk
+MAX_INCOMING_TRANSFERS = 4
+
+# Images are downscaled to this (width, height) before upload unless
+# /image --original is used
+IMAGE_UPLOAD_MAX_SIZE = (320, 200)
+IMAGE_UPLOAD_QUALITY = 80
+
+# Terminal image rendering: "full" (one pixel per cell) or "half" (two pixels
+# per cell with the upper half block), and "truecolor", "256" or "16" colours
+RENDER_MODES = ("full", "half")
+COLOR_MODES = ("truecolor", "256", "16")
+IMAGE_RENDER_MODE = "half"
+IMAGE_COLOR_MODE = "truecolor"
+
+# Memory cap of the rendered image cache (bytes of ANSI output)
+RENDER_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Received images are rendered by this many worker processes; at most
+# MAX_PENDING_RENDERS wait to be drawn, older ones are skipped during bursts
+RENDER_WORKERS = 2
+MAX_PENDING_RENDERS = 4
+
+# Server media store (content-addressed uploads) and client cache of received
+# image bytes, both bounded by total size
+MEDIA_STORE_DIR = "media_store"
+MEDIA_STORE_MAX_BYTES = 512 * 1024 * 1024
+MEDIA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MEDIA_OFFER_TIMEOUT = 5
+
+# Server address and multi-worker mode. With more than one worker, workers
+# share the port (SO_REUSEPORT) and talk through CLUSTER_BACKEND ("unix":
+# broker on a unix socket at CLUSTER_SOCKET, default in the temp dir).
+SERVER_HOST = "localhost"
+SERVER_PORT = 8765
+SERVER_WORKERS = 1
+CLUSTER_BACKEND = "unix"
+CLUSTER_SOCKET = None
+
+# Server chat history (SQLite in WAL mode). Messages are written in batches
+# every HISTORY_FLUSH_INTERVAL seconds, or sooner once HISTORY_BATCH_SIZE are
+# pending. /history streams pages of HISTORY_PAGE_SIZE, and clients get the
+# last HISTORY_REPLAY_COUNT messages of their room (at most
+# HISTORY_REPLAY_MAX_AGE seconds old) when they join it.
+HISTORY_DB = "history.db"
+HISTORY_FLUSH_INTERVAL = 0.2
+HISTORY_BATCH_SIZE = 500
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_MESSAGES = 1000
+HISTORY_REPLAY_COUNT = 20
+HISTORY_REPLAY_MAX_AGE = 24 * 60 * 60
+
+# Most results returned by one /search
+SEARCH_MAX_RESULTS = 50
+
+# Resumable sessions: a dropped user keeps its name, life and room for
+# SESSION_RESUME_TIMEOUT seconds, and the last SESSION_BUFFER_FRAMES frames
+# (at most SESSION_BUFFER_BYTES) sent to it are replayed when it comes back
+SESSION_RESUME_TIMEOUT = 60
+SESSION_BUFFER_FRAMES = 500
+SESSION_BUFFER_BYTES = 4 * 1024 * 1024
+SESSION_HANDOFF_TIMEOUT = 2
+
+# Client reconnects with exponential backoff (jittered), giving up after
+# RECONNECT_MAX_ATTEMPTS
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RECONNECT_MAX_ATTEMPTS = 20
+
+# Optional batching: events queued within BATCH_WINDOW_MS (e.g. 5-20) are
+# sent as one "batch" frame of at most BATCH_MAX_EVENTS events; 0 sends every
+# event as its own frame. The server logs frames/s vs events/s every
+# BATCH_STATS_INTERVAL seconds (0 to disable).
+BATCH_WINDOW_MS = 0
+BATCH_MAX_EVENTS = 64
+BATCH_STATS_INTERVAL = 10
+
+# Compression. With COMPRESSION on, both sides negotiate permessage-deflate
+# with a 2**COMPRESSION_WINDOW_BITS byte window (9-15) and zlib
+# COMPRESSION_MEM_LEVEL (1-9) / COMPRESSION_LEVEL, but only text messages of
+# at least COMPRESSION_THRESHOLD bytes (history pages, lists, batches) are
+# compressed; binary image chunks only if COMPRESSION_BINARY. Image uploads
+# can use MEDIA_CHUNK_CODEC "zstd" instead, when the zstandard package is
+# installed on the client and the server.
+COMPRESSION = True
+COMPRESSION_WINDOW_BITS = 12
+COMPRESSION_MEM_LEVEL = 5
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_BINARY = False
+MEDIA_CHUNK_CODEC = "none"
+MEDIA_ZSTD_LEVEL = 3
+
+# Wire protocols, as websocket subprotocols: "json" and "msgpack" (compact
+# binary events, needs the msgpack package on both ends). Clients offer them
+# in this order of preference; the server accepts these and follows the
+# client's order. It also talks JSON to clients that offer neither.
+WIRE_PROTOCOLS = ["json", "msgpack"]
+
+# Server flood control: per-connection token buckets of (rate per second,
+# burst) for each kind of event; "image" counts uploaded bytes and "total"
+# every event but image chunks. Events over a limit are delayed, dropped
+# with a notice or get the client disconnected (RATE_LIMIT_ACTION: "delay",
+# "drop" or "disconnect", overridable per kind in RATE_LIMIT_ACTIONS). An
+# event that would wait more than RATE_LIMIT_MAX_DELAY seconds is dropped;
+# clients are told at most every RATE_LIMIT_NOTICE_INTERVAL seconds.
+RATE_LIMITS = {
+    "total": (30, 60),
+    "message": (5, 10),
+    "whisper": (5, 10),
+    "atack": (2, 5),
+    "image": (1024 * 1024, 4 * 1024 * 1024),
+}
+RATE_LIMIT_ACTION = "drop"
+RATE_LIMIT_ACTIONS = {"image": "delay"}
+RATE_LIMIT_MAX_DELAY = 5
+RATE_LIMIT_NOTICE_INTERVAL = 5
+
+# Server logging ("debug" also logs every received event; "off" disables it)
+# and metrics: Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics
+# (METRICS_PORT + worker id with several workers; 0 disables it). Event type
+# labels are capped at METRICS_MAX_TYPES distinct values; the event loop lag
+# is sampled every LOOP_LAG_INTERVAL seconds.
+LOG_LEVEL = "info"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_MAX_TYPES = 64
+LOOP_LAG_INTERVAL = 0.5
@@ -0,0 +1,141 @@
+"""Client side of resumable sessions.
+
+``Connection`` wraps the current websocket so the prompt and the command
+handlers keep working across reconnects. It remembers the session token
+the server sent and how many frames have been received since, and uses
+them to resume the session after reconnecting.
+
+It also batches outgoing events when ``config.BATCH_WINDOW_MS`` is set,
+and meters frames vs events in both directions for ``/stats``. Compression
+and the wire protocol are negotiated on connect as set up in
+``compression`` and ``protocol``; events given to ``send`` as dicts are
+encoded for the negotiated protocol.
+"""
+import asyncio
+import json
+import random
+
+import websockets
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+from src.core import batching
+from src.core import compression
+from src.core import config
+from src.core import protocol
+
+
+def backoff_delays():
+    """Seconds to wait before each reconnect attempt: exponential, capped and jittered."""
+    for attempt in range(config.RECONNECT_MAX_ATTEMPTS):
+        delay = min(config.RECONNECT_MAX_DELAY, config.RECONNECT_BASE_DELAY * 2 ** attempt)
+        # Jitter keeps clients dropped together from reconnecting in lockstep
+        yield delay * random.uniform(0.5, 1.0)
+
+
+class Connection:
+    """The current websocket plus what is needed to resume the session."""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.websocket = None
+        self.packed = False  # the server accepted chat.msgpack
+        self.token = None  # from the server's "session" event
+        self.seq = 0       # frames received since the session started
+        self.media_codecs = []  # image chunk codecs the server accepts
+        self.closing = False
+        self.pending = []  # encoded events waiting for the batch window
+        self.flush_task = None
+        self.outbound = batching.RateMeter()
+        self.inbound = batching.RateMeter()
+
+    async def connect(self):
+        self.websocket = await websockets.connect(
+            self.uri, compression=None, extensions=compression.client_extensions(),
+            subprotocols=protocol.available()
+        )
+        self.packed = protocol.is_packed(self.websocket.subprotocol)
+
+    async def reconnect(self):
+        """Reconnect and ask the server to resume the session.
+
+        Returns:
+            bool: False after RECONNECT_MAX_ATTEMPTS failed attempts.
+        """
+        for attempt, delay in enumerate(backoff_delays(), 1):
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                if self.token:
+                    await self.websocket.send(json.dumps({
+                        "type": "resume",
+                        "token": self.token,
+                        "last_seq": self.seq
+                    }))
+            except (OSError, asyncio.TimeoutError, InvalidHandshake, ConnectionClosed) as e:
+                print(f"\n[RECONNECT] Attempt {attempt} failed: {e}")
+                continue
+            return True
+        return False
+
+    def received(self, data):
+        """Count a received frame; ``data`` is the decoded event, if any."""
+        self.seq += 1
+        if isinstance(data, dict):
+            if data.get("type") == "session":
+                # Not numbered itself: it tells where the following frames start
+                self.token = data.get("token")
+                self.seq = data.get("seq", 0)
+                self.media_codecs = data.get("media_codecs") or []
+            elif data.get("type") == "resume_failed":
+                self.token = None
+
+    def encode(self, event):
+        """An event dict as a frame of the negotiated protocol."""
+        return protocol.pack(event) if self.packed else json.dumps(event)
+
+    async def send(self, message):
+        """Send an event dict, encoded text or a binary frame."""
+        if isinstance(message, dict):
+            message = self.encode(message)
+        if not batching.window() or not batching.batchable(message, not isinstance(message, bytes)):
+            # Anything not batched must not overtake the events waiting for the window
+            await self.flush()
+            await self.websocket.send(message)
+            self.outbound.add(1, 1)
+            return
+
+        self.pending.append(message.encode("utf-8"))
+        if len(self.pending) >= config.BATCH_MAX_EVENTS:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(batching.window())
+        self.flush_task = None
+        try:
+            await self.flush()
+        except ConnectionClosed:
+            print("\n[OFFLINE] Not connected, messages not sent. Reconnecting...")
+
+    async def flush(self):
+        """Send the events waiting for the batch window now."""
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+            self.flush_task = None
+        pending, self.pending = self.pending, []
+        if len(pending) == 1:
+            await self.websocket.send(pending[0].decode("utf-8"))
+        elif pending:
+            await self.websocket.send(batching.pack(pending).decode("utf-8"))
+        if pending:
+            self.outbound.add(1, len(pending))
+
+    async def close(self):
+        self.closing = True
+        if self.websocket is not None:
+            try:
+                await self.flush()
+            except ConnectionClosed:
+                pass
+            await self.websocket.close()
@@ -0,0 +1,95 @@
+"""Table-driven routing of events and commands to their handlers.
+
+A ``Dispatcher`` maps a key (an event ``type``, a command name) to a handler
+coroutine registered with its ``on`` decorator, so routing is a single dict
+lookup however many handlers there are, and adding one doesn't touch the
+receive loop. Keys without a handler go to the ``fallback`` handler.
+
+A handler can declare a schema: the fields the event must have and their
+types. It is checked once, before the handler runs, so handlers read the
+fields without checking them again. An event that doesn't match is passed to
+``on_invalid`` instead of the handler.
+
+Every call is timed and passed to ``observe(seconds, handler name)``, which
+is how the server feeds its metrics.
+"""
+import time
+
+
+class Dispatcher:
+    def __init__(self, name, observe=None, on_invalid=None):
+        """
+        Args:
+            name (str): What is dispatched, for error messages.
+            observe (callable): Called with (seconds, handler name) after each handler.
+            on_invalid (coroutine function): Called with (error, *args) when an
+                event fails its handler's schema.
+        """
+        self.name = name
+        self.observe = observe
+        self.on_invalid = on_invalid
+        self.handlers = {}
+        self.schemas = {}
+        self.default = None
+
+    def on(self, *keys, schema=None):
+        """Decorator registering a handler for ``keys``.
+
+        Args:
+            schema (dict): Field name -> type (or tuple of types) the event,
+                the handler's last argument, must have.
+        """
+        def register(handler):
+            for key in keys:
+                if key in self.handlers:
+                    raise ValueError(f"{self.name}: {key!r} already handled by {self.handlers[key].__name__}")
+                self.handlers[key] = handler
+                if schema:
+                    self.schemas[key] = schema
+            return handler
+        return register
+
+    def fallback(self, handler):
+        """Decorator registering the handler for keys nobody else handles."""
+        self.default = handler
+        return handler
+
+    def __contains__(self, key):
+        return key in self.handlers
+
+    async def dispatch(self, key, *args):
+        """Run the handler for ``key`` with ``args``.
+
+        Returns:
+            The handler's result, or None if there is no handler or the event
+            is invalid.
+        """
+        handler = self.handlers.get(key, self.default)
+        if handler is None:
+            return None
+        schema = self.schemas.get(key)
+        if schema is not None:
+            error = invalid(args[-1], schema)
+            if error is not None:
+                if self.on_invalid is not None:
+                    await self.on_invalid(f"{key}: {error}", *args)
+                return None
+        if self.observe is None:
+            return await handler(*args)
+        start = time.perf_counter()
+        try:
+            return await handler(*args)
+        finally:
+            self.observe(time.perf_counter() - start, handler.__name__)
+
+
+def invalid(event, schema):
+    """Why ``event`` doesn't match ``schema``, or None if it does."""
+    for field, types in schema.items():
+        value = event.get(field)
+        if value is None:
+            return f"missing '{field}'"
+        # bool is an int, but never a valid size or sequence number
+        if not isinstance(value, types) or (isinstance(value, bool) and types is int):
+            return f"'{field}' has the wrong type"
+    return None
@@ -0,0 +1,166 @@
+"""Wire protocols negotiated as websocket subprotocols.
+
+Clients offer the protocols in ``config.WIRE_PROTOCOLS`` in order of
+preference (JSON first by default) and the server picks the first one it
+accepts:
+
+* ``chat.json``: JSON text frames, as always. Clients that offer no
+  subprotocol at all (older versions) get JSON too.
+* ``chat.msgpack.1``: MessagePack binary frames with compact keys. Field
+  names in ``KEYS`` and event types in ``TYPES`` are sent as small integers,
+  so an ``atack`` or ``life_update`` event is a dozen bytes instead of being
+  mostly key names. Anything not in the tables goes out as a string, which
+  keeps the protocol open to new fields. Changing the tables (other than
+  appending to them) needs a new protocol version. A packed event must
+  decode to what JSON could carry: maps with string keys (once expanded)
+  and no binary or extension values, or it is rejected like invalid JSON.
+
+Whatever the protocol, text frames are always JSON: a client may still get
+a JSON frame (e.g. a session replayed by a worker that didn't know its
+protocol) and must handle both. Binary frames are image chunks when their
+transfer id belongs to an active transfer (see ``src.core.transfer``), and
+MessagePack events otherwise.
+
+Packed events are binary frames, so they are never batched (batch frames
+are JSON) and permessage-deflate leaves them alone unless
+``config.COMPRESSION_BINARY`` is set (see ``src.core.compression``).
+MessagePack is optional: without the ``msgpack`` package only JSON is
+offered or accepted.
+"""
+from src.core import config
+
+try:
+    import msgpack
+    _packer = msgpack.Packer()
+except ImportError:
+    msgpack = None
+
+JSON = "chat.json"
+MSGPACK = "chat.msgpack.1"
+NAMES = {"json": JSON, "msgpack": MSGPACK}
+
+# Append only: the index of an entry is its code on the wire
+KEYS = (
+    "type", "user", "from", "to", "message", "text", "atack", "life", "name", "room",
+    "id", "size", "filename", "sha256", "chunks", "count", "users", "messages", "seq", "ts",
+    "more", "replay", "action", "token", "last_seq", "resumed", "complete", "codec", "poster", "rooms",
+    "current", "events", "limit", "within", "terms", "payload", "query", "results", "media_codecs",
+    "tick", "hits", "damage", "defeated", "respawned",
+)
+TYPES = (
+    "message", "whisper", "whisper_received", "whisper_sent", "whisper_error",
+    "atack", "atack_received", "atack_sent", "atack_error", "atack_notification",
+    "life_update", "notification", "command", "user_list", "session",
+    "resume", "resume_failed", "room_joined", "room_list", "history",
+    "search_results", "server_stats", "image_start", "image_end", "image_abort",
+    "image_ref", "image_data", "media_offer", "media_have", "media_need",
+    "media_fetch", "batch", "battle",
+)
+_KEY_CODES = {name: code for code, name in enumerate(KEYS)}
+_KEY_NAMES = dict(enumerate(KEYS))
+_TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+_TYPE_NAMES = dict(enumerate(TYPES))
+_TYPE = _KEY_CODES["type"]
+
+
+class DecodeError(ValueError):
+    """Raised when a binary frame is not a valid packed event."""
+
+
+def available():
+    """Subprotocols this side can speak, in order of preference."""
+    names = [NAMES[name] for name in config.WIRE_PROTOCOLS if name in NAMES]
+    if msgpack is None:
+        names = [name for name in names if name != MSGPACK]
+    return names or [JSON]
+
+
+def select(connection, offered):
+    """``select_subprotocol`` for the server: the client's first choice we accept.
+
+    Clients offering nothing we know get no subprotocol, i.e. JSON.
+    """
+    accepted = available()
+    for name in offered:
+        if name in accepted:
+            return name
+    return None
+
+
+def is_packed(subprotocol):
+    return subprotocol == MSGPACK
+
+
+_NESTED = (dict, list)
+
+
+def _compact(value):
+    if value.__class__ is list:
+        return [_compact(item) if item.__class__ in _NESTED else item for item in value]
+    compact = {
+        _KEY_CODES.get(key, key): _compact(item) if item.__class__ in _NESTED else item
+        for key, item in value.items()
+    }
+    event_type = value.get("type")
+    if event_type.__class__ is str:
+        compact[_TYPE] = _TYPE_CODES.get(event_type, event_type)
+    return compact
+
+
+def _expand(pairs):
+    # object_hook of the unpacker: called for every map, innermost first
+    event = {_KEY_NAMES.get(key, key): item for key, item in pairs.items()}
+    for key, item in event.items():
+        # Relayed events are encoded again as JSON, which can't carry these
+        if key.__class__ is not str:
+            raise DecodeError(f"unexpected key {key!r}")
+        if item.__class__ is bytes:
+            raise DecodeError(f"binary value for {key!r}")
+    event_type = event.get("type")
+    if event_type.__class__ is int:
+        event["type"] = _TYPE_NAMES.get(event_type, event_type)
+    return event
+
+
+def _check_list(items):
+    # list_hook of the unpacker
+    if any(item.__class__ is bytes for item in items):
+        raise DecodeError("unexpected binary value in a list")
+    return items
+
+
+def _reject_ext(code, data):
+    raise DecodeError(f"unexpected extension type {code}")
+
+
+def pack(event):
+    """Encode an event for ``chat.msgpack``, the type first."""
+    if isinstance(event, dict) and "type" in event and next(iter(event)) != "type":
+        event = {"type": event["type"], **event}
+    return _packer.pack(_compact(event) if event.__class__ in _NESTED else event)
+
+
+def unpack(payload):
+    """Decode a ``chat.msgpack`` frame.
+
+    Raises:
+        DecodeError: The payload is not a packed event.
+    """
+    try:
+        return msgpack.unpackb(payload, strict_map_key=False, object_hook=_expand,
+                               list_hook=_check_list, ext_hook=_reject_ext)
+    except DecodeError:
+        raise
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise DecodeError(f"Invalid packed event: {e}") from e
+
+
+def packed_type(payload):
+    """The event type of a packed frame without decoding it, or None.
+
+    Relies on ``pack`` writing the type first, as a small map's first entry.
+    """
+    if len(payload) < 3 or not 0x80 < payload[0] <= 0x8f or payload[1] != _TYPE:
+        return None
+    code = payload[2]
+    return TYPES[code] if code < len(TYPES) else None
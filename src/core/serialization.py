@@ -0,0 +1,48 @@
+"""JSON encoding shared by the client and the server.
+
+Uses orjson or ujson when one of them is installed and falls back to the
+standard library otherwise. ``encode`` always returns UTF-8 bytes so a
+broadcast can serialize an event once and hand the very same buffer to every
+recipient's websocket.
+"""
+import json
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    DecodeError = orjson.JSONDecodeError
+
+    def encode(event):
+        return orjson.dumps(event)
+
+    def decode(payload):
+        return orjson.loads(payload)
+
+except ImportError:
+    try:
+        import ujson
+
+        BACKEND = "ujson"
+        DecodeError = ValueError
+
+        def encode(event):
+            return ujson.dumps(event, ensure_ascii=False).encode("utf-8")
+
+        def decode(payload):
+            return ujson.loads(payload)
+
+    except ImportError:
+        BACKEND = "json"
+        DecodeError = json.JSONDecodeError
+
+        def encode(event):
+            return json.dumps(event, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        def decode(payload):
+            return json.loads(payload)
+
+
+def dumps(event):
+    """Encode an event as a ``str`` for callers that need a text payload."""
+    return encode(event).decode("utf-8")
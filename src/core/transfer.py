@@ -0,0 +1,214 @@
+"""Chunked binary image transfer.
+
+An image travels as three kinds of frames:
+
+* ``image_start`` (an event): transfer id, sender, file name and size.
+* Chunks (binary): 16-byte transfer id, 4-byte big-endian sequence number,
+  then up to ``config.IMAGE_CHUNK_SIZE`` bytes of file content. Uploads may
+  compress each chunk with the ``codec`` named in ``image_start``; the
+  server relays them decoded.
+* ``image_end`` (an event): chunk count and SHA-256 of the whole file.
+
+The server relays each frame as soon as it arrives and receivers append
+chunks to a spooled buffer, so no side ever holds a base64 copy of the file
+and large images only spill to disk instead of growing memory.
+
+Before uploading, the sender offers the image's SHA-256 (``media_offer``).
+If the server already stores it, the upload is skipped and the room gets an
+``image_ref`` that clients resolve from their cache or fetch on demand.
+"""
+import asyncio
+import hashlib
+import struct
+import tempfile
+import uuid
+from collections import OrderedDict
+
+from src.core import compression
+from src.core import config
+
+CHUNK_ID_SIZE = 16
+CHUNK_HEADER = struct.Struct(f"!{CHUNK_ID_SIZE}sI")
+
+OFFERS = {}  # sha256 -> future resolved with True if the server needs the upload
+
+
+class TransferError(Exception):
+    """Raised when an incoming transfer is malformed or fails its checks."""
+
+
+def pack_chunk(transfer_id, seq, payload):
+    """Build a binary chunk frame.
+
+    Args:
+        transfer_id: 16-byte transfer id.
+        seq: Zero-based chunk sequence number.
+        payload: Chunk content.
+    """
+    return CHUNK_HEADER.pack(transfer_id, seq) + payload
+
+
+def unpack_chunk(frame):
+    """Split a binary chunk frame into ``(transfer_id, seq, payload)``."""
+    if len(frame) < CHUNK_HEADER.size:
+        raise TransferError("Chunk frame too short")
+    transfer_id, seq = CHUNK_HEADER.unpack_from(frame)
+    return transfer_id, seq, memoryview(frame)[CHUNK_HEADER.size:]
+
+
+async def offer_image(websocket, user_name, filename, digest, size):
+    """Ask the server whether it already has an image.
+
+    The answer arrives on the receive loop, which calls ``resolve_offer``.
+
+    Returns:
+        bool: True if the image must be uploaded.
+    """
+    future = asyncio.get_running_loop().create_future()
+    OFFERS[digest] = future
+    try:
+        await websocket.send({
+            "type": "media_offer",
+            "user": user_name,
+            "filename": filename,
+            "size": size,
+            "sha256": digest
+        })
+        return await asyncio.wait_for(future, config.MEDIA_OFFER_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Servers without a media store never answer: just upload
+        return True
+    finally:
+        OFFERS.pop(digest, None)
+
+
+def resolve_offer(digest, needed):
+    future = OFFERS.get(digest)
+    if future is not None and not future.done():
+        future.set_result(needed)
+
+
+async def send_image(websocket, user_name, filename, fileobj, size):
+    """Stream ``fileobj`` to the server as a chunked image transfer.
+
+    Returns:
+        str: Hex SHA-256 of the content that was sent.
+    """
+    transfer_id = uuid.uuid4()
+    start = {
+        "type": "image_start",
+        "id": transfer_id.hex,
+        "user": user_name,
+        "filename": filename,
+        "size": size
+    }
+    codec = compression.upload_codec(getattr(websocket, "media_codecs", None))
+    if codec:
+        start["codec"] = codec
+    await websocket.send(start)
+
+    digest = hashlib.sha256()
+    seq = 0
+    while True:
+        chunk = fileobj.read(config.IMAGE_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        await websocket.send(pack_chunk(transfer_id.bytes, seq, compression.compress_chunk(chunk, codec)))
+        seq += 1
+
+    await websocket.send({
+        "type": "image_end",
+        "id": transfer_id.hex,
+        "chunks": seq,
+        "sha256": digest.hexdigest()
+    })
+    return digest.hexdigest()
+
+
+class IncomingTransfer:
+    """Receive-side state of one transfer."""
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.size = int(meta.get("size", 0))
+        if self.size > config.IMAGE_MAX_SIZE:
+            raise TransferError(f"Image too large ({self.size} bytes)")
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=config.IMAGE_SPOOL_SIZE)
+        self.digest = hashlib.sha256()
+        self.next_seq = 0
+        self.received = 0
+
+    def feed(self, seq, payload):
+        if seq != self.next_seq:
+            raise TransferError(f"Expected chunk {self.next_seq}, got {seq}")
+        self.received += len(payload)
+        if self.received > self.size:
+            raise TransferError("Transfer larger than announced")
+        self.digest.update(payload)
+        self.buffer.write(payload)
+        self.next_seq += 1
+
+    def finish(self, chunks, sha256):
+        if chunks != self.next_seq or self.received != self.size:
+            raise TransferError("Transfer incomplete")
+        if sha256 != self.digest.hexdigest():
+            raise TransferError("Checksum mismatch")
+        self.buffer.seek(0)
+        return self.buffer
+
+    def discard(self):
+        self.buffer.close()
+
+
+class Reassembler:
+    """Tracks concurrent incoming transfers with a bounded number in flight."""
+
+    def __init__(self, max_transfers=None):
+        self.max_transfers = max_transfers or config.MAX_INCOMING_TRANSFERS
+        self.transfers = OrderedDict()  # transfer id bytes -> IncomingTransfer
+
+    def start(self, meta):
+        transfer_id = uuid.UUID(hex=meta["id"]).bytes
+        if len(self.transfers) >= self.max_transfers:
+            _, oldest = self.transfers.popitem(last=False)
+            oldest.discard()
+        self.transfers[transfer_id] = IncomingTransfer(meta)
+
+    def expects(self, frame):
+        """True if a binary frame is a chunk of a transfer in flight."""
+        return frame[:CHUNK_ID_SIZE] in self.transfers
+
+    def feed(self, frame):
+        """Append a binary chunk frame. Chunks of unknown transfers are ignored."""
+        transfer_id, seq, payload = unpack_chunk(frame)
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return
+        try:
+            transfer.feed(seq, payload)
+        except TransferError:
+            self.abort(transfer_id)
+            raise
+
+    def finish(self, data):
+        """Complete a transfer.
+
+        Returns:
+            tuple: ``(meta, file object positioned at 0)``, or None if the
+            transfer is unknown. The caller must close the file object.
+        """
+        transfer_id = uuid.UUID(hex=data["id"]).bytes
+        transfer = self.transfers.pop(transfer_id, None)
+        if transfer is None:
+            return None
+        try:
+            return transfer.meta, transfer.finish(data.get("chunks"), data.get("sha256"))
+        except TransferError:
+            transfer.discard()
+            raise
+
+    def abort(self, transfer_id):
+        transfer = self.transfers.pop(transfer_id, None)
+        if transfer is not None:
+            transfer.discard()
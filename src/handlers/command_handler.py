@@ -1,28 +1,35 @@
-import json
-import base64
+import asyncio
 import os
 from collections import defaultdict
 from src.core import config
+from src.core.dispatch import Dispatcher
 from src.utils.sound import play_notification_sound
-from src.utils.image_utils import display_image_in_terminal
+from src.core.transfer import offer_image, send_image
+from src.handlers.render_queue import render, show_frame
 
 user_messages = defaultdict(list)
 
-async def handle_quit_command(websocket, user_name):
+# Slash commands by name, handled with (websocket, user_name, parts); True ends the session
+COMMANDS = Dispatcher("commands")
+
+@COMMANDS.on("quit")
+async def handle_quit_command(websocket, user_name, parts):
     print(f"Goodbye, {user_name}.")
-    quit_message = json.dumps({"type": "command", "name": "quit", "user": user_name})
+    quit_message = {"type": "command", "name": "quit", "user": user_name}
     await websocket.send(quit_message)
     return True
 
 
-def handle_help_command():
+@COMMANDS.on("help")
+async def handle_help_command(websocket, user_name, parts):
     print("\n--- AVAILABLE COMMANDS ---")
     for cmd, desc in config.COMMANDS.items():
         print(f"/{cmd:<7} : {desc}")
     print("--------------------------\n")
 
 
-def handle_sound_command(parts):
+@COMMANDS.on("sound")
+async def handle_sound_command(websocket, user_name, parts):
     if len(parts) < 2:
         print("Usage: /sound <path/to/sound.wav> | /sound mute | /sound unmute")
         status = "muted" if config.IS_MUTED else (config.NOTIFICATION_SOUND if config.NOTIFICATION_SOUND else "System default beep")
@@ -61,12 +68,44 @@ def handle_sound_command(parts):
     play_notification_sound(config.NOTIFICATION_SOUND) 
 
 
+def parse_image_options(parts):
+    """Split /image arguments into (options, positional args), or None if invalid."""
+    options = {"original": False, "mode": None, "colors": None}
+    args = []
+    it = iter(parts[1:])
+    for part in it:
+        if part == "--original":
+            options["original"] = True
+        elif part in ("--mode", "--colors"):
+            value = next(it, None)
+            choices = config.RENDER_MODES if part == "--mode" else config.COLOR_MODES
+            if value not in choices:
+                print(f"Error: {part} must be one of: {', '.join(choices)}")
+                return None
+            options[part[2:]] = value
+        else:
+            args.append(part)
+    return options, args
+
+
+@COMMANDS.on("image")
 async def handle_image_command(websocket, user_name, parts):
-    if len(parts) < 2:
-        print("Usage: /image <path/to/image>")
+    parsed = parse_image_options(parts)
+    if parsed is None:
         return
-        
-    image_path = "images/"+parts[1]
+    options, args = parsed
+
+    if not args:
+        if options["mode"] or options["colors"]:
+            # No image given: change the defaults used for every image
+            config.IMAGE_RENDER_MODE = options["mode"] or config.IMAGE_RENDER_MODE
+            config.IMAGE_COLOR_MODE = options["colors"] or config.IMAGE_COLOR_MODE
+            print(f"Image rendering: mode={config.IMAGE_RENDER_MODE}, colors={config.IMAGE_COLOR_MODE}")
+            return
+        print("Usage: /image [--original] [--mode full|half] [--colors truecolor|256|16] <path/to/image>")
+        return
+
+    image_path = "images/"+args[0]
     
     if not os.path.exists(image_path):
         print(f"Error: File not found at {image_path}")
@@ -75,54 +114,57 @@ async def handle_image_command(websocket, user_name, parts):
     print(f"[{user_name}]: Reading and sending image {image_path}...")
 
     try:
-        import sys
-        
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-            
-        encoded_content = base64.b64encode(image_bytes).decode('utf-8')
-        
-        image_data_packet = json.dumps({
-            "type": "image_data", 
-            "user": user_name, 
-            "filename": os.path.basename(image_path),
-            "content": encoded_content
-        })
-        
-        await websocket.send(image_data_packet)
-        print(f"[{user_name}]: Image packet sent to server.")
-        
-        # Display image locally using the same method as receiving
-        sys.__stdout__.write(f"[{user_name}] Displaying image '{os.path.basename(image_path)}'...\n")
-        sys.__stdout__.flush()
-        
-        # Temporarily redirect stdout to real stdout to bypass prompt_toolkit
-        old_stdout = sys.stdout
-        sys.stdout = sys.__stdout__
-        try:
-            display_image_in_terminal(image_path)
-        finally:
-            sys.stdout = old_stdout
-        
-        sys.__stdout__.write("\n")
-        sys.__stdout__.flush()
-        
+        # NumPy and Pillow are only loaded once an image is actually used
+        from src.utils.image_utils import prepare_image_for_upload, content_hash
+
+        if options["original"]:
+            file_name = os.path.basename(image_path)
+            image_file = open(image_path, 'rb')
+        else:
+            # Decode and downscale off the event loop so the prompt stays responsive
+            file_name, image_file = await asyncio.to_thread(prepare_image_for_upload, image_path)
+
+        with image_file:
+            image_file.seek(0, os.SEEK_END)
+            size = image_file.tell()
+            image_file.seek(0)
+            if size > config.IMAGE_MAX_SIZE:
+                print(f"Error: Image is larger than {config.IMAGE_MAX_SIZE} bytes")
+                return
+            digest = await asyncio.to_thread(content_hash, image_file)
+            if await offer_image(websocket, user_name, file_name, digest, size):
+                await send_image(websocket, user_name, file_name, image_file, size)
+                print(f"[{user_name}]: Image sent to server ({size} bytes).")
+            else:
+                print(f"[{user_name}]: Server already has this image, sent a reference.")
+            image_file.seek(0)
+            image_bytes = await asyncio.to_thread(image_file.read)
+
+        # Preview what was sent, rendered off the event loop like received images
+        frame = await render(image_bytes, digest, options["mode"], options["colors"])
+        if frame is None:
+            print(f"\n[ERROR] Failed to render image '{file_name}'.")
+        else:
+            show_frame(user_name, os.path.basename(image_path), frame)
+
     except Exception as e:
         print(f"Error reading/encoding file: {e}")
 
-async def handle_users_command(websocket, user_name):
+@COMMANDS.on("users")
+async def handle_users_command(websocket, user_name, parts):
     try:
-        request = json.dumps({
+        request = {
             "type": "command",
             "name": "users",
             "user": user_name
-        })
+        }
         await websocket.send(request)
         print("\n[Requesting user list from server...]")
     except Exception as e:
         print(f"\n[ERROR] Failed to request user list: {e}")
 
-def handle_clear_messages(user_name):
+@COMMANDS.on("clear")
+async def handle_clear_messages(websocket, user_name, parts):
     os.system('cls' if os.name == 'nt' else 'clear')
     if user_name in user_messages:
         user_messages[user_name].clear()
@@ -131,7 +173,8 @@ def handle_clear_messages(user_name):
 def store_message(user_name, message):
     user_messages[user_name].append(message)
 
-def handle_watch_video(parts, user_name):
+@COMMANDS.on("watch")
+async def handle_watch_video(websocket, user_name, parts):
     import webbrowser
     video_url = parts[1]
     
@@ -142,6 +185,7 @@ def handle_watch_video(parts, user_name):
     except Exception as e:
         print(f"Error opening video: {e}")
 
+@COMMANDS.on("whisper")
 async def handle_whisper_command(websocket, user_name, parts):
     if len(parts) < 3:
         print("Usage: /whisper <username> <message>")
@@ -150,16 +194,17 @@ async def handle_whisper_command(websocket, user_name, parts):
     target_user = parts[1]
     message = ' '.join(parts[2:])
     
-    whisper_data = json.dumps({
+    whisper_data = {
         "type": "whisper",
         "from": user_name,
         "to": target_user,
         "message": message
-    })
+    }
     
     await websocket.send(whisper_data)
     print(f"[Whisper to {target_user}] {message}")
 
+@COMMANDS.on("atack")
 async def handle_atack_command(websocket, user_name, parts):
     if len(parts) < 3:
         print("Usage: /atack <username> <atack")
@@ -171,59 +216,116 @@ async def handle_atack_command(websocket, user_name, parts):
         print(f"Error: Unknown atack '{atack}'. Available atacks: {', '.join(config.ATACKS.keys())}")
         return
     
-    atack_data = json.dumps({
+    atack_data = {
         "type": "atack",
         "from": user_name,
         "to": target_user,
         "atack": atack
-    })
+    }
     
     await websocket.send(atack_data)
-    print(f"You hit {target_user} with {atack}.")
-async def process_command(websocket, user_name, user_input):
-    parts = user_input.split()
-    command_name = parts[0].lstrip('/')
-    
-    if command_name == "quit":
-        return await handle_quit_command(websocket, user_name)
-    
-    elif command_name == "help":
-        handle_help_command()
-    
-    elif command_name == "sound":
-        handle_sound_command(parts)
-    
-    elif command_name == "image":
-        await handle_image_command(websocket, user_name, parts)
-    
-    elif command_name == "users":
-        await handle_users_command(websocket, user_name)
-        return False
+    # The hit lands with the server's next battle tick
+    print(f"Attacking {target_user} with {atack}...")
+@COMMANDS.on("join")
+async def handle_join_command(websocket, user_name, parts):
+    if len(parts) < 2:
+        print("Usage: /join <room>")
+        return
 
-    elif command_name == "clear":
-        handle_clear_messages(user_name)
-        return False
-    
-    elif command_name == "watch":
-        handle_watch_video(parts, user_name)
-        return False
-    
-    elif command_name == "whisper":
-        await handle_whisper_command(websocket, user_name, parts)
-        return False
-    
-    elif command_name == "atack":
-        await handle_atack_command(websocket, user_name, parts)
-        return False
+    await websocket.send({
+        "type": "command",
+        "name": "join",
+        "user": user_name,
+        "room": parts[1]
+    })
+
+@COMMANDS.on("leave")
+async def handle_leave_command(websocket, user_name, parts):
+    await websocket.send({"type": "command", "name": "leave", "user": user_name})
+
+@COMMANDS.on("rooms")
+async def handle_rooms_command(websocket, user_name, parts):
+    await websocket.send({"type": "command", "name": "rooms", "user": user_name})
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+@COMMANDS.on("history")
+async def handle_history_command(websocket, user_name, parts):
+    request = {"type": "command", "name": "history", "user": user_name}
+    if len(parts) > 1:
+        arg = parts[1].lower()
+        try:
+            if arg[-1] in DURATION_UNITS:
+                request["within"] = parse_duration(arg)
+            else:
+                request["limit"] = int(arg)
+        except ValueError:
+            print("Usage: /history [n|since], e.g. /history 100 or /history 2h")
+            return
 
+    await websocket.send(request)
+
+def parse_duration(value):
+    """Seconds in '45s', '30m', '2h' or '1d'."""
+    value = value.lower()
+    if not value or value[-1] not in DURATION_UNITS:
+        raise ValueError(value)
+    return float(value[:-1]) * DURATION_UNITS[value[-1]]
+
+@COMMANDS.on("search")
+async def handle_search_command(websocket, user_name, parts):
+    request = {"type": "command", "name": "search", "user": user_name, "terms": []}
+    try:
+        for part in parts[1:]:
+            key, _, value = part.partition(":")
+            if value and key == "from":
+                request["from"] = value
+            elif value and key == "in":
+                request["room"] = value
+            elif value and key == "since":
+                request["within"] = parse_duration(value)
+            elif value and key == "until":
+                request["older_than"] = parse_duration(value)
+            else:
+                request["terms"].append(part)
+    except ValueError:
+        print("Durations look like 45s, 30m, 2h or 1d.")
+        return
+
+    if not request["terms"] and "from" not in request and "room" not in request:
+        print("Usage: /search <terms> [from:user] [in:room] [since:2h] [until:30m]")
+        return
+
+    await websocket.send(request)
+
+@COMMANDS.on("stats")
+async def handle_stats_command(websocket, user_name, parts):
+    # The server's numbers arrive as a server_stats event
+    await websocket.send({"type": "command", "name": "stats", "user": user_name})
+    window = config.BATCH_WINDOW_MS
+    print("\n--- CONNECTION STATS ---")
+    print(f"Batch window: {f'{window:g} ms' if window > 0 else 'off'}")
+    print(f"Sent:     {websocket.outbound.report()}")
+    print(f"Received: {websocket.inbound.report()}")
+    print(f"Totals:   sent {websocket.outbound.events} events in {websocket.outbound.frames} frames, "
+          f"received {websocket.inbound.events} events in {websocket.inbound.frames} frames")
+    print("------------------------")
+
+@COMMANDS.fallback
+async def send_unknown_command(websocket, user_name, parts):
+    # Not a local command: the server (or the other clients) may know it
+    user_input = " ".join(parts)
     user_messages[user_name].append(user_input)
     
-    unknown_command = json.dumps({
+    unknown_command = {
         "type": "command",
-        "name": command_name,
+        "name": parts[0].lstrip('/'),
         "user": user_name,
         "payload": user_input
-    })
+    }
     await websocket.send(unknown_command)
-    
-    return False
+
+
+async def process_command(websocket, user_name, user_input):
+    parts = user_input.split()
+    return bool(await COMMANDS.dispatch(parts[0].lstrip('/'), websocket, user_name, parts))
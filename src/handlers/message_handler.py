@@ -1,114 +1,305 @@
-import sys
+import asyncio
 import json
 import base64
-import os
-import tempfile
+import hashlib
 import time
 import websockets
 
 from src.utils.sound import play_notification_sound
-from src.utils.image_utils import display_image_in_terminal
+from src.core import batching
 from src.core import config
+from src.core import protocol
+from src.core.dispatch import Dispatcher
+from src.core.transfer import Reassembler, TransferError, resolve_offer
+from src.utils import render_cache
+from src.handlers.render_queue import RenderQueue
 
 
-def render_image_from_data(data):
+class Receiver:
+    """What the event handlers of one connection share."""
+
+    def __init__(self, websocket, user_name, connection):
+        self.websocket = websocket
+        self.packed = protocol.is_packed(websocket.subprotocol)
+        self.user_name = user_name
+        self.connection = connection
+        self.transfers = Reassembler()
+        self.renderer = RenderQueue()
+        self.history_header = True  # next history page starts a new listing
+
+    async def send(self, event):
+        await self.websocket.send(protocol.pack(event) if self.packed else json.dumps(event))
+
+
+# Server events by type, handled with (receiver, event); unknown types are ignored
+EVENTS = Dispatcher("server events")
+
+
+@EVENTS.on("image_data")
+async def on_image_data(ctx, data):
+    # Skip rendering if the sender is the current user (already displayed locally)
+    if data.get('user') == ctx.user_name:
+        return
+    play_notification_sound(config.NOTIFICATION_SOUND)
     try:
         image_bytes = base64.b64decode(data['content'])
-        file_name = data['filename']
-        
-        temp_dir = tempfile.gettempdir()
-        unique_id = int(time.time() * 1000)
-        temp_path = os.path.join(temp_dir, f"temp_img_{unique_id}_{file_name}")
-
-        with open(temp_path, 'wb') as f:
-            f.write(image_bytes)
-            
-        # Write directly to real stdout to bypass prompt_toolkit
-        sys.__stdout__.write(f"\n[{data['user']}] Displaying image '{file_name}'...\n")
-        sys.__stdout__.flush()
-        
-        # Use the original display function but redirect to real stdout
-        old_stdout = sys.stdout
-        sys.stdout = sys.__stdout__
-        try:
-            display_image_in_terminal(temp_path)
-        finally:
-            sys.stdout = old_stdout
-        
-        sys.__stdout__.write("\n")
-        sys.__stdout__.flush()
-        
-        os.remove(temp_path)
-        
-    except Exception as e:
+    except (KeyError, ValueError) as e:
         print(f"\n[ERROR] Failed to render image: {e}")
+        return
+    ctx.renderer.submit(data.get('user'), data.get('filename'), image_bytes,
+                        hashlib.sha256(image_bytes).hexdigest())
+
+
+@EVENTS.on("image_start")
+async def on_image_start(ctx, data):
+    if data.get('user') != ctx.user_name:
+        try:
+            ctx.transfers.start(data)
+        except (TransferError, KeyError, ValueError) as e:
+            print(f"\n[ERROR] Cannot receive image from {data.get('user')}: {e}")
+
+
+@EVENTS.on("image_end")
+async def on_image_end(ctx, data):
+    try:
+        result = ctx.transfers.finish(data)
+    except (TransferError, KeyError, ValueError) as e:
+        print(f"\n[ERROR] Image transfer failed: {e}")
+        result = None
+    if result is not None:
+        meta, image_file = result
+        with image_file:
+            image_bytes = image_file.read()
+        render_cache.MEDIA_CACHE.put(data.get('sha256'), image_bytes)
+        play_notification_sound(config.NOTIFICATION_SOUND)
+        ctx.renderer.submit(meta.get('user'), meta.get('filename'), image_bytes, data.get('sha256'))
+
+
+@EVENTS.on("image_ref")
+async def on_image_ref(ctx, data):
+    # Image the server already stores: resolve locally or fetch it
+    digest = data.get('sha256')
+    if data.get('user') != ctx.user_name and digest:
+        if ctx.renderer.submit(data.get('user'), data.get('filename'),
+                               render_cache.MEDIA_CACHE.get(digest), digest):
+            play_notification_sound(config.NOTIFICATION_SOUND)
+        else:
+            await ctx.send({
+                "type": "media_fetch",
+                "sha256": digest,
+                "poster": data.get('user'),
+                "filename": data.get('filename')
+            })
+
+
+@EVENTS.on("media_have", "media_need")
+async def on_media_reply(ctx, data):
+    resolve_offer(data.get('sha256'), data.get("type") == "media_need")
+
+
+@EVENTS.on("image_abort")
+async def on_image_abort(ctx, data):
+    try:
+        ctx.transfers.abort(bytes.fromhex(data.get("id", "")))
+    except ValueError:
+        pass
+
+
+@EVENTS.on("message")
+async def on_message(ctx, data):
+    # Skip displaying if the sender is the current user (already displayed locally)
+    if data.get('user') != ctx.user_name:
+        play_notification_sound(config.NOTIFICATION_SOUND)
+        print(f"{data.get('user', 'unknown')}: {data.get('text', '')}")
+
+
+@EVENTS.on("notification")
+async def on_notification(ctx, data):
+    action = data.get("action", "performed an action")
+    print(f"[NOTIFICATION] {data.get('user', '')} {action}.")
+
+
+@EVENTS.on("command")
+async def on_command(ctx, data):
+    name = data.get("name", "unknown")
+    user = data.get("user", "someone")
+
+    if name == "quit":
+        print(f"\n[SERVER] {user} has disconnected.")
+    else:
+        print(f"\n[SERVER] Command '{name}' received from {user}.")
+
+
+@EVENTS.on("user_list")
+async def on_user_list(ctx, data):
+    # Display online users with life information
+    users = data.get("users", [])
+    count = data.get("count", 0)
+    print(f"\n--- ONLINE USERS ({count}) ---")
+    for user in users:
+        name = user.get("name", "unknown")
+        life = user.get("life", "?")
+        indicator = " (you)" if name == ctx.user_name else ""
+        print(f"  • {name}{indicator} - Life: {life}")
+    print("---------------------------")
 
 
-async def receive_messages(websocket, user_name):
-    "websocket: WebSocket connection object."
+@EVENTS.on("session")
+async def on_session(ctx, data):
+    if data.get("resumed"):
+        print(f"\n[RECONNECTED] Session resumed in '{data.get('room')}' with {data.get('life')} life.")
+        if not data.get("complete", True):
+            print("[RECONNECTED] Some messages sent while you were away were lost.")
+
+
+@EVENTS.on("resume_failed")
+async def on_resume_failed(ctx, data):
+    print("\n[RECONNECTED] Your previous session expired; your next message joins you as a new user.")
+
+
+@EVENTS.on("room_joined")
+async def on_room_joined(ctx, data):
+    print(f"\n[ROOM] You are now in '{data.get('room')}' ({data.get('count', 0)} users).")
+
+
+@EVENTS.on("room_list")
+async def on_room_list(ctx, data):
+    rooms = data.get("rooms", [])
+    current = data.get("current")
+    print(f"\n--- ROOMS ({len(rooms)}) ---")
+    for room in rooms:
+        indicator = " (you)" if room.get("name") == current else ""
+        print(f"  • {room.get('name')}{indicator} - {room.get('count', 0)} users")
+    print("---------------------------")
+
+
+@EVENTS.on("history")
+async def on_history(ctx, data):
+    messages = data.get("messages", [])
+    if ctx.history_header:
+        title = "RECENT MESSAGES" if data.get("replay") else "HISTORY"
+        print(f"\n--- {title} IN {data.get('room', '').upper()} ---")
+        if not messages:
+            print("  No messages.")
+    for entry in messages:
+        sent_at = time.strftime("%d/%m %H:%M", time.localtime(entry.get("ts", 0)))
+        print(f"  [{sent_at}] {entry.get('user', 'unknown')}: {entry.get('text', '')}")
+    ctx.history_header = not data.get("more")
+    if ctx.history_header:
+        print("---------------------------")
+
+
+@EVENTS.on("search_results")
+async def on_search_results(ctx, data):
+    results = data.get("results", [])
+    print(f"\n--- SEARCH: {data.get('query', '')} ({len(results)} found in {data.get('took_ms', 0):.1f} ms) ---")
+    for entry in results:
+        sent_at = time.strftime("%d/%m %H:%M", time.localtime(entry.get("ts", 0)))
+        print(f"  [{sent_at}] #{entry.get('room', '')} {entry.get('user', 'unknown')}: {entry.get('text', '')}")
+    print("---------------------------")
+
+
+@EVENTS.on("server_stats")
+async def on_server_stats(ctx, data):
+    print(f"\n--- SERVER STATS (worker {data.get('worker', 0)}, up {data.get('uptime', 0) / 60:.0f} min) ---")
+    gauges = data.get("gauges", {})
+    print(f"Connections: {gauges.get('chat_connections', 0):g}, users: {gauges.get('chat_users', 0):g}, "
+          f"detached sessions: {gauges.get('chat_detached_sessions', 0):g}")
+    print(f"In:  {data.get('bytes_in', 0)} bytes, events {data.get('events_in', {})}")
+    print(f"Out: {data.get('bytes_out', 0)} bytes in {data.get('frames_out', 0)} frames, events {data.get('events_out', {})}")
+    fanout, wait = data.get("fanout_ms", {}), data.get("queue_wait_ms", {})
+    print(f"Broadcast fan-out: p50 <= {fanout.get('p50')} ms, p99 <= {fanout.get('p99')} ms")
+    print(f"Send queue wait:   p50 <= {wait.get('p50')} ms, p99 <= {wait.get('p99')} ms")
+    print(f"Handler p99 (ms):  {data.get('handler_p99_ms', {})}")
+    print(f"Event loop lag p99 <= {data.get('loop_lag_p99_ms')} ms")
+    print(f"Deepest send queues: {', '.join(f'{name} {depth}' for name, depth in data.get('deepest_queues', [])) or 'none'}")
+    print(f"Throttled: {data.get('throttled') or 'nothing'}")
+    print("---------------------------")
+
+
+@EVENTS.on("whisper_received")
+async def on_whisper_received(ctx, data):
+    from_user = data.get("from", "unknown")
+    message = data.get("message", "")
+    play_notification_sound(config.NOTIFICATION_SOUND)
+    print(f"\n[Whisper from {from_user}] {message}")
+
+
+@EVENTS.on("battle")
+async def on_battle(ctx, data):
+    # One event per room and tick with every hit, defeat and respawn
+    for hit in data.get("hits", []):
+        from_user, to_user = hit.get("from"), hit.get("to")
+        if to_user == ctx.user_name:
+            play_notification_sound(config.NOTIFICATION_SOUND)
+            print(f"\n{from_user} hits you with {hit.get('atack')} (-{hit.get('damage')}). Life: {hit.get('life')}")
+        elif from_user == ctx.user_name:
+            print(f"\nYou hit {to_user} with {hit.get('atack')} (-{hit.get('damage')}). {to_user}'s life: {hit.get('life')}")
+        else:
+            print(f"\n[BATTLE] {from_user} hits {to_user} with {hit.get('atack')}. {to_user}'s life: {hit.get('life')}")
+    for name in data.get("defeated", []):
+        if name == ctx.user_name:
+            print(f"\n[BATTLE] You have been defeated! You'll respawn in {config.BATTLE_RESPAWN_SECONDS}s.")
+        else:
+            print(f"\n[BATTLE] {name} has been defeated!")
+    for name in data.get("respawned", []):
+        if name == ctx.user_name:
+            print("\n[BATTLE] You are back with full life.")
+        else:
+            print(f"\n[BATTLE] {name} is back with full life.")
+
+
+@EVENTS.on("atack_error", "whisper_error")
+async def on_send_error(ctx, data):
+    # Error sending a whisper or an atack
+    error_message = data.get("message", "Unknown error")
+    print(f"\n[ERROR] {error_message}")
+
+
+async def receive_messages(websocket, user_name, connection=None):
+    "websocket: WebSocket connection object. connection: Connection counting frames for session resume."
+    ctx = Receiver(websocket, user_name, connection)
+    render_task = asyncio.create_task(ctx.renderer.run())
     try:
         async for message_str in websocket:
+            binary = isinstance(message_str, bytes)
+            if binary and (not ctx.packed or ctx.transfers.expects(message_str)):
+                if connection is not None:
+                    # Not numbered: chunks are not kept for session resume
+                    connection.inbound.add(1, 1)
+                # Image chunk of a transfer announced by image_start
+                try:
+                    ctx.transfers.feed(message_str)
+                except TransferError as e:
+                    print(f"\n[ERROR] Image transfer failed: {e}")
+                continue
+
             try:
-                data = json.loads(message_str) 
-            except json.JSONDecodeError:
-                print(f"[SERVER NOTIFICATION] {message_str}")
+                # Packed events are binary, text frames are always JSON
+                data = protocol.unpack(message_str) if binary else json.loads(message_str)
+            except (json.JSONDecodeError, protocol.DecodeError):
+                data = None
+            if data is None:
+                if connection is not None:
+                    connection.received(None)
+                    connection.inbound.add(1, 1)
+                if not binary:
+                    print(f"[SERVER NOTIFICATION] {message_str}")
                 continue
-            
-            if data.get("type") == "image_data":
-                # Skip rendering if the sender is the current user (already displayed locally)
-                if data.get('user') != user_name:
-                    play_notification_sound(config.NOTIFICATION_SOUND)
-                    render_image_from_data(data)
-            
-            elif data.get("type") == "message":
-                # Skip displaying if the sender is the current user (already displayed locally)
-                if data.get('user') != user_name:
-                    play_notification_sound(config.NOTIFICATION_SOUND)
-                    print(f"{data.get('user', 'unknown')}: {data.get('text', '')}")
-            
-            elif data.get("type") == "notification":
-                action = data.get("action", "performed an action")
-                print(f"[NOTIFICATION] {data.get('user', '')} {action}.")
-            
-            elif data.get("type") == "command":
-                name = data.get("name", "unknown")
-                user = data.get("user", "someone")
-                
-                if name == "quit":
-                    print(f"\n[SERVER] {user} has disconnected.")
-                else:
-                    print(f"\n[SERVER] Command '{name}' received from {user}.")
-            
-            elif data.get("type") == "user_list":
-                # Display online users with life information
-                users = data.get("users", [])
-                count = data.get("count", 0)
-                print(f"\n--- ONLINE USERS ({count}) ---")
-                for user in users:
-                    name = user.get("name", "unknown")
-                    life = user.get("life", "?")
-                    indicator = " (you)" if name == user_name else ""
-                    print(f"  • {name}{indicator} - Life: {life}")
-                print("---------------------------")
-            
-            elif data.get("type") == "whisper_received":
-                from_user = data.get("from", "unknown")
-                message = data.get("message", "")
-                play_notification_sound(config.NOTIFICATION_SOUND)
-                print(f"\n[Whisper from {from_user}] {message}")
-            
-            elif data.get("type") == "atack_received":
-                from_user = data.get("from")
-                atack = data.get("atack")
-                play_notification_sound(config.NOTIFICATION_SOUND)
-                print(f"\n{from_user} hits you with {atack}.")
-            
-            elif data.get("type") == "whisper_error":
-                # Error sending whisper
-                error_message = data.get("message", "Unknown error")
-                print(f"\n[ERROR] {error_message}")
+
+            # A batch frame carries several events, handled in order
+            events = batching.unpack(data)
+            if connection is not None:
+                connection.inbound.add(1, len(events))
+            for data in events:
+                if connection is not None:
+                    connection.received(data)
+                if isinstance(data, dict):
+                    await EVENTS.dispatch(data.get("type"), ctx, data)
             
     except websockets.exceptions.ConnectionClosed:
-        print("\n[SERVER] Connection closed. Press Enter to exit.")
+        print("\n[SERVER] Connection closed.")
     except Exception as e:
         print(f"\n[ERROR] An error occurred while receiving data: {e}")
+    finally:
+        render_task.cancel()
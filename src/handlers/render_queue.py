@@ -0,0 +1,145 @@
+"""Off-loop rendering of received images.
+
+Decoding and rendering run in a process pool, so a large image never blocks
+the receive loop. Frames are written in the order the images arrived and
+at most ``config.MAX_PENDING_RENDERS`` images wait at a time. When a burst
+arrives faster than it can be drawn, the oldest waiting images are skipped.
+"""
+import asyncio
+import multiprocessing
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src.core import config
+from src.utils import render_cache
+
+_EXECUTOR = None
+
+
+def get_executor():
+    """Process pool shared by every RenderQueue, created on first use."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(
+            max_workers=config.RENDER_WORKERS,
+            # spawn: forking a process that already runs prompt_toolkit threads is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _EXECUTOR
+
+
+def show_frame(user, file_name, frame):
+    from src.utils.image_utils import write_frame
+
+    # Write directly to real stdout to bypass prompt_toolkit
+    sys.__stdout__.write(f"\n[{user}] Displaying image '{file_name}'...\n")
+    sys.__stdout__.flush()
+
+    old_stdout = sys.stdout
+    sys.stdout = sys.__stdout__
+    try:
+        write_frame(frame)
+    finally:
+        sys.stdout = old_stdout
+
+    sys.__stdout__.write("\n")
+    sys.__stdout__.flush()
+
+
+async def render(image_bytes, digest, mode=None, colors=None):
+    """Render one image in the process pool, through the render cache.
+
+    Returns:
+        bytes: The frame, or None if the image can't be decoded.
+    """
+    from src.utils.image_utils import render_frame, terminal_target_size
+
+    mode = mode or config.IMAGE_RENDER_MODE
+    colors = colors or config.IMAGE_COLOR_MODE
+    columns, lines = terminal_target_size()
+    key = (digest, columns, lines, mode, colors)
+    frame = render_cache.CACHE.get(key)
+    if frame is None:
+        frame = await asyncio.get_running_loop().run_in_executor(
+            get_executor(), render_frame, image_bytes, columns, lines, mode, colors)
+        if frame is not None:
+            render_cache.CACHE.put(key, frame)
+    return frame
+
+
+class RenderQueue:
+    """Ordered, bounded queue of images being rendered by the process pool."""
+
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending or config.MAX_PENDING_RENDERS
+        self.pending = deque()  # (user, file_name, cache key, future)
+        self.ready = asyncio.Event()
+        self.skipped = 0
+
+    def submit(self, user, file_name, image_bytes, digest):
+        """Start rendering an image without waiting for it.
+
+        ``image_bytes`` may be None when only a cached frame can be used.
+
+        Returns:
+            bool: False if nothing was queued (no bytes and no cached frame).
+        """
+        # Imported on the first received image rather than at client startup
+        from src.utils.image_utils import render_frame, terminal_target_size
+
+        mode = config.IMAGE_RENDER_MODE
+        colors = config.IMAGE_COLOR_MODE
+        columns, lines = terminal_target_size()
+        key = (digest, columns, lines, mode, colors)
+
+        loop = asyncio.get_running_loop()
+        frame = render_cache.CACHE.get(key) if digest else None
+        if frame is not None:
+            future = loop.create_future()
+            future.set_result(frame)
+        elif image_bytes is None:
+            return False
+        else:
+            future = loop.run_in_executor(
+                get_executor(), render_frame, image_bytes, columns, lines, mode, colors)
+
+        if len(self.pending) >= self.max_pending:
+            *_, oldest = self.pending.popleft()
+            oldest.cancel()
+            self.skipped += 1
+
+        self.pending.append((user, file_name, key, future))
+        self.ready.set()
+        return True
+
+    async def run(self):
+        """Write finished frames in arrival order until cancelled."""
+        while True:
+            if not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            user, file_name, key, future = self.pending.popleft()
+            try:
+                frame = await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    continue
+                raise
+            except Exception as e:
+                print(f"\n[ERROR] Failed to render image: {e}")
+                continue
+
+            if self.skipped:
+                print(f"\n[{self.skipped} image(s) skipped: arriving faster than they can be drawn]")
+                self.skipped = 0
+
+            if frame is None:
+                print(f"\n[ERROR] Failed to render image '{file_name}' from {user}.")
+                continue
+
+            if key[0]:
+                render_cache.CACHE.put(key, frame)
+            show_frame(user, file_name, frame)
@@ -0,0 +1,170 @@
+"""Authoritative battle engine: atacks resolved in fixed ticks.
+
+An atack used to be applied as soon as it arrived, and every hit sent its
+own ``atack_received``, ``atack_sent`` and ``life_update`` plus a notification
+to everyone in the target's room. Under heavy PvP that is a fan-out per hit.
+
+Now the server queues hits and resolves them every ``config.BATTLE_TICK_MS``.
+Each room with something happening gets one ``battle`` event per tick:
+
+    {"type": "battle", "room": "lobby", "tick": 42,
+     "hits": [{"from": "alice", "to": "bob", "atack": "punch", "damage": 8, "life": 92}],
+     "defeated": [], "respawned": []}
+
+so spectator traffic follows the tick rate, not the atack rate. Attackers
+outside the room get the same event directly.
+
+Damage comes from ``config.ATACKS``. After an atack, the attacker must wait
+``damage / config.BATTLE_DAMAGE_PER_SECOND`` seconds before the next one,
+which caps anyone's damage per second whatever atack they pick. A user whose
+life reaches 0 can't atack or be atacked until it respawns with full life
+``config.BATTLE_RESPAWN_SECONDS`` later. The deadline is kept in the session
+as ``respawn_at`` so a worker that takes the session over can reschedule it.
+
+Cooldowns are checked on the attacker's worker. Hits are resolved on the
+worker holding the target, which owns its life points, so in multi-worker
+mode a room may get one ``battle`` event per tick from each worker.
+"""
+import asyncio
+import time
+from collections import defaultdict
+
+from src.core import config
+
+MAX_LIFE = 100  # life of a new session (see Registry.register)
+
+
+class BattleEngine:
+    def __init__(self, registry, cluster):
+        self.registry = registry
+        self.cluster = cluster
+        self.ready_at = {}      # attacker name -> time.monotonic() of its next atack
+        self.pending = []       # (attacker, target, atack) hits to resolve next tick
+        self.respawns = []      # (name, respawn_at) of defeated users due back next tick
+        self.ticks = 0
+        self.wake = asyncio.Event()
+        cluster.on("atack", lambda event, payload: self.hit(event["from"], event["to"], event["atack"]))
+
+    def attack(self, attacker, target, atack):
+        """Check an atack from a local user and queue it where the target lives.
+
+        Returns:
+            str: Why the atack was refused, or None if it was queued.
+        """
+        damage = config.ATACKS.get(atack)
+        if damage is None:
+            return f"Unknown atack '{atack}'."
+        target_worker = self.cluster.worker_of(target)
+        if target_worker is None:
+            return f"User '{target}' not found or offline."
+        if self._life(attacker) == 0:
+            return "You have been defeated, wait to respawn."
+        if self._life(target) == 0:
+            return f"{target} is already defeated."
+        now = time.monotonic()
+        wait = self.ready_at.get(attacker, 0) - now
+        if wait > 0:
+            return f"Still recovering, ready in {wait:.1f}s."
+        self.ready_at[attacker] = now + damage / config.BATTLE_DAMAGE_PER_SECOND
+
+        if target_worker == self.cluster.worker_id:
+            self.hit(attacker, target, atack)
+        else:
+            self.cluster.send_to_worker(target_worker, {
+                "op": "atack", "from": attacker, "to": target, "atack": atack
+            })
+        return None
+
+    def hit(self, attacker, target, atack):
+        """Queue a hit on a user of this worker."""
+        self.pending.append((attacker, target, atack))
+        self.wake.set()
+
+    def forget(self, name):
+        """Drop the cooldown of a user that left."""
+        self.ready_at.pop(name, None)
+
+    def _session(self, name):
+        websocket = self.registry.find(name)
+        if websocket is not None:
+            return self.registry.get(websocket)
+        return self.registry.find_remote(name)
+
+    def _life(self, name):
+        session = self._session(name)
+        return session['life'] if session else None
+
+    def adopt(self, session):
+        """Reschedule the respawn of a defeated session taken over from another worker."""
+        at = session.get('respawn_at')
+        if session['life'] == 0 and at is not None:
+            delay = max(at - time.time(), 0)
+            asyncio.get_running_loop().call_later(delay, self._respawn, session['name'], at)
+
+    def _respawn(self, name, at):
+        self.respawns.append((name, at))
+        self.wake.set()
+
+    async def run(self):
+        """Resolve queued hits once per tick, sleeping while nothing happens."""
+        while True:
+            await self.wake.wait()
+            # Let the tick's hits pile up
+            await asyncio.sleep(config.BATTLE_TICK_MS / 1000)
+            self.wake.clear()
+            self.tick()
+
+    def tick(self):
+        self.ticks += 1
+        hits, self.pending = self.pending, []
+        respawns, self.respawns = self.respawns, []
+        deltas = {}                   # room -> battle event
+        outsiders = defaultdict(set)  # room -> attackers who are elsewhere
+        lives = {}                    # user -> life after this tick
+
+        def delta(room):
+            if room not in deltas:
+                deltas[room] = {
+                    "type": "battle", "room": room, "tick": self.ticks,
+                    "hits": [], "defeated": [], "respawned": []
+                }
+            return deltas[room]
+
+        for name, at in respawns:
+            websocket = self.registry.find(name)
+            session = self.registry.get(websocket) if websocket is not None else None
+            # Gone, or a timer left over from an earlier defeat
+            if session is None or session.get('respawn_at') != at:
+                continue
+            del session['respawn_at']
+            session['life'] = lives[name] = MAX_LIFE
+            delta(session['room'])["respawned"].append(name)
+
+        loop = asyncio.get_running_loop()
+        for attacker, target, atack in hits:
+            websocket = self.registry.find(target)
+            session = self.registry.get(websocket) if websocket is not None else None
+            # Gone, or defeated by an earlier hit of this tick
+            if session is None or session['life'] == 0:
+                continue
+            damage = config.ATACKS.get(atack, 0)
+            session['life'] = lives[target] = max(session['life'] - damage, 0)
+            room = session['room']
+            event = delta(room)
+            event["hits"].append({
+                "from": attacker, "to": target, "atack": atack, "damage": damage, "life": session['life']
+            })
+            attacker_session = self._session(attacker)
+            if attacker_session is not None and attacker_session['room'] != room:
+                outsiders[room].add(attacker)
+            if session['life'] == 0:
+                event["defeated"].append(target)
+                session['respawn_at'] = at = time.time() + config.BATTLE_RESPAWN_SECONDS
+                loop.call_later(config.BATTLE_RESPAWN_SECONDS, self._respawn, target, at)
+
+        for name, life in lives.items():
+            self.cluster.announce_life(name, life)
+        for room, event in deltas.items():
+            self.cluster.broadcast(event, room=room)
+            for name in outsiders[room]:
+                self.cluster.deliver(name, event)
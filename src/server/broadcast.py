@@ -0,0 +1,395 @@
+"""Outbound fan-out for the chat server.
+
+Every connection gets a bounded queue drained by its own writer task, so a
+broadcast is one encode plus one ``put_nowait`` per recipient and a slow or
+stalled client can never hold up the handler that produced the event.
+
+Text payloads are queued as UTF-8 bytes and written as text frames, which
+lets the websocket library skip re-encoding the same string for every
+recipient. Binary payloads (image chunks) are queued as-is. Connections that
+negotiated ``chat.msgpack`` (see ``src.core.protocol``) get their events
+packed in binary frames instead; a broadcast encodes an event at most once
+per protocol, whatever the number of recipients.
+
+With batching on (``config.BATCH_WINDOW_MS``), the writer waits that long
+after the first queued frame and sends the small events that piled up as
+one batch frame (see ``src.core.batching``).
+
+Image transfers are the exception to the overflow policy: one missing a
+chunk can't complete, so they go through ``broadcast_wait``, which waits for
+room in full queues instead and slows the upload down to its slowest
+receiver. Frames queued that way (also by ``send_wait``) are never evicted
+for a later event.
+
+While a history replay is being fetched, the outbox is held (``hold_outbox``):
+live frames wait aside and are queued behind the replay pages, which are
+queued ``early``, once ``release_outbox`` is called.
+
+An outbox can also record what it sends into a session's replay buffer
+(see ``src.server.sessions``). When the connection drops, the outbox is
+detached: it stops writing and records every later frame, so the client
+can catch up when it resumes. Image chunks are not recorded: a resumed
+client starts with no transfer in progress and could not use them, and at
+64 KiB each they would push the chat frames out of the buffer.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from websockets.exceptions import ConnectionClosed
+
+from src.core import batching
+from src.core import config
+from src.core import protocol
+from src.core import serialization
+from src.server import metrics
+
+log = logging.getLogger("chat.broadcast")
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+OUTBOXES = {}
+
+# Frames vs events written by every outbox of this process
+METER = batching.RateMeter()
+
+
+class Outbox:
+    """Bounded send queue and writer task for a single websocket."""
+
+    def __init__(self, websocket, maxsize=None, policy=None, replay=None):
+        self.websocket = websocket
+        self.packed = websocket is not None and protocol.is_packed(websocket.subprotocol)
+        self.policy = policy or config.SEND_QUEUE_OVERFLOW
+        self.queue = asyncio.Queue(maxsize or config.SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.kept = 0             # queued frames the overflow policy must not evict
+        self.replay = replay      # ReplayBuffer of a resumable session
+        self.holds = 0            # history replays in progress
+        self.held = None          # frames waiting for them, see hold()
+        self.detached = websocket is None
+        self.closed = False
+        self.task = None if self.detached else asyncio.create_task(self._writer())
+
+    def put(self, payload, text=True, queued=None, keep=False, record=True, early=False):
+        """Queue an encoded payload without waiting.
+
+        Args:
+            queued: ``time.perf_counter()`` when the payload was produced,
+                for the queue wait metric (defaults to now).
+            keep: Never evict the payload to make room for a later one.
+            record: Record the payload into the replay buffer, if any.
+            early: Queue ahead of the frames held back by ``hold``.
+
+        Returns:
+            bool: False if the payload (or an older one) had to be dropped.
+        """
+        if self.held is not None and not early:
+            self.held.append((payload, text, queued or time.perf_counter(), keep, record))
+            return True
+        if self.detached:
+            if record:
+                self.replay.record(payload, text)
+            return True
+        item = (payload, text, self.replay if record else None, queued or time.perf_counter(), keep)
+        try:
+            self.queue.put_nowait(item)
+            self.kept += keep
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        self.dropped += 1
+        # With frames to keep in the queue, the new one is dropped instead
+        if self.policy == DROP_OLDEST and not self.kept:
+            self.queue.get_nowait()
+            self.queue.put_nowait(item)
+        elif self.policy == DISCONNECT:
+            log.warning("[BROADCAST] Disconnecting slow consumer %s", self.websocket.remote_address)
+            self.close()
+            asyncio.create_task(self.websocket.close(1008, "slow consumer"))
+        return False
+
+    async def put_wait(self, payload, text=True, record=True, early=False):
+        """Queue a payload, waiting for room instead of applying the overflow policy."""
+        if self.held is not None and not early:
+            self.held.append((payload, text, time.perf_counter(), True, record))
+        elif self.detached:
+            if record:
+                self.replay.record(payload, text)
+        elif not self.closed:
+            replay = self.replay if record else None
+            await self.queue.put((payload, text, replay, time.perf_counter(), True))
+            self.kept += 1
+
+    def hold(self):
+        """Set every later frame aside until ``release``, except early ones."""
+        self.holds += 1
+        if self.held is None:
+            self.held = deque()
+
+    async def release(self):
+        """Queue the frames set aside by ``hold``, in order."""
+        self.holds -= 1
+        # Still held while draining, so later frames can't overtake
+        while self.held and not self.holds:
+            payload, text, queued, keep, record = self.held.popleft()
+            if keep:
+                await self.put_wait(payload, text, record, early=True)
+            else:
+                self.put(payload, text, queued, record=record, early=True)
+        if not self.holds:
+            self.held = None
+
+    def _record(self, payload, text, replay, queued, keep):
+        self.kept -= keep
+        metrics.QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued)
+        # Recorded before sending: a frame lost with the connection is replayed
+        if replay is not None:
+            replay.record(payload, text)
+        return payload, text
+
+    @staticmethod
+    def _sent(payload, events=1):
+        METER.add(1, events)
+        metrics.FRAMES_SENT.inc()
+        metrics.BYTES_SENT.inc(amount=len(payload))
+
+    def _take(self):
+        return self._record(*self.queue.get_nowait())
+
+    async def _writer(self):
+        try:
+            while True:
+                payload, text = self._record(*await self.queue.get())
+                window = batching.window()
+                if window:
+                    # Let a burst build up into one frame
+                    await asyncio.sleep(window)
+                    await self._send_batched([(payload, text)])
+                    continue
+                await self.websocket.send(payload, text=text)
+                self._sent(payload)
+                # Flush whatever piled up meanwhile without going back to sleep.
+                while not self.queue.empty():
+                    payload, text = self._take()
+                    await self.websocket.send(payload, text=text)
+                    self._sent(payload)
+        except ConnectionClosed:
+            # Nothing more can be written: don't let frames pile up or put_wait block
+            if self.replay is not None:
+                self._record_pending()
+            else:
+                self._discard_pending()
+        except Exception as e:
+            log.error("[BROADCAST] Writer error: %s", e)
+
+    async def _send_batched(self, items):
+        while not self.queue.empty():
+            items.append(self._take())
+        batch = []
+        for payload, text in items:
+            if batching.batchable(payload, text) and len(batch) < config.BATCH_MAX_EVENTS:
+                batch.append(payload)
+                continue
+            await self._send_batch(batch)
+            batch = []
+            if batching.batchable(payload, text):
+                batch.append(payload)
+            else:
+                await self.websocket.send(payload, text=text)
+                self._sent(payload)
+        await self._send_batch(batch)
+
+    async def _send_batch(self, batch):
+        if not batch:
+            return
+        payload = batch[0] if len(batch) == 1 else batching.pack(batch)
+        await self.websocket.send(payload, text=True)
+        self._sent(payload, len(batch))
+
+    def _record_pending(self):
+        while not self.queue.empty():
+            self._take()
+        self.detached = True
+
+    def _discard_pending(self):
+        self.closed = True
+        # Also wakes up any put_wait blocked on a full queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.kept = 0
+
+    def detach(self):
+        """Stop writing to the connection and record every frame from now on."""
+        self.task.cancel()
+        self._record_pending()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self._discard_pending()
+
+
+def encode(event, packed=False):
+    """Serialize an event once so it can be shared by every recipient.
+
+    Args:
+        event: Event dict, or JSON text (str or bytes) to relay as is.
+        packed: Encode for ``chat.msgpack`` connections.
+
+    Returns:
+        tuple: ``(payload bytes, True for a text frame)``.
+    """
+    if packed:
+        if isinstance(event, (str, bytes)):
+            try:
+                event = serialization.decode(event)
+            except serialization.DecodeError:
+                # Plain text goes out as is, whatever the protocol
+                return encode(event)
+        return protocol.pack(event), False
+    if isinstance(event, bytes):
+        return event, True
+    if isinstance(event, str):
+        return event.encode("utf-8"), True
+    return serialization.encode(event), True
+
+
+def open_outbox(websocket):
+    OUTBOXES[websocket] = Outbox(websocket)
+
+
+def open_detached_outbox(key, replay):
+    """Record frames for a session that has no connection yet."""
+    OUTBOXES[key] = Outbox(None, replay=replay)
+
+
+def close_outbox(websocket):
+    outbox = OUTBOXES.pop(websocket, None)
+    if outbox is not None:
+        outbox.close()
+
+
+def attach_replay(websocket, replay):
+    """Record every frame queued from now on into ``replay``."""
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        outbox.replay = replay
+
+
+def hold_outbox(websocket):
+    """Hold back every frame but ``early`` ones until ``release_outbox``."""
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        outbox.hold()
+
+
+async def release_outbox(websocket):
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        await outbox.release()
+
+
+def detach_outbox(websocket):
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None and not outbox.detached:
+        outbox.detach()
+
+
+def send(websocket, event):
+    """Queue an event for a single connection."""
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        payload, text = encode(event, outbox.packed)
+        outbox.put(payload, text)
+        metrics.EVENTS_SENT.inc(metrics.event_type(payload, packed=not text))
+
+
+async def send_wait(websocket, event, binary=False, early=False):
+    """Queue an event for a single connection, waiting while its queue is full.
+
+    Used for bulk streams (e.g. media fetches) that must not lose frames.
+    ``early`` events go ahead of the frames held back by ``hold_outbox``.
+    """
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        payload, text = (event, False) if binary else encode(event, outbox.packed)
+        metrics.EVENTS_SENT.inc(metrics.event_type(payload, binary, packed=not (binary or text)))
+        await outbox.put_wait(payload, text, record=not binary, early=early)
+
+
+async def send_frames(websocket, frames):
+    """Queue already encoded ``(seq, payload, text)`` frames, waiting for room."""
+    outbox = OUTBOXES.get(websocket)
+    if outbox is not None:
+        for _, payload, text in frames:
+            await outbox.put_wait(payload, text)
+
+
+def broadcast(recipients, event, exclude=(), binary=False):
+    """Queue one encoded copy of ``event`` for every recipient.
+
+    Args:
+        recipients: Iterable of websockets.
+        event: Event dict, or JSON text to relay as is.
+        exclude: Websockets that should not receive the event.
+        binary: Send ``event`` (bytes) as a binary frame to everyone.
+    """
+    start = time.perf_counter()
+    encoded = {}  # packed -> (payload, text), encoded on first use
+    if binary:
+        encoded[False] = encoded[True] = (event, False)
+    queued = 0
+    for websocket in recipients:
+        if websocket in exclude:
+            continue
+        outbox = OUTBOXES.get(websocket)
+        if outbox is not None:
+            encoding = encoded.get(outbox.packed)
+            if encoding is None:
+                encoding = encoded[outbox.packed] = encode(event, outbox.packed)
+            outbox.put(*encoding, start, record=not binary)
+            queued += 1
+    if queued:
+        packed, (payload, text) = next(iter(encoded.items()))
+        metrics.EVENTS_SENT.inc(metrics.event_type(payload, binary, packed=packed and not text), amount=queued)
+    metrics.FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+
+async def broadcast_wait(recipients, event, exclude=(), binary=False):
+    """Like ``broadcast``, but waits for room in full queues instead of dropping.
+
+    Recipients with room get the event right away; the others are waited on
+    in turn.
+    """
+    start = time.perf_counter()
+    encoded = {}  # packed -> (payload, text), encoded on first use
+    if binary:
+        encoded[False] = encoded[True] = (event, False)
+    full = []
+    queued = 0
+    for websocket in recipients:
+        if websocket in exclude:
+            continue
+        outbox = OUTBOXES.get(websocket)
+        if outbox is None:
+            continue
+        encoding = encoded.get(outbox.packed)
+        if encoding is None:
+            encoding = encoded[outbox.packed] = encode(event, outbox.packed)
+        if outbox.queue.full() and not outbox.detached:
+            full.append((outbox, encoding))
+        else:
+            outbox.put(*encoding, start, keep=True, record=not binary)
+        queued += 1
+    if queued:
+        packed, (payload, text) = next(iter(encoded.items()))
+        metrics.EVENTS_SENT.inc(metrics.event_type(payload, binary, packed=packed and not text), amount=queued)
+    metrics.FANOUT_SECONDS.observe(time.perf_counter() - start)
+    for outbox, encoding in full:
+        await outbox.put_wait(*encoding, record=not binary)
+
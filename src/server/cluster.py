@@ -0,0 +1,412 @@
+"""Multi-worker mode: presence replication and a message bus between workers.
+
+With ``--workers N`` the server forks N worker processes that all accept
+connections on the same port (SO_REUSEPORT). Each worker only holds the
+websockets of its own clients, so everything that may involve a client on
+another worker goes through the cluster bus:
+
+* presence (``join``/``leave``/``life``) is replicated to every worker, so the
+  registry can resolve any user name or list all users without a round trip;
+* ``deliver`` hands an event to the worker holding a given user;
+* ``broadcast`` fans an event out on every worker; ``broadcast_wait`` does
+  the same for image transfers, which must not lose a frame.
+
+The bus is a pluggable ``Backend`` with Redis-like publish/subscribe
+semantics. ``LocalBackend`` is used for a single worker; ``UnixSocketBackend``
+talks to a small broker process over a unix socket, so no external service
+is needed. Other backends can be added with ``register_backend``.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import tempfile
+
+from src.core import config
+from src.server.broadcast import send, broadcast, broadcast_wait
+
+log = logging.getLogger("chat.cluster")
+
+# Frame on the unix socket: header length, payload length, JSON header, raw payload
+FRAME_HEADER = struct.Struct("!II")
+
+BROADCAST_CHANNEL = "all"
+
+
+def worker_channel(worker_id):
+    return f"worker.{worker_id}"
+
+
+class Backend:
+    """Publish/subscribe transport between workers."""
+
+    async def start(self, worker_id, on_message):
+        """Subscribe to the broadcast channel and this worker's channel.
+
+        Args:
+            worker_id: Id of the local worker.
+            on_message: Callable ``(event, payload)`` for every message
+                published by another worker.
+        """
+        raise NotImplementedError
+
+    def publish(self, channel, event, payload=b""):
+        """Publish a JSON-serializable ``event`` plus optional raw bytes.
+
+        Must not block: called from the websocket handlers' hot path.
+        Messages from one worker must arrive in the order they were published.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBackend(Backend):
+    """Single worker: there is nobody to talk to."""
+
+    async def start(self, worker_id, on_message):
+        pass
+
+    def publish(self, channel, event, payload=b""):
+        pass
+
+
+async def read_frame(reader):
+    header_size, payload_size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return header, payload
+
+
+def pack_frame(header, payload=b""):
+    encoded = json.dumps(header).encode("utf-8")
+    return FRAME_HEADER.pack(len(encoded), len(payload)) + encoded + payload
+
+
+class UnixSocketBackend(Backend):
+    """Client of the unix socket broker started by ``run_cluster``."""
+
+    def __init__(self, path=None):
+        self.path = path or cluster_socket_path()
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    async def start(self, worker_id, on_message):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(pack_frame({
+            "op": "subscribe",
+            "channels": [BROADCAST_CHANNEL, worker_channel(worker_id)]
+        }))
+        await self.writer.drain()
+        self.task = asyncio.create_task(self._read(on_message))
+
+    async def _read(self, on_message):
+        try:
+            while True:
+                header, payload = await read_frame(self.reader)
+                try:
+                    on_message(header["event"], payload)
+                except Exception as e:
+                    log.error("[CLUSTER] Failed to handle %s: %s", header.get('event'), e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error("[CLUSTER] Lost connection to the broker.")
+
+    def publish(self, channel, event, payload=b""):
+        self.writer.write(pack_frame({"op": "publish", "channel": channel, "event": event}, payload))
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+BACKENDS = {
+    "local": LocalBackend,
+    "unix": UnixSocketBackend,
+}
+
+
+def register_backend(name, backend_class):
+    """Make a Backend subclass selectable through config.CLUSTER_BACKEND."""
+    BACKENDS[name] = backend_class
+
+
+def cluster_socket_path():
+    return config.CLUSTER_SOCKET or os.path.join(tempfile.gettempdir(), f"chat-cmd-{config.SERVER_PORT}.sock")
+
+
+async def run_broker(path):
+    """Relay published frames to every other connection subscribed to the channel."""
+    subscribers = {}  # channel -> set of StreamWriters
+
+    async def serve(reader, writer):
+        channels = []
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                if header["op"] == "subscribe":
+                    channels = header["channels"]
+                    for channel in channels:
+                        subscribers.setdefault(channel, set()).add(writer)
+                elif header["op"] == "publish":
+                    frame = pack_frame(header, payload)
+                    for subscriber in subscribers.get(header["channel"], ()):
+                        if subscriber is not writer:
+                            subscriber.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for channel in channels:
+                subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(serve, path)
+    async with server:
+        await server.serve_forever()
+
+
+class Cluster:
+    """This worker's view of the cluster: routing, presence and fan-out."""
+
+    def __init__(self, registry, worker_id=0, backend=None):
+        self.registry = registry
+        self.worker_id = worker_id
+        self.backend = backend or LocalBackend()
+        self.handlers = {
+            "join": self._on_join,
+            "leave": self._on_leave,
+            "life": self._on_life,
+            "room": self._on_room,
+            "sync": self._on_sync,
+            "deliver": self._on_deliver,
+            "broadcast": self._on_broadcast,
+        }
+        self.waiting = asyncio.Queue()  # (event, payload) from broadcast_wait on other workers
+        self.relay_task = None
+
+    def on(self, op, handler):
+        """Register ``handler(event, payload)`` for a custom bus operation."""
+        self.handlers[op] = handler
+
+    async def start(self):
+        self.relay_task = asyncio.create_task(self._relay_waiting())
+        await self.backend.start(self.worker_id, self._dispatch)
+        # Ask the other workers for the users they already hold
+        self.publish(BROADCAST_CHANNEL, {"op": "sync", "worker": self.worker_id})
+
+    def _dispatch(self, event, payload):
+        handler = self.handlers.get(event.get("op"))
+        if handler is not None:
+            handler(event, payload)
+
+    def publish(self, channel, event, payload=b""):
+        self.backend.publish(channel, event, payload)
+
+    # Presence
+
+    def announce_join(self, session):
+        self.publish(BROADCAST_CHANNEL, {
+            "op": "join", "worker": self.worker_id,
+            "name": session['name'], "life": session['life'], "room": session['room']
+        })
+
+    def announce_leave(self, name):
+        self.publish(BROADCAST_CHANNEL, {"op": "leave", "name": name})
+
+    def announce_life(self, name, life):
+        self.publish(BROADCAST_CHANNEL, {"op": "life", "name": name, "life": life})
+
+    def announce_room(self, name, room):
+        self.publish(BROADCAST_CHANNEL, {"op": "room", "name": name, "room": room})
+
+    def _on_join(self, event, payload):
+        self.registry.add_remote({
+            'name': event["name"], 'life': event["life"],
+            'room': event["room"], 'worker': event["worker"]
+        })
+
+    def _on_leave(self, event, payload):
+        self.registry.remove_remote(event["name"])
+
+    def _on_life(self, event, payload):
+        session = self.registry.find_remote(event["name"])
+        if session is not None:
+            session['life'] = event["life"]
+
+    def _on_room(self, event, payload):
+        self.registry.move_remote(event["name"], event["room"])
+
+    def _on_sync(self, event, payload):
+        for name, websocket in self.registry.by_name.items():
+            session = self.registry.get(websocket)
+            self.publish(worker_channel(event["worker"]), {
+                "op": "join", "worker": self.worker_id,
+                "name": name, "life": session['life'], "room": session['room']
+            })
+
+    # Routing
+
+    def worker_of(self, name):
+        """Id of the worker holding user ``name``, or None if nobody does."""
+        if self.registry.find(name) is not None:
+            return self.worker_id
+        session = self.registry.find_remote(name)
+        return session['worker'] if session else None
+
+    def deliver(self, name, event):
+        """Send an event to user ``name`` wherever it is connected.
+
+        Returns:
+            bool: False if no worker holds that user.
+        """
+        websocket = self.registry.find(name)
+        if websocket is not None:
+            send(websocket, event)
+            return True
+        session = self.registry.find_remote(name)
+        if session is None:
+            return False
+        self.publish(worker_channel(session['worker']), {"op": "deliver", "to": name, "event": event})
+        return True
+
+    def send_to_worker(self, worker_id, event):
+        """Run a custom bus operation on another worker."""
+        self.publish(worker_channel(worker_id), event)
+
+    def _on_deliver(self, event, payload):
+        websocket = self.registry.find(event["to"])
+        if websocket is not None:
+            send(websocket, event["event"])
+
+    def broadcast(self, event, exclude=(), room=None):
+        """Fan an event out to the members of a room on every worker.
+
+        Args:
+            event: Event dict or encoded text payload.
+            exclude: Local websockets or user names that must not get it.
+            room: Only deliver to this room; None means every connection.
+        """
+        exclude_ws, exclude_names = self._exclusions(exclude)
+        broadcast(self._recipients(room), event, exclude=exclude_ws)
+
+        if isinstance(self.backend, LocalBackend):
+            return
+        # Other workers holding no member of the room simply find nobody to send to
+        if isinstance(event, bytes):
+            event = event.decode("utf-8")
+        self.publish(BROADCAST_CHANNEL, {
+            "op": "broadcast", "room": room, "exclude": exclude_names, "event": event
+        })
+
+    async def broadcast_wait(self, event, exclude=(), binary=False, room=None):
+        """Fan an event out like ``broadcast``, waiting for full local queues.
+
+        Other workers can't push back on the sender: they queue what they
+        get this way and relay it one event at a time, in order.
+
+        Args:
+            binary: Send ``event`` (bytes) as a binary frame.
+        """
+        exclude_ws, exclude_names = self._exclusions(exclude)
+        if not isinstance(self.backend, LocalBackend):
+            header = {"op": "broadcast", "room": room, "exclude": exclude_names, "wait": True}
+            if binary:
+                self.publish(BROADCAST_CHANNEL, {**header, "binary": True}, event)
+            else:
+                if isinstance(event, bytes):
+                    event = event.decode("utf-8")
+                self.publish(BROADCAST_CHANNEL, {**header, "event": event})
+        await broadcast_wait(self._recipients(room), event, exclude=exclude_ws, binary=binary)
+
+    def _exclusions(self, exclude):
+        """Local websockets and user names to exclude, from a mix of both."""
+        exclude_ws = set()
+        exclude_names = []
+        for item in exclude:
+            if isinstance(item, str):
+                exclude_names.append(item)
+                item = self.registry.find(item)
+                if item is None:
+                    continue
+            else:
+                session = self.registry.get(item)
+                if session is not None:
+                    exclude_names.append(session['name'])
+            exclude_ws.add(item)
+        return exclude_ws, exclude_names
+
+    def _recipients(self, room):
+        return self.registry if room is None else self.registry.room_members(room)
+
+    def _on_broadcast(self, event, payload):
+        if event.get("wait"):
+            self.waiting.put_nowait((event, payload))
+            return
+        exclude = {ws for ws in map(self.registry.find, event["exclude"]) if ws is not None}
+        broadcast(self._recipients(event.get("room")), event["event"], exclude=exclude)
+
+    async def _relay_waiting(self):
+        while True:
+            event, payload = await self.waiting.get()
+            exclude = {ws for ws in map(self.registry.find, event["exclude"]) if ws is not None}
+            binary = event.get("binary", False)
+            await broadcast_wait(self._recipients(event.get("room")), payload if binary else event["event"],
+                                 exclude=exclude, binary=binary)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def make_backend(workers):
+    if workers <= 1:
+        return LocalBackend()
+    return BACKENDS[config.CLUSTER_BACKEND]()
+
+
+def _broker_process(path):
+    try:
+        asyncio.run(run_broker(path))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_cluster(worker_main, workers):
+    """Start the broker and ``workers`` processes running ``worker_main(worker_id)``.
+
+    Workers share the listening port through SO_REUSEPORT, so the kernel
+    balances new connections between them.
+    """
+    context = multiprocessing.get_context("fork")
+    processes = []
+    if config.CLUSTER_BACKEND == "unix":
+        path = cluster_socket_path()
+        if os.path.exists(path):
+            os.remove(path)
+        broker = context.Process(target=_broker_process, args=(path,), daemon=True)
+        broker.start()
+        processes.append(broker)
+        # Workers connect to the broker as soon as they start
+        while not os.path.exists(path):
+            if not broker.is_alive():
+                raise RuntimeError("Cluster broker failed to start")
+            broker.join(0.05)
+
+    for worker_id in range(workers):
+        process = context.Process(target=worker_main, args=(worker_id,))
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes[1:] if config.CLUSTER_BACKEND == "unix" else processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
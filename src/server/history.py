@@ -0,0 +1,230 @@
+"""Append-only chat history, one log per room, stored in SQLite.
+
+Messages are appended to an in-memory batch by the websocket handlers and
+written in a single transaction every ``config.HISTORY_FLUSH_INTERVAL``
+seconds, so recording a message never waits on the disk. The database runs
+in WAL mode: workers of a multi-worker server share the file, and readers
+don't block the writer.
+
+All database work happens on one dedicated thread that owns the
+connection. Reads first write the pending batch, so a query always sees
+every message appended before it.
+
+Messages are also indexed for ``/search`` in an FTS5 table (an inverted
+index over text, sender and room). A trigger keeps it up to date as each
+batch is inserted, so indexing happens off the hot path as well and queries
+never scan the log.
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.core import config
+
+log = logging.getLogger("chat.history")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    room TEXT NOT NULL,
+    ts REAL NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room_seq ON messages (room, seq);
+CREATE INDEX IF NOT EXISTS messages_room_ts ON messages (room, ts);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    text, user, room, content='messages', content_rowid='seq'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text, user, room) VALUES (new.seq, new.text, new.user, new.room);
+END;
+"""
+
+
+def fts_phrase(term):
+    """Quote a user-supplied term for an FTS5 query; a trailing ``*`` keeps prefix matching."""
+    prefix = term.endswith("*")
+    term = term.rstrip("*").replace('"', '""')
+    return f'"{term}"*' if prefix else f'"{term}"'
+
+
+class HistoryStore:
+    """Batched writer and paged reader of the message log."""
+
+    def __init__(self, path=None):
+        self.path = path or config.HISTORY_DB
+        self.pending = []  # (room, ts, user, text) not written yet
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.db = None
+        # Opened lazily on the thread: the server may fork workers after import
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=5)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            indexed = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone() is not None
+            self.db.executescript(SCHEMA)
+            if not indexed:
+                # Index the messages logged before search existed
+                with self.db:
+                    self.db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return self.db
+
+    def _write(self, batch):
+        if batch:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT INTO messages (room, ts, user, text) VALUES (?, ?, ?, ?)", batch)
+
+    async def _run(self, fn, *args):
+        """Run ``fn`` on the database thread after writing the pending batch."""
+        batch, self.pending = self.pending, []
+
+        def call():
+            self._write(batch)
+            return fn(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    # Writing
+
+    def append(self, room, user, text):
+        """Record a chat message. Never blocks; it is written with the next batch."""
+        self.pending.append((room, time.time(), user, text))
+        if len(self.pending) >= config.HISTORY_BATCH_SIZE:
+            self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), config.HISTORY_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.pending:
+                try:
+                    await self._run(lambda: None)
+                except sqlite3.Error as e:
+                    log.error("[HISTORY] Failed to write messages: %s", e)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self._run(lambda: None)
+        self.executor.shutdown(wait=True)
+
+    # Reading
+
+    def _start_after(self, room, limit, since, until):
+        """Sequence number just before the first of the last ``limit`` messages between ``since`` and ``until``."""
+        row = self._connect().execute(
+            "SELECT seq FROM messages WHERE room = ? AND ts >= ? AND ts <= ? ORDER BY seq DESC LIMIT 1 OFFSET ?",
+            (room, since, until, limit - 1)
+        ).fetchone()
+        return row[0] - 1 if row else 0
+
+    def _page(self, room, after, since, until, limit):
+        return self._connect().execute(
+            "SELECT seq, ts, user, text FROM messages WHERE room = ? AND seq > ? AND ts >= ? AND ts <= ? "
+            "ORDER BY seq LIMIT ?",
+            (room, after, since, until, limit)
+        ).fetchall()
+
+    async def pages(self, room, limit, since=0, until=None):
+        """Yield the last ``limit`` messages of ``room`` sent since ``since``, oldest first.
+
+        Args:
+            room: Room name.
+            limit: Maximum number of messages.
+            since: Unix timestamp; older messages are skipped.
+            until: Unix timestamp; newer messages are skipped.
+
+        Yields:
+            list: Pages of at most ``config.HISTORY_PAGE_SIZE`` message dicts
+            with 'seq', 'ts', 'user' and 'text'.
+        """
+        until = until if until is not None else float("inf")
+        after = await self._run(self._start_after, room, limit, since, until)
+        remaining = limit
+        while remaining > 0:
+            rows = await self._run(self._page, room, after, since, until, min(remaining, config.HISTORY_PAGE_SIZE))
+            if not rows:
+                return
+            yield [{'seq': seq, 'ts': ts, 'user': user, 'text': text} for seq, ts, user, text in rows]
+            remaining -= len(rows)
+            after = rows[-1][0]
+
+    def _search(self, terms, user, room, since, until, limit):
+        query = [f"text : {fts_phrase(term)}" for term in terms]
+        if user:
+            query.append(f"user : {fts_phrase(user)}")
+        if room:
+            query.append(f"room : {fts_phrase(room)}")
+        # Turn the time range into a rowid range the index can seek to
+        db = self._connect()
+        first, last = db.execute(
+            "SELECT (SELECT MIN(seq) FROM messages WHERE ts >= ?), (SELECT MAX(seq) FROM messages WHERE ts <= ?)",
+            (since, until)
+        ).fetchone()
+        if first is None or last is None:
+            return []
+        # Walking the index newest first lets LIMIT stop early on common words
+        sql = (
+            "SELECT m.seq, m.ts, m.user, m.room, m.text FROM messages_fts "
+            "JOIN messages AS m ON m.seq = messages_fts.rowid "
+            "WHERE messages_fts MATCH ? AND messages_fts.rowid BETWEEN ? AND ? "
+            "AND m.ts >= ? AND m.ts <= ?"
+        )
+        args = [" AND ".join(query), first, last, since, until]
+        # The index matches tokens; keep only exact sender and room names
+        if user:
+            sql += " AND m.user = ?"
+            args.append(user)
+        if room:
+            sql += " AND m.room = ?"
+            args.append(room)
+        sql += " ORDER BY messages_fts.rowid DESC LIMIT ?"
+        args.append(limit)
+        return db.execute(sql, args).fetchall()
+
+    async def search(self, terms, user=None, room=None, since=0, until=None, limit=None):
+        """Find messages containing every term, newest first.
+
+        Args:
+            terms: Words to look for in the message text (``word*`` matches
+                a prefix).
+            user: Only messages sent by this user.
+            room: Only messages sent in this room.
+            since: Unix timestamp of the oldest message to return.
+            until: Unix timestamp of the newest message to return.
+            limit: Maximum number of results, default
+                ``config.SEARCH_MAX_RESULTS``.
+
+        Returns:
+            list: Message dicts with 'seq', 'ts', 'user', 'room' and 'text'.
+        """
+        terms = [term for term in terms if term.strip("*")]
+        if not terms and not user and not room:
+            return []
+        rows = await self._run(
+            self._search, terms, user, room, since,
+            until if until is not None else float("inf"),
+            limit or config.SEARCH_MAX_RESULTS
+        )
+        return [
+            {'seq': seq, 'ts': ts, 'user': user, 'room': room, 'text': text}
+            for seq, ts, user, room, text in rows
+        ]
@@ -0,0 +1,39 @@
+"""Leveled server logging that keeps writes off the event loop.
+
+Records go through a ``QueueHandler`` to a ``QueueListener`` thread that
+does the actual writing, so logging a line from a handler is an
+``put_nowait``, never a blocking write to a slow terminal or pipe. Messages
+below ``config.LOG_LEVEL`` cost a level check; "off" disables logging.
+"""
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from src.core import config
+
+LEVELS = ("debug", "info", "warning", "error", "off")
+
+
+def setup_logging(level=None):
+    """Configure the "chat" loggers of this process (each worker has its own thread)."""
+    level = (level or config.LOG_LEVEL).lower()
+    logger = logging.getLogger("chat")
+    logger.propagate = False
+    # A forked worker inherits the parent's handler but not its writer thread
+    logger.handlers.clear()
+    if level == "off":
+        # A handler still, or warnings would go to logging's last resort on stderr
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.CRITICAL + 1)
+        return
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(records, output)
+    logger.addHandler(QueueHandler(records))
+    logger.setLevel(level.upper())
+    listener.start()
+    # Write what is still queued on exit
+    atexit.register(listener.stop)
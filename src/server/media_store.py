@@ -0,0 +1,141 @@
+"""Content-addressed media store for the chat server.
+
+Uploaded images are kept on disk under their SHA-256, so an image that is
+posted again is announced to the room as a small ``image_ref`` instead of
+being uploaded and relayed in full. Clients that don't have it cached fetch
+it on demand. The store is bounded by total size and evicts the least
+recently used files first.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from src.core import config
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_digest(value):
+    """True if ``value`` is a lowercase hex SHA-256 (and thus a safe file name)."""
+    return isinstance(value, str) and DIGEST_RE.match(value) is not None
+
+
+class MediaWriter:
+    """Streams one upload to a temporary file while hashing it."""
+
+    def __init__(self, store):
+        self.store = store
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.file = tempfile.NamedTemporaryFile(dir=store.tmp_dir, suffix=".part", delete=False)
+
+    def write(self, payload):
+        self.received += len(payload)
+        self.digest.update(payload)
+        self.file.write(payload)
+
+    def commit(self, expected=None):
+        """Move the upload into the store.
+
+        Returns:
+            str: The digest of the stored file, or None if it didn't match
+            ``expected``.
+        """
+        self.file.close()
+        digest = self.digest.hexdigest()
+        if expected is not None and expected != digest:
+            os.remove(self.file.name)
+            return None
+        self.store.add(digest, self.file.name, self.received)
+        return digest
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class MediaStore:
+    """Size-bounded, LRU-evicted on-disk store of files keyed by SHA-256."""
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or config.MEDIA_STORE_DIR
+        self.max_bytes = max_bytes or config.MEDIA_STORE_MAX_BYTES
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.entries = OrderedDict()  # digest -> size, least recently used first
+        self.size = 0
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._load()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _load(self):
+        """Index files left by a previous run, oldest access first."""
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+
+        found = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name == "tmp":
+                continue
+            for item in os.scandir(entry.path):
+                if is_digest(item.name):
+                    stat = item.stat()
+                    found.append((stat.st_mtime, item.name, stat.st_size))
+
+        for _, digest, size in sorted(found):
+            self.entries[digest] = size
+            self.size += size
+        self._evict()
+
+    def has(self, digest):
+        if digest not in self.entries:
+            # Another worker process sharing this directory may have stored it
+            path = self._path(digest)
+            if not os.path.exists(path):
+                return False
+            size = os.path.getsize(path)
+            self.entries[digest] = size
+            self.size += size
+        self.entries.move_to_end(digest)
+        return True
+
+    def size_of(self, digest):
+        return self.entries.get(digest)
+
+    def open(self, digest):
+        """Open a stored file for reading and mark it as recently used."""
+        path = self._path(digest)
+        self.entries.move_to_end(digest)
+        os.utime(path)
+        return open(path, "rb")
+
+    def begin(self):
+        """Start receiving an upload."""
+        return MediaWriter(self)
+
+    def add(self, digest, temp_path, size):
+        if digest in self.entries:
+            os.remove(temp_path)
+            self.entries.move_to_end(digest)
+            return
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        self.entries[digest] = size
+        self.size += size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            digest, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,245 @@
+"""Server instrumentation, exported in the Prometheus text format.
+
+Metrics are plain in-process counters and fixed-bucket histograms. Updating
+one is a dict lookup and an addition, so they stay on the hot path: events
+and bytes in and out per event type, how long a broadcast takes to fan out,
+how long frames wait in the send queues, handler time per event type and
+per registered handler, and event loop lag. Values that are cheap to read
+but costly to track (queue depth of every connection, session counts) are
+gauges computed when the endpoint is scraped.
+
+``serve`` answers ``GET /metrics`` on ``config.METRICS_HOST`` and
+``config.METRICS_PORT`` (plus the worker id in multi-worker mode, one
+endpoint per worker). ``snapshot`` gives the summary the ``/stats`` command
+shows.
+
+Event types come from clients, so a label only takes the first
+``config.METRICS_MAX_TYPES`` distinct well-formed types; later ones count as
+"other".
+"""
+import asyncio
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from src.core import config
+from src.core import protocol
+
+log = logging.getLogger("chat.metrics")
+
+# Seconds; also fine for the loop lag, which is mostly well below 1 ms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+_TYPE_TEXT = re.compile(r'"type"\s*:\s*"([A-Za-z0-9_]{1,32})"')
+_TYPE_BYTES = re.compile(rb'"type"\s*:\s*"([A-Za-z0-9_]{1,32})"')
+_TYPE_SCAN = 256  # clients and the server put "type" first, no need to scan whole pages
+
+METRICS = []
+_types = set()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, list(zip(self.labels, labels)), value
+
+
+class Gauge:
+    """A value read when scraped: ``read`` returns {label tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+        METRICS.append(self)
+
+    def samples(self):
+        for labels, value in self.read().items():
+            yield self.name, list(zip(self.labels, labels)), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [count per bucket (+Inf last), sum]
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def quantile(self, q, *labels):
+        """Upper bound of the bucket holding the ``q`` quantile, None without samples."""
+        series = self.series.get(labels)
+        if not series:
+            return None
+        rank = q * sum(series[0])
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for labels, (counts, total) in self.series.items():
+            pairs = list(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", pairs + [("le", f"{bound:g}")], cumulative
+            yield f"{self.name}_bucket", pairs + [("le", "+Inf")], cumulative + counts[-1]
+            yield f"{self.name}_sum", pairs, total
+            yield f"{self.name}_count", pairs, cumulative + counts[-1]
+
+
+def event_type(payload, binary=False, packed=False):
+    """The ``type`` of an encoded event, as a bounded label value.
+
+    Args:
+        binary: ``payload`` is an image chunk.
+        packed: ``payload`` is a ``chat.msgpack`` event.
+    """
+    if binary:
+        return "image_chunk"
+    if packed:
+        # Packed types are codes from a fixed table, no need to bound them
+        return protocol.packed_type(payload) or "other"
+    match = (_TYPE_BYTES if isinstance(payload, bytes) else _TYPE_TEXT).search(payload, 0, _TYPE_SCAN)
+    if match is None:
+        return "other"
+    value = match.group(1)
+    if isinstance(value, bytes):
+        value = value.decode("ascii")
+    if value not in _types:
+        if len(_types) >= config.METRICS_MAX_TYPES:
+            return "other"
+        _types.add(value)
+    return value
+
+
+EVENTS_RECEIVED = Counter("chat_events_received_total", "Events received from clients", ("type",))
+EVENTS_SENT = Counter("chat_events_sent_total", "Events queued for clients (one per recipient)", ("type",))
+BYTES_RECEIVED = Counter("chat_bytes_received_total", "Payload bytes received from clients")
+BYTES_SENT = Counter("chat_bytes_sent_total", "Payload bytes written to clients")
+FRAMES_SENT = Counter("chat_frames_sent_total", "Frames written to clients (a batch frame carries several events)")
+FANOUT_SECONDS = Histogram("chat_broadcast_fanout_seconds", "Time to encode a broadcast and queue it for every recipient")
+QUEUE_WAIT_SECONDS = Histogram("chat_send_queue_wait_seconds", "Time frames wait in a send queue before being written")
+HANDLER_SECONDS = Histogram("chat_handler_seconds", "Time the connection handler spends on an event", ("type",))
+DISPATCH_SECONDS = Histogram("chat_dispatch_seconds", "Time spent in each event and command handler", ("handler",))
+LOOP_LAG_SECONDS = Histogram("chat_event_loop_lag_seconds", "How late the event loop runs a timer")
+
+
+def _label_text(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_label_text(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def _ms(seconds):
+    # None for no samples, or samples beyond the last bucket
+    return None if seconds is None or seconds == float("inf") else round(seconds * 1000, 3)
+
+
+def snapshot():
+    """A summary of the metrics for the ``/stats`` command."""
+    gauges = {metric.name: metric.read() for metric in METRICS if isinstance(metric, Gauge) and not metric.labels}
+    return {
+        "events_in": {labels[0]: int(value) for labels, value in EVENTS_RECEIVED.values.items()},
+        "events_out": {labels[0]: int(value) for labels, value in EVENTS_SENT.values.items()},
+        "bytes_in": int(BYTES_RECEIVED.total()),
+        "bytes_out": int(BYTES_SENT.total()),
+        "frames_out": int(FRAMES_SENT.total()),
+        "fanout_ms": {"p50": _ms(FANOUT_SECONDS.quantile(0.5)), "p99": _ms(FANOUT_SECONDS.quantile(0.99))},
+        "queue_wait_ms": {"p50": _ms(QUEUE_WAIT_SECONDS.quantile(0.5)), "p99": _ms(QUEUE_WAIT_SECONDS.quantile(0.99))},
+        "handler_p99_ms": {labels[0]: _ms(HANDLER_SECONDS.quantile(0.99, *labels)) for labels in HANDLER_SECONDS.series},
+        "loop_lag_p99_ms": _ms(LOOP_LAG_SECONDS.quantile(0.99)),
+        "gauges": {name: values.get((), 0) for name, values in gauges.items()},
+    }
+
+
+async def watch_loop_lag():
+    """Sample how late a sleep wakes up: the time every other callback had to wait."""
+    interval = config.LOOP_LAG_INTERVAL
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(time.perf_counter() - start - interval, 0.0))
+
+
+async def _respond(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found: try /metrics\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port):
+    """Start the metrics endpoint.
+
+    Returns:
+        asyncio.Server: The endpoint, or None if the port is taken.
+    """
+    try:
+        return await asyncio.start_server(_respond, config.METRICS_HOST, port)
+    except OSError as e:
+        log.warning("[METRICS] Endpoint disabled, can't listen on %s:%d: %s", config.METRICS_HOST, port, e)
+        return None
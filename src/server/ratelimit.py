@@ -0,0 +1,96 @@
+"""Per-connection flood control with token buckets.
+
+Every connection gets a ``RateLimiter`` holding one bucket per kind of
+event in ``config.RATE_LIMITS``: chat messages, whispers, atacks, image
+bytes, and "total" for every event but image chunks. A bucket refills at ``rate``
+tokens per second up to ``burst``; each event takes one token (image chunks
+take one per byte). A check is a clock read and a little arithmetic, so
+limiting costs next to nothing per message.
+
+What happens to an event over its limit is ``config.RATE_LIMIT_ACTION``
+(or the per-kind override in ``config.RATE_LIMIT_ACTIONS``):
+
+* ``delay``: the handler waits for the tokens, which stops reading from the
+  client and pushes back on it through TCP. Waits longer than
+  ``config.RATE_LIMIT_MAX_DELAY`` are dropped instead.
+* ``drop``: the event is discarded and the client is told to slow down, at
+  most once per ``config.RATE_LIMIT_NOTICE_INTERVAL`` seconds.
+* ``disconnect``: the connection is closed and its session ended.
+"""
+import time
+from collections import Counter
+
+from src.core import config
+
+DELAY = "delay"
+DROP = "drop"
+DISCONNECT = "disconnect"
+OUTCOMES = {DELAY: "delayed", DROP: "dropped", DISCONNECT: "disconnected"}
+
+# Event types limited by their own bucket, besides "total"
+EVENT_KINDS = {"message": "message", "whisper": "whisper", "atack": "atack"}
+
+# (kind, action) -> events throttled by this process
+THROTTLED = Counter()
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount=1):
+        """Take ``amount`` tokens if there are enough.
+
+        Returns:
+            float: 0 if they were taken, otherwise the seconds until they
+            would be available.
+        """
+        now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        # An event larger than the burst could never pass: it needs a full bucket
+        amount = min(amount, self.burst)
+        if tokens >= amount:
+            self.tokens = tokens - amount
+            return 0.0
+        self.tokens = tokens
+        return (amount - tokens) / self.rate
+
+
+class RateLimiter:
+    """The token buckets of one connection."""
+
+    def __init__(self, limits=None):
+        limits = config.RATE_LIMITS if limits is None else limits
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in limits.items()}
+        self.last_notice = 0.0
+
+    def take(self, kind, amount=1):
+        """Seconds to wait before an event of ``kind`` is within limits (0 if it is now)."""
+        bucket = self.buckets.get(kind)
+        return bucket.take(amount) if bucket is not None else 0.0
+
+    def notify(self):
+        """True if the client should be told it is throttled (not told recently)."""
+        now = time.monotonic()
+        if now - self.last_notice < config.RATE_LIMIT_NOTICE_INTERVAL:
+            return False
+        self.last_notice = now
+        return True
+
+
+def action_for(kind):
+    return config.RATE_LIMIT_ACTIONS.get(kind, config.RATE_LIMIT_ACTION)
+
+
+def report():
+    """Throttled events so far, e.g. ``message: 12 dropped, image: 3 delayed``."""
+    return ", ".join(
+        f"{kind}: {count} {OUTCOMES.get(action, action)}"
+        for (kind, action), count in sorted(THROTTLED.items())
+    )
@@ -0,0 +1,174 @@
+"""Connection registry for the chat server.
+
+Keeps every lookup the handler needs on the hot path behind a dict or set so
+resolving a whisper/atack target, listing users or counting them never scans
+all connections.
+
+In multi-worker mode the registry also mirrors the users connected to the
+other workers (``remote``), kept up to date by presence events on the
+cluster bus, so those lookups stay local and O(1) as well.
+"""
+from collections import defaultdict
+
+DEFAULT_ROOM = "lobby"
+
+
+class Registry:
+    """Indexes of connected websockets, registered users and room members."""
+
+    def __init__(self):
+        self.sessions = {}              # websocket -> session dict (None until registered)
+        self.by_name = {}               # user name -> websocket
+        self.rooms = defaultdict(set)   # room name -> set of websockets
+        self.count = 0                  # number of registered users on this worker
+        self.remote = {}                # user name -> session dict of a user on another worker
+        self.remote_rooms = defaultdict(set)  # room name -> names of remote members
+
+    def connect(self, websocket):
+        """Track a new connection that has not sent its user name yet."""
+        self.sessions[websocket] = None
+
+    def register(self, websocket, name, room=DEFAULT_ROOM):
+        """Attach a user name to a connection.
+
+        Returns:
+            dict: The new session, or None if the name is already taken.
+        """
+        if name in self.by_name or name in self.remote:
+            return None
+
+        session = {'name': name, 'life': 100, 'room': room}
+        self.sessions[websocket] = session
+        self.by_name[name] = websocket
+        self.rooms[room].add(websocket)
+        self.count += 1
+        return session
+
+    def disconnect(self, websocket):
+        """Drop a connection from every index.
+
+        Returns:
+            dict: The session that was removed, or None if it never registered.
+        """
+        session = self.sessions.pop(websocket, None)
+        if session is None:
+            return None
+
+        if self.by_name.get(session['name']) is websocket:
+            del self.by_name[session['name']]
+
+        self._leave_room(websocket, session['room'])
+        self.count -= 1
+        return session
+
+    def rebind(self, old, new):
+        """Move a session to a new connection (a resumed session)."""
+        session = self.sessions.pop(old)
+        self.sessions[new] = session
+        self.by_name[session['name']] = new
+        members = self.rooms[session['room']]
+        members.discard(old)
+        members.add(new)
+        return session
+
+    def _leave_room(self, websocket, room):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(websocket)
+            if not members:
+                del self.rooms[room]
+
+    def move(self, websocket, room):
+        """Move a registered connection to another room.
+
+        Returns:
+            str: The room it left, or None if the connection isn't registered.
+        """
+        session = self.sessions.get(websocket)
+        if session is None:
+            return None
+        previous = session['room']
+        self._leave_room(websocket, previous)
+        self.rooms[room].add(websocket)
+        session['room'] = room
+        return previous
+
+    def get(self, websocket):
+        """Return the session of a connection, or None if not registered."""
+        return self.sessions.get(websocket)
+
+    def find(self, name):
+        """Return the websocket registered under ``name``, or None."""
+        return self.by_name.get(name)
+
+    def find_remote(self, name):
+        """Return the session of a user connected to another worker, or None."""
+        return self.remote.get(name)
+
+    def add_remote(self, session):
+        """Mirror a user registered on another worker (``session`` has a 'worker' key)."""
+        self.remove_remote(session['name'])
+        self.remote[session['name']] = session
+        self.remote_rooms[session['room']].add(session['name'])
+
+    def remove_remote(self, name):
+        session = self.remote.pop(name, None)
+        if session is not None:
+            self._leave_remote_room(name, session['room'])
+        return session
+
+    def move_remote(self, name, room):
+        session = self.remote.get(name)
+        if session is not None:
+            self._leave_remote_room(name, session['room'])
+            self.remote_rooms[room].add(name)
+            session['room'] = room
+
+    def _leave_remote_room(self, name, room):
+        members = self.remote_rooms.get(room)
+        if members is not None:
+            members.discard(name)
+            if not members:
+                del self.remote_rooms[room]
+
+    @property
+    def total(self):
+        """Registered users across all workers."""
+        return self.count + len(self.remote)
+
+    def room_members(self, room):
+        """Return the set of local websockets in ``room`` (empty if unknown)."""
+        return self.rooms.get(room, set())
+
+    def room_of(self, websocket):
+        """Return the room of a connection, or DEFAULT_ROOM if not registered."""
+        session = self.sessions.get(websocket)
+        return session['room'] if session else DEFAULT_ROOM
+
+    def room_counts(self):
+        """Return {room: number of users} across all workers."""
+        counts = {room: len(members) for room, members in self.rooms.items()}
+        for room, names in self.remote_rooms.items():
+            counts[room] = counts.get(room, 0) + len(names)
+        return counts
+
+    def user_list(self):
+        """Return the public view of every registered user."""
+        users = [
+            {'name': name, 'life': self.sessions[ws]['life'], 'room': self.sessions[ws]['room']}
+            for name, ws in self.by_name.items()
+        ]
+        users.extend(
+            {'name': name, 'life': session['life'], 'room': session['room']}
+            for name, session in self.remote.items()
+        )
+        return users
+
+    def __contains__(self, websocket):
+        return websocket in self.sessions
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,275 @@
+"""Resumable sessions: a dropped connection keeps its user for a while.
+
+Once a user registers, the server sends it a ``session`` event with a token
+and starts numbering every frame sent to it. The last frames are kept in a
+``ReplayBuffer``. When the connection drops, the session (name, life, room)
+stays registered for ``config.SESSION_RESUME_TIMEOUT`` seconds and frames
+sent to it meanwhile are buffered as well. A client that reconnects sends
+``{"type": "resume", "token": ..., "last_seq": n}`` with the number of
+frames it received, and gets back everything after ``n``. Image chunk frames
+are neither numbered nor buffered.
+
+Tokens start with the id of the worker that holds the session. A resume
+that lands on another worker asks that worker to hand the session over on
+the cluster bus.
+"""
+import asyncio
+import base64
+import secrets
+from collections import deque
+
+from src.core import compression
+from src.core import config
+from src.server.broadcast import (
+    send, send_frames, attach_replay, detach_outbox, open_detached_outbox, close_outbox
+)
+
+
+class ReplayBuffer:
+    """The last frames sent to a session, numbered from 1."""
+
+    def __init__(self, max_frames=None, max_bytes=None):
+        self.max_frames = max_frames or config.SESSION_BUFFER_FRAMES
+        self.max_bytes = max_bytes or config.SESSION_BUFFER_BYTES
+        self.frames = deque()  # (seq, payload, text)
+        self.seq = 0           # number of frames recorded so far
+        self.size = 0
+
+    def record(self, payload, text):
+        self.seq += 1
+        self.frames.append((self.seq, payload, text))
+        self.size += len(payload)
+        while len(self.frames) > self.max_frames or self.size > self.max_bytes:
+            _, dropped, _ = self.frames.popleft()
+            self.size -= len(dropped)
+        return self.seq
+
+    def since(self, seq):
+        """Frames recorded after ``seq``.
+
+        Returns:
+            tuple: (list of (seq, payload, text), False if some of them were
+            already evicted).
+        """
+        frames = [frame for frame in self.frames if frame[0] > seq]
+        first = frames[0][0] if frames else self.seq + 1
+        return frames, first == seq + 1
+
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'frames': [
+                [seq, payload.decode("utf-8") if text else base64.b64encode(payload).decode("ascii"), text]
+                for seq, payload, text in self.frames
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        buffer = cls()
+        for seq, payload, text in state['frames']:
+            buffer.frames.append((seq, payload.encode("utf-8") if text else base64.b64decode(payload), text))
+            buffer.size += len(buffer.frames[-1][1])
+        buffer.seq = state['seq']
+        return buffer
+
+
+class Placeholder:
+    """Stands in for the connection of a session handed over by another worker."""
+
+
+class SessionManager:
+    """Tokens, replay buffers and expiry of this worker's sessions."""
+
+    def __init__(self, registry, cluster):
+        self.registry = registry
+        self.cluster = cluster
+        self.tokens = {}    # token -> connection the session is bound to
+        self.by_ws = {}     # connection -> token
+        self.buffers = {}   # token -> ReplayBuffer
+        self.expiry = {}    # token -> TimerHandle, only while the session is detached
+        self.handoffs = {}  # token -> Future waiting for another worker's session
+        self.adopted = []   # callbacks for sessions taken over from another worker
+        self.on_expire = None  # called with the connection of a session that timed out
+        cluster.on("session_takeover", self._on_takeover)
+        cluster.on("session_handoff", self._on_handoff)
+
+    def on_adopt(self, callback):
+        """Call ``callback(session)`` for every session taken over from another worker."""
+        self.adopted.append(callback)
+
+    def create(self, websocket):
+        """Make a registered connection resumable and send it its token."""
+        token = f"{self.cluster.worker_id}.{secrets.token_urlsafe(18)}"
+        buffer = ReplayBuffer()
+        self.tokens[token] = websocket
+        self.by_ws[websocket] = token
+        self.buffers[token] = buffer
+        # Not numbered itself: the client counts the frames after it
+        send(websocket, {
+            "type": "session", "token": token, "seq": 0, "resumed": False,
+            "media_codecs": compression.media_codecs()
+        })
+        attach_replay(websocket, buffer)
+        return token
+
+    def detach(self, websocket):
+        """Keep the session of a dropped connection for a while.
+
+        Returns:
+            bool: False if the connection has no resumable session.
+        """
+        token = self.by_ws.get(websocket)
+        if token is None:
+            return False
+        if token not in self.expiry:
+            detach_outbox(websocket)
+            self.expiry[token] = asyncio.get_running_loop().call_later(
+                config.SESSION_RESUME_TIMEOUT, self._expire, token
+            )
+        return True
+
+    def end(self, websocket):
+        """The user quit: the session can't be resumed any more."""
+        token = self.by_ws.get(websocket)
+        if token is not None:
+            self._forget(token)
+
+    def _forget(self, token):
+        websocket = self.tokens.pop(token, None)
+        self.buffers.pop(token, None)
+        handle = self.expiry.pop(token, None)
+        if handle is not None:
+            handle.cancel()
+        if websocket is not None:
+            self.by_ws.pop(websocket, None)
+        return websocket
+
+    def _expire(self, token):
+        self.expiry.pop(token, None)
+        websocket = self._forget(token)
+        if websocket is not None and self.on_expire is not None:
+            self.on_expire(websocket)
+
+    def _release(self, token):
+        """Detach a session from its connection, closing it if still open."""
+        websocket = self.tokens[token]
+        if token not in self.expiry:
+            # The old connection hasn't noticed it is gone yet
+            self.detach(websocket)
+            if not isinstance(websocket, Placeholder):
+                asyncio.create_task(websocket.close(1000, "session resumed elsewhere"))
+        return websocket
+
+    async def resume(self, token, websocket, last_seq):
+        """Bind a session to a new connection and queue the frames it missed.
+
+        Returns:
+            dict: The resumed session, or None if the token is unknown or
+            expired.
+        """
+        if not isinstance(token, str) or not isinstance(last_seq, int):
+            return None
+        worker, _, secret = token.partition(".")
+        if worker != str(self.cluster.worker_id) and token not in self.tokens:
+            if not worker.isdigit() or not await self._take_over(token, int(worker)):
+                return None
+            # The token now has to point at this worker
+            token = f"{self.cluster.worker_id}.{secret}"
+        if token not in self.tokens:
+            return None
+
+        old = self._release(token)
+        buffer = self.buffers[token]
+        session = self.registry.get(old)
+        frames, complete = buffer.since(last_seq)
+        send(websocket, {
+            "type": "session",
+            "token": token,
+            "seq": frames[0][0] - 1 if frames else buffer.seq,
+            "resumed": True,
+            "complete": complete,
+            "name": session['name'],
+            "life": session['life'],
+            "room": session['room'],
+            "media_codecs": compression.media_codecs()
+        })
+        # Frames sent to the old connection meanwhile are recorded too: send
+        # until caught up, then switch over without yielding in between
+        while frames:
+            await send_frames(websocket, frames)
+            if self.tokens.get(token) is not old:
+                return None  # taken over again while catching up
+            frames, _ = buffer.since(frames[-1][0])
+
+        self.expiry.pop(token).cancel()
+        self.registry.rebind(old, websocket)
+        close_outbox(old)
+        self.tokens[token] = websocket
+        del self.by_ws[old]
+        self.by_ws[websocket] = token
+        attach_replay(websocket, buffer)
+        return session
+
+    # Sessions held by another worker
+
+    async def _take_over(self, token, worker):
+        future = asyncio.get_running_loop().create_future()
+        self.handoffs[token] = future
+        self.cluster.send_to_worker(worker, {
+            "op": "session_takeover", "token": token, "worker": self.cluster.worker_id
+        })
+        try:
+            state = await asyncio.wait_for(future, config.SESSION_HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.handoffs.pop(token, None)
+        if state is None:
+            return False
+        token = f"{self.cluster.worker_id}.{token.partition('.')[2]}"
+
+        # Registered under a placeholder until the resume switches to the connection
+        key = Placeholder()
+        self.registry.remove_remote(state['name'])
+        session = self.registry.register(key, state['name'], state['room'])
+        if session is None:
+            return False
+        session['life'] = state['life']
+        if state.get('respawn_at') is not None:
+            session['respawn_at'] = state['respawn_at']
+        buffer = ReplayBuffer.from_dict(state['buffer'])
+        open_detached_outbox(key, buffer)
+        self.tokens[token] = key
+        self.by_ws[key] = token
+        self.buffers[token] = buffer
+        self.expiry[token] = asyncio.get_running_loop().call_later(
+            config.SESSION_RESUME_TIMEOUT, self._expire, token
+        )
+        self.cluster.announce_join(session)
+        for callback in self.adopted:
+            callback(session)
+        return True
+
+    def _on_takeover(self, event, payload):
+        token = event["token"]
+        state = None
+        if token in self.tokens:
+            websocket = self._release(token)
+            buffer = self.buffers[token]
+            self._forget(token)
+            close_outbox(websocket)
+            # No leave announcement: the new worker announces the join
+            session = self.registry.disconnect(websocket)
+            state = {
+                'name': session['name'], 'life': session['life'], 'room': session['room'],
+                'respawn_at': session.get('respawn_at'), 'buffer': buffer.to_dict()
+            }
+        self.cluster.send_to_worker(event["worker"], {
+            "op": "session_handoff", "token": token, "state": state
+        })
+
+    def _on_handoff(self, event, payload):
+        future = self.handoffs.get(event["token"])
+        if future is not None and not future.done():
+            future.set_result(event["state"])
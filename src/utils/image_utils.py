@@ -1,8 +1,15 @@
 """Image display utilities for terminal."""
+import hashlib
+import io
+import os
+import sys
 import numpy
-from PIL import Image
+from PIL import Image, features
 import shutil
 
+from src.core import config
+from src.utils import render_cache
+
 
 def get_terminal_size():
     """Get the current terminal size.
@@ -13,92 +20,307 @@ def get_terminal_size():
     return shutil.get_terminal_size()
 
 
-def display_image_in_terminal(image_path):
-    """Display an image in the terminal using ANSI escape codes.
-    
+def prepare_image_for_upload(image_path, max_size=None):
+    """Downscale and re-encode an image to the resolution terminals can show.
+
     Args:
-        image_path: Path to the image file to display.
+        image_path: Path to the image file.
+        max_size: (width, height) cap, defaults to config.IMAGE_UPLOAD_MAX_SIZE.
+
+    Returns:
+        tuple: (filename, io.BytesIO) of the encoded image. The original file
+        is returned untouched when re-encoding would not make it smaller.
+    """
+    max_size = max_size or config.IMAGE_UPLOAD_MAX_SIZE
+    original_size = os.path.getsize(image_path)
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+
+    with Image.open(image_path) as image:
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        buffer = io.BytesIO()
+        if features.check("webp"):
+            image.save(buffer, "WEBP", quality=config.IMAGE_UPLOAD_QUALITY, method=4)
+            filename = f"{base_name}.webp"
+        else:
+            image.quantize(colors=256).save(buffer, "PNG", optimize=True)
+            filename = f"{base_name}.png"
+
+    if buffer.tell() >= original_size:
+        with open(image_path, "rb") as f:
+            return os.path.basename(image_path), io.BytesIO(f.read())
+
+    buffer.seek(0)
+    return filename, buffer
+
+
+def load_image(source, target_width, target_height):
+    """Load and resize an image to fit terminal dimensions.
+
+    Args:
+        source: Path or binary file object of the image.
+        target_width: Maximum width in terminal columns.
+        target_height: Maximum height in terminal lines.
+
+    Returns:
+        numpy.ndarray: (height, width, 3) uint8 RGB array, or None on error.
     """
+    try:
+        with Image.open(source, "r") as image:
+            image.thumbnail((target_width, target_height), Image.Resampling.LANCZOS)
+            return numpy.asarray(image.convert("RGB"))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Erro ao abrir a imagem: {e}")
+        return None
+
+
+RENDER_MODES = config.RENDER_MODES
+COLOR_MODES = config.COLOR_MODES
+
+UPPER_HALF_BLOCK = "\u2580"
+DEFAULT_COLOR = -1  # terminal default colour (padding row in half mode)
+
+ANSI_16 = numpy.array([
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+], dtype=numpy.int32)
+
+CUBE_LEVELS = numpy.array([0, 95, 135, 175, 215, 255], dtype=numpy.int32)
+CUBE_THRESHOLDS = (CUBE_LEVELS[1:] + CUBE_LEVELS[:-1]) / 2
+
+
+def quantize(pixels, colors):
+    """Map RGB pixels to one integer colour key per cell.
+
+    Args:
+        pixels: (height, width, 3) uint8 array.
+        colors: One of COLOR_MODES.
+
+    Returns:
+        numpy.ndarray: (height, width) int32 keys. For "truecolor" the key is
+        0xRRGGBB, otherwise it is the xterm palette index.
+    """
+    rgb = pixels.astype(numpy.int32)
+
+    if colors == "16":
+        distances = ((rgb[:, :, None, :] - ANSI_16) ** 2).sum(axis=3)
+        return distances.argmin(axis=2).astype(numpy.int32)
+
+    if colors == "256":
+        # Nearest entry of the 6x6x6 cube, per channel
+        levels = numpy.searchsorted(CUBE_THRESHOLDS, rgb)
+        cube = CUBE_LEVELS[levels]
+        cube_index = 16 + 36 * levels[:, :, 0] + 6 * levels[:, :, 1] + levels[:, :, 2]
+        cube_error = ((rgb - cube) ** 2).sum(axis=2)
+
+        # Nearest step of the 24-level grayscale ramp
+        gray_step = numpy.clip(numpy.rint((rgb.mean(axis=2) - 8) / 10), 0, 23).astype(numpy.int32)
+        gray_value = 8 + 10 * gray_step
+        gray_error = ((rgb - gray_value[:, :, None]) ** 2).sum(axis=2)
+
+        return numpy.where(gray_error < cube_error, 232 + gray_step, cube_index).astype(numpy.int32)
+
+    return (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+
+
+def _sgr(key, colors, background):
+    """SGR parameters selecting colour ``key`` as foreground or background."""
+    if key == DEFAULT_COLOR:
+        return "49" if background else "39"
+    if colors == "16":
+        base = (40 if background else 30) if key < 8 else (100 if background else 90)
+        return str(base + key % 8)
+    if colors == "256":
+        return f"{48 if background else 38};5;{key}"
+    return f"{48 if background else 38};2;{key >> 16};{(key >> 8) & 255};{key & 255}"
+
+
+def _changed(keys):
+    """True where a cell's key differs from its left neighbour (always at column 0)."""
+    changed = numpy.ones(keys.shape, dtype=bool)
+    changed[:, 1:] = keys[:, 1:] != keys[:, :-1]
+    return changed
+
+
+def _code_table(keys, colors, background):
+    """Format each distinct colour of a frame once.
+
+    Returns:
+        tuple: (list of SGR parameter strings, array of indexes into it
+        shaped like ``keys``).
+    """
+    unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+    table = [_sgr(key, colors, background) for key in unique_keys.tolist()]
+    return table, inverse.reshape(keys.shape)
+
+
+def render_ansi(pixels, mode="full", colors="truecolor"):
+    """Turn an RGB array into terminal escape sequences.
+
+    In "full" mode every cell shows one pixel as a background colour. In
+    "half" mode every cell shows two vertically stacked pixels as an upper
+    half block with separate foreground and background colours. A colour
+    escape is only emitted where it differs from the cell on the left.
+
+    Args:
+        pixels: (height, width, 3) uint8 array.
+        mode: One of RENDER_MODES.
+        colors: One of COLOR_MODES.
+
+    Returns:
+        str: The rendered rows, newline-terminated.
+    """
+    height, width, _ = pixels.shape
+    if not height or not width:
+        return ""
+
+    if mode == "half":
+        fg = quantize(pixels[0::2], colors)
+        bg = numpy.full(fg.shape, DEFAULT_COLOR, dtype=numpy.int32)
+        bg[:height // 2] = quantize(pixels[1::2], colors)
+        char = UPPER_HALF_BLOCK
+    else:
+        fg = None
+        bg = quantize(pixels, colors)
+        char = " "
+
+    bg_table, bg_index = _code_table(bg, colors, True)
+    bg_changed = _changed(bg)
+
+    rows = []
+    if fg is None:
+        for y in range(bg.shape[0]):
+            starts = numpy.flatnonzero(bg_changed[y])
+            run_lengths = numpy.diff(starts, append=width).tolist()
+            rows.append("".join(
+                f"\033[{bg_table[i]}m{char * n}"
+                for i, n in zip(bg_index[y, starts].tolist(), run_lengths)
+            ))
+        return "\033[0m\n".join(rows) + "\033[0m\n"
+
+    fg_table, fg_index = _code_table(fg, colors, False)
+    fg_changed = _changed(fg)
+    any_changed = fg_changed | bg_changed
+    for y in range(bg.shape[0]):
+        starts = numpy.flatnonzero(any_changed[y])
+        run_lengths = numpy.diff(starts, append=width).tolist()
+        parts = []
+        for fg_i, fg_flag, bg_i, bg_flag, n in zip(
+            fg_index[y, starts].tolist(), fg_changed[y, starts].tolist(),
+            bg_index[y, starts].tolist(), bg_changed[y, starts].tolist(),
+            run_lengths,
+        ):
+            if fg_flag and bg_flag:
+                parts.append(f"\033[{fg_table[fg_i]};{bg_table[bg_i]}m{char * n}")
+            elif fg_flag:
+                parts.append(f"\033[{fg_table[fg_i]}m{char * n}")
+            else:
+                parts.append(f"\033[{bg_table[bg_i]}m{char * n}")
+        rows.append("".join(parts))
+    return "\033[0m\n".join(rows) + "\033[0m\n"
+
+
+def content_hash(source):
+    """SHA-256 hex digest of an image given as a path or binary file object."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        position = source.tell()
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(chunk)
+        source.seek(position)
+    return digest.hexdigest()
+
+
+def terminal_target_size():
+    """Terminal (columns, lines) available for an image."""
     try:
         columns, lines = get_terminal_size()
     except OSError:
         print("Não foi possível obter o tamanho do terminal. Usando padrão 80x24.")
         columns, lines = 80, 24
-        
-    target_lines = lines - 1 
-    target_columns = columns
-
-    def get_image(path, target_width, target_height):
-        """Load and resize image to fit terminal dimensions.
-        
-        Args:
-            path: Path to the image file.
-            target_width: Maximum width in terminal columns.
-            target_height: Maximum height in terminal lines.
-            
-        Returns:
-            numpy.ndarray: Pixel values array or None if error.
-        """
-        try:
-            image = Image.open(path, "r")
-        except FileNotFoundError:
-            return None
-        except Exception as e:
-            print(f"Erro ao abrir a imagem: {e}")
-            return None
-        
-        max_width_in_pixels = target_width
-        max_height_in_pixels = target_height 
-        
-        image.thumbnail((max_width_in_pixels, max_height_in_pixels), Image.Resampling.LANCZOS)
-        
-        width, height = image.size
-        pixel_values = list(image.getdata())
-        
-        if image.mode == "RGB":
-            channels = 3
-        elif image.mode == "L":
-            channels = 1
-        elif image.mode == "RGBA":
-            image = image.convert("RGB")
-            channels = 3
-            width, height = image.size
-            pixel_values = list(image.getdata())
-        else:
-            return None
+    return columns, lines
+
 
-        pixel_values = numpy.array(pixel_values).reshape((height, width, channels)) 
-        return pixel_values
+def render_frame(source, columns, lines, mode, colors):
+    """Decode, resize and render an image for a terminal of the given size.
 
-    image = get_image(image_path, target_columns, target_lines)
+    Runs in render worker processes, so it only takes picklable arguments
+    (``source`` may be raw image bytes) and does not touch the render cache.
 
+    Returns:
+        bytes: The UTF-8 encoded frame, or None if the image can't be loaded.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    # Half blocks carry two pixel rows per terminal line
+    rows_per_line = 2 if mode == "half" else 1
+    image = load_image(source, columns, (lines - 1) * rows_per_line)
     if image is None:
+        return None
+    return render_ansi(image, mode, colors).encode("utf-8")
+
+
+def render_image(source, digest=None, mode=None, colors=None):
+    """Render an image through the render cache.
+
+    Args:
+        source: Path or binary file object of the image.
+        digest: SHA-256 hex digest of the content, computed if not given.
+        mode: One of RENDER_MODES, defaults to config.IMAGE_RENDER_MODE.
+        colors: One of COLOR_MODES, defaults to config.IMAGE_COLOR_MODE.
+
+    Returns:
+        bytes: The rendered frame, or None if the image can't be loaded.
+    """
+    mode = mode or config.IMAGE_RENDER_MODE
+    colors = colors or config.IMAGE_COLOR_MODE
+    columns, lines = terminal_target_size()
+
+    key = (digest or content_hash(source), columns, lines, mode, colors)
+    frame = render_cache.CACHE.get(key)
+    if frame is None:
+        frame = render_frame(source, columns, lines, mode, colors)
+        if frame is not None:
+            render_cache.CACHE.put(key, frame)
+    return frame
+
+
+def write_frame(frame):
+    """Write a rendered frame to stdout in a single call."""
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is None:
+        sys.stdout.write(frame.decode("utf-8"))
+        sys.stdout.flush()
+        return
+    sys.stdout.flush()
+    buffer.write(frame)
+    buffer.flush()
+
+
+def display_image_in_terminal(image_path, mode=None, colors=None, digest=None):
+    """Display an image in the terminal using ANSI escape codes.
+
+    Args:
+        image_path: Path to the image file to display, or an open binary
+            file object.
+        mode: One of RENDER_MODES, defaults to config.IMAGE_RENDER_MODE.
+        colors: One of COLOR_MODES, defaults to config.IMAGE_COLOR_MODE.
+        digest: SHA-256 hex digest of the content if already known.
+    """
+    frame = render_image(image_path, digest, mode, colors)
+
+    if frame is None:
         print(f"Erro: Não foi possível carregar a imagem em '{image_path}' ou o modo de cor é incompatível.")
         return
 
-    img_height, img_width, channels = image.shape
-
-    k = 0 
-    for i in range(img_height): 
-        if i >= target_lines:
-            break 
-
-        for j in range(img_width): 
-            if j >= target_columns:
-                break 
-                    
-            if channels == 3:
-                r = image[i][j][k]
-                g = image[i][j][k+1]
-                b = image[i][j][k+2]
-            else: 
-                r = g = b = image[i][j][k]
-                
-            background_color_code = f"\033[48;2;{r};{g};{b}m"
-            reset_code = "\033[0m"
-
-            colored_char = f"{background_color_code} {reset_code}"
-                
-            print(colored_char, end="")
-
-        print()
+    write_frame(frame)
@@ -0,0 +1,51 @@
+"""LRU caches of rendered terminal images and received image bytes.
+
+Frames are keyed by (content hash, columns, lines, render mode, colours) and
+stored as the final ANSI bytes, so showing the same image again at the same
+terminal size skips decoding, resizing and rendering entirely. Received
+images are also kept by content hash so an ``image_ref`` for an image seen
+before never needs to be fetched again.
+"""
+from collections import OrderedDict
+
+from src.core import config
+
+
+class RenderCache:
+    """Byte-size bounded LRU mapping of cache keys to byte strings."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        frame = self.entries.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        if len(frame) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = frame
+        self.size += len(frame)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+CACHE = RenderCache(config.RENDER_CACHE_MAX_BYTES)
+MEDIA_CACHE = RenderCache(config.MEDIA_CACHE_MAX_BYTES)
@@ -12,12 +12,24 @@ if platform.system() == 'Windows':
 else:
     WINSOUND_AVAILABLE = False
 
-try:
-    import pygame
-    pygame.mixer.init()
-    PYGAME_AVAILABLE = True
-except ImportError:
-    PYGAME_AVAILABLE = False
+# pygame is imported and the audio device opened by the sound thread when
+# the first sound is needed, not when the client starts
+pygame = None
+PYGAME_AVAILABLE = None  # unknown until then
+
+
+def _init_pygame():
+    global pygame, PYGAME_AVAILABLE
+    if PYGAME_AVAILABLE is None:
+        try:
+            os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+            import pygame as module
+            module.mixer.init()
+            pygame = module
+            PYGAME_AVAILABLE = True
+        except Exception:
+            PYGAME_AVAILABLE = False
+    return PYGAME_AVAILABLE
 
 
 def is_terminal_focused():
@@ -59,36 +71,108 @@ def is_terminal_focused():
         return True
 
 
-def play_notification_sound(sound_path=None):
-    if config.IS_MUTED:
-        return
-    
-    if is_terminal_focused():
-        return
+SUPPORTED_FORMATS = ('.mp3', '.wav', '.ogg')
+
+
+class SoundWorker:
+    """Plays notification sounds on one long-lived thread.
+
+    Callers only record a request, so the receive loop never waits on the
+    focus check or on audio. Sounds are decoded once and kept, and a burst of
+    messages collapses into at most one chime per ``config.SOUND_COALESCE_MS``.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.requested = None     # sound path of the pending chime, "" for the beep
+        self.to_preload = None
+        self.last_request = 0.0
+        self.sounds = {}          # path -> decoded pygame.mixer.Sound
+        self.focused = False
+        self.focus_checked = 0.0
+
+    def request(self, sound_path):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_request < config.SOUND_COALESCE_MS / 1000:
+                return
+            self.last_request = now
+            self.requested = sound_path or ""
+        self._wake()
+
+    def preload(self, sound_path):
+        """Decode a sound ahead of its first use."""
+        with self.lock:
+            self.to_preload = sound_path
+        self._wake()
+
+    def _wake(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="sound", daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                sound_path, self.requested = self.requested, None
+                preload, self.to_preload = self.to_preload, None
+            try:
+                if preload:
+                    self._load(preload)
+                if sound_path is not None and not self._terminal_focused():
+                    self._play(sound_path)
+            except Exception:
+                pass
 
-    def play():
-        try:
-            if sound_path and os.path.exists(sound_path):
-                if PYGAME_AVAILABLE:
-                    if sound_path.lower().endswith(('.mp3', '.wav', '.ogg')):
-                        pygame.mixer.music.load(sound_path)
-                        pygame.mixer.music.play()
-                        while pygame.mixer.music.get_busy():
-                            time.sleep(0.1)
-                    else:
-                        print(f"\n[WARNING] Unsupported audio format. Please use .wav, .mp3, or .ogg files.")
-                        _play_system_beep()
-                elif WINSOUND_AVAILABLE and sound_path.lower().endswith('.wav'):
-                    winsound.PlaySound(sound_path, winsound.SND_FILENAME | winsound.SND_ASYNC)
+    def _terminal_focused(self):
+        # is_terminal_focused may spawn a subprocess, so its answer is reused for a while
+        now = time.monotonic()
+        if now - self.focus_checked >= config.FOCUS_CACHE_SECONDS:
+            self.focused = is_terminal_focused()
+            self.focus_checked = now
+        return self.focused
+
+    def _load(self, sound_path):
+        sound = self.sounds.get(sound_path)
+        if sound is None and _init_pygame() and sound_path.lower().endswith(SUPPORTED_FORMATS):
+            sound = self.sounds[sound_path] = pygame.mixer.Sound(sound_path)
+        return sound
+
+    def _play(self, sound_path):
+        if sound_path and os.path.exists(sound_path):
+            if _init_pygame():
+                if sound_path.lower().endswith(SUPPORTED_FORMATS):
+                    # Mixed on pygame's own channel: returns immediately
+                    self._load(sound_path).play()
                 else:
+                    print(f"\n[WARNING] Unsupported audio format. Please use .wav, .mp3, or .ogg files.")
                     _play_system_beep()
+            elif WINSOUND_AVAILABLE and sound_path.lower().endswith('.wav'):
+                winsound.PlaySound(sound_path, winsound.SND_FILENAME | winsound.SND_ASYNC)
             else:
                 _play_system_beep()
+        else:
+            _play_system_beep()
+
+
+WORKER = SoundWorker()
+
+
+def play_notification_sound(sound_path=None):
+    if config.IS_MUTED:
+        return
+
+    WORKER.request(sound_path)
 
-        except Exception as e:
-            pass
 
-    threading.Thread(target=play, daemon=True).start()
+def preload_notification_sound(sound_path):
+    if sound_path:
+        WORKER.preload(sound_path)
 
 
 def _play_system_beep():